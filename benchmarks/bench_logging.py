@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Time a conversion at each log level
+
+Usage:
+  bench_logging.py [--pages=<n>] [--repeat=<n>] [<infile>]
+
+Converts <infile> (or a generated book of --pages pages) with the default options
+at the levels of --quiet, the default and --verbose, log output going to the null
+device, and prints the best time of each. The debug payload of per-line messages
+is only built at the --verbose level, so --quiet and the default should be close.
+
+Options:
+  --pages=<n>    Pages in the generated book [default: 2000]
+  --repeat=<n>   Conversions timed at each level [default: 3]
+"""
+
+import logging
+import os
+import sys
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dp2ppgen import Converter
+
+
+levels = [("--quiet", logging.ERROR), ("default", logging.INFO), ("--verbose", logging.DEBUG)]
+
+pageLines = [
+    "-----File: {0:03d}.png---\\sparkle\\swanky\\Kipling\\------",
+    "It was a dark and stormy night and the rain fell in tor-*",
+    "*rents. The wind[{0}]--howled [**typo|fixed] loudly.",
+    "Another [oe]uvre  line with  spaces . ",
+    "",
+    "[Footnote {0}: A footnote here.]",
+    "",
+    "[Sidenote: Side note text]",
+    "Paragraph two con-",
+    "tinues here <i>at some</i> length.",
+    "",
+]
+
+
+def generateBook(pages):
+    lines = []
+    for pageNum in range(1, pages+1):
+        lines.extend(line.format(pageNum) for line in pageLines)
+    return lines
+
+
+def timeConversion(lines, level, repeat):
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    rootLogger = logging.getLogger()
+    rootLogger.addHandler(handler)
+    rootLogger.setLevel(level)
+
+    converter = Converter(["--force"])
+    best = None
+    try:
+        for i in range(repeat):
+            startTime = time.perf_counter()
+            converter.convert(lines)
+            seconds = time.perf_counter() - startTime
+            if best is None or seconds < best:
+                best = seconds
+    finally:
+        rootLogger.removeHandler(handler)
+        handler.stream.close()
+
+    return best
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args['<infile>']:
+        with open(args['<infile>'], encoding='utf-8', errors='replace') as f:
+            lines = f.read().split("\n")
+    else:
+        lines = generateBook(int(args['--pages']))
+
+    # Images and tables are looked for relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(args['<infile>'])) if args['<infile>'] else os.path.dirname(os.path.abspath(__file__)))
+
+    # Untimed first run, for the modules and caches the stages load on first use
+    timeConversion(lines, logging.CRITICAL, 1)
+
+    repeat = int(args['--repeat'])
+    print("{} lines, best of {}".format(len(lines), repeat))
+    baseline = None
+    for name, level in levels:
+        seconds = timeConversion(lines, level, repeat)
+        if baseline is None:
+            baseline = seconds
+        print("{:<10} {:8.3f}s {:+7.1%}".format(name, seconds, seconds/baseline - 1))
+
+
+if __name__ == "__main__":
+    main()
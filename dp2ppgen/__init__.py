@@ -1 +1 @@
-
+from .dp2ppgen import Converter, ConversionError, __version__
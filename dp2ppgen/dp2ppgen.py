@@ -5,21 +5,48 @@
 
 Usage:
   dp2ppgen [options] <infile> [<outfile>]
+  dp2ppgen [options] --batch [--manifest=<manifest>] [<infiles>...]
+  dp2ppgen [options] --serve=<address>
   dp2ppgen -h | --help
   dp2ppgen --version
 
-Translates pgdp.org formatted text files into ppgen syntax.
+Translates pgdp.org formatted text files into ppgen syntax. The input can also be
+a project zip as downloaded from DP, its text and images are read straight from
+the archive.
+
+Batch mode converts every given file, and every book listed in the manifest,
+with the same options. Each output is named as in single file mode. A manifest
+has one book per line in the form "infile [outfile]"; blank lines and lines
+starting with # are ignored. Images are taken from the images/ folder next to
+each book.
+
+Server mode listens on <address> (a port, host:port or the path of a Unix
+socket) and converts books POSTed to /convert as JSON, for example
+{"text": "...", "options": ["--pages", "--utf8"]}. The response holds the ppgen
+output and the warnings and errors raised during the conversion. Modules,
+image dimensions and rendered tables stay loaded between requests.
+
+Streaming mode reads, converts and writes a very large book a few pages at a
+time. Only the conversions that work within a page (or across one page break)
+are done: pages, fixup, utf8, sidenotes, illustrations and joinspanned. Options
+that need the whole book at once are skipped with a warning. Markup errors are
+reported once the whole book has been read, the output is not kept unless
+the --force option is given.
 
 Examples:
   dp2ppgen book.txt
   dp2ppgen book.txt book-src.txt
+  dp2ppgen --batch --jobs=4 */book.txt
+  dp2ppgen --serve=8040
 
 Options:
   --boilerplate                Pastes contents of header.txt and footer.txt to start and end
   -c, --chapters               Convert chapter headings into ppgen style chapter headings
+  --compact                    Hold the input as one string plus a line offset table rather than a string per line (less memory for very large books)
   --config=<config>            Use the set of options in the given configuration file
   --chaptermaxlines=<max>      Max lines a chapter can be, anything larger is not a chapter [default: 15]
   -d, --dryrun                 Run through conversions but do not write out result
+  --diagnostics=<file>         Also write warnings and errors to file as JSON Lines with problem code, line, scan page and snippet (and input line with --sourcemap)
   -e, --sections               Convert section headings into ppgen style section headings
   --sectionmaxlines=<max>      Max lines a section can be, ianything larger is not a section [default: 3]
   -f, --footnotes              Convert footnotes into ppgen format
@@ -30,6 +57,7 @@ Options:
   --fixup                      Perform guiguts style fixup operations
   --force                      Ignore markup errors and force operation
   -i, --illustrations          Convert raw [Illustration] tags into ppgen .il/.ca markup
+  --jobs=<n>                   Number of books to convert in parallel in batch mode (default: number of CPUs), or of processes checking the markup of a large book (default: 1)
   -j, --joinspanned            Join hypenations (-* *-) and formatting markup (/* */ /# #/) that spans page breaks
   --autofixhyphens             Analyze hyphenated word usage and replace joined hyphenations with best fit (if one exists)
   -k, --keeporiginal           On any conversion keep original text as a comment
@@ -37,9 +65,14 @@ Options:
   -q, --quiet                  Print less text
   -r, --report=[txt,html,csv]  Perform various analysis on the input file
   -s, --sidenotes              Convert sidenotes into ppgen format
+  --sourcemap                  Write <outfile>.map giving the input line and scan page of every output line
   --snkeepbreaks               Keep exact line endings for multi-line sidenotes
+  --scannos=<mode>             Report or fix (report, fix) words that look like l/1, rn/m or cl/d scannos of a word used far more often
+  --wordlist=<file>            Words (one per line) known to be good, added to the book's own words for --scannos
+  --stream                     Convert page by page holding only a few pages in memory (see Streaming mode)
   --detectmarkup               Best guess what out of line markup /* */ /# #/ represent (table, toc, poetry, etc..)
   --tnote                      Generate transcribers note
+  --mmap                       Read the input through a memory map instead of into memory up front, the conversion still decodes every line
   -m, --markup                 Convert out of line markup /* */ /# #/ into ppgen format
   -v, --verbose                Print more text
   -h, --help                   Show help
@@ -47,17 +80,18 @@ Options:
   --version                    Show version
 """
 
-from docopt import docopt
-import glob
+from docopt import docopt, DocoptExit
+import collections.abc
+import functools
+import itertools
 import re
 import os
 import sys
 import logging
-import tempfile
-import subprocess
-import shlex
-import json
-from PIL import Image
+import time
+
+# Heavier modules (PIL, json, shlex, subprocess, tempfile, glob) are imported by
+# the stages that use them to keep startup fast for runs that never need them
 
 
 __appname__ = "dp2ppgen"
@@ -92,11 +126,11 @@ markupTypes = {
         'count': None,
     },
     'index': {
-        'alias': ('idx'),
+        'alias': ('idx',),
         'count': None,
     },
     'blockquote': {
-        'alias': ('bq'),
+        'alias': ('bq',),
         'count': None,
     },
     'hangingindent': {
@@ -104,11 +138,11 @@ markupTypes = {
         'count': None,
     },
     'halftitle': {
-        'alias': ('ht'),
+        'alias': ('ht',),
         'count': None,
     },
     'signature': {
-        'alias': ('sig'),
+        'alias': ('sig',),
         'count': None,
     },
     #TODO
@@ -116,140 +150,247 @@ markupTypes = {
 }
 
 
-# Limited check for syntax errors in dp markup of input file
-def validateDpMarkup(inBuf):
+# Tokens checked by DpMarkupValidator. Lines are scanned joined by \n (no token may
+# span one) in two passes merged by position, one for out-of-line markup at the
+# start of a line and one for brackets and inline tags anywhere. A single
+# alternation with ^ branches is several times slower, the regex engine can then
+# no longer skip straight to the characters a token starts with.
+dpMarkupLineStartRegex = re.compile(r"^(?:\/[*#]|[*#]\/)", re.MULTILINE) # /* /# */ #/
+dpMarkupTokenRegex = re.compile(r"[\[\]]|<\/?[^>\n]>")                # [ ] <i> </i> <b> ...
 
-    # TODO, someone must have written a more thorough version of this already.. use that instead
+# Checks dp markup a line, or a sequence of lines, at a time so the input does not
+# have to be held in memory, see validateDpMarkup. Open markup is kept on a stack
+# of (line, markup).
+#
+# A validator can also check one chunk of a book on its own (chunk=True): errors
+# are then collected in events as (message, extra) rather than logged, and a
+# closer found with the stack empty is recorded as (None, (line, markup, openedBy))
+# since it may match markup opened in an earlier chunk, see mergeMarkupChunks.
+class DpMarkupValidator:
+
+    def __init__(self, lineNum=0, chunk=False):
+        self.formattingStack = []
+        self.errorCount = 0
+        self.lineNum = lineNum
+        self.events = [] if chunk else None
+
+    def checkLine(self, line):
+        self.checkLines([line])
+
+    def checkLines(self, lines):
+        self.checkText("\n".join(lines), len(lines))
+
+    # All tokens are found in one scan over the lines joined by \n, line numbers are
+    # only worked out for the lines that have tokens
+    def checkText(self, text, lineCount):
+        import heapq
+
+        lineNum = self.lineNum
+        self.lineNum += lineCount
+
+        # Check balance of /* */ /# #/, [], <i></i>
+        # () are not checked, diacritic markup [)x] gives false positives
+        tokens = heapq.merge(dpMarkupLineStartRegex.finditer(text), dpMarkupTokenRegex.finditer(text), key=matchStart)
+        pos = 0
+        footnoteStart = None
+        for m in tokens:
+            start = m.start()
+            if footnoteStart is not None and text.count("\n", footnoteStart, start):
+                self.checkFootnote(text, footnoteStart, lineNum)
+                footnoteStart = None
+            lineNum += text.count("\n", pos, start)
+            pos = start
+
+            v = m.group()
+            if v == "[":
+                # Single line [Footnote ...]
+                if text.startswith("[Footnote", start) and isFootnoteStart(text, start):
+                    footnoteStart = start
+                self.formattingStack.append((lineNum+1, v))
+            elif v == "]":
+                self.closeMarkup(lineNum, v, "[")
+            elif v[0] == "/": # /* /#
+                self.formattingStack.append((lineNum+1, v))
+            elif v[0] != "<": # */ #/
+                self.closeMarkup(lineNum, v, "/{}".format(v[0]))
+            elif "/" in v: # closing tag
+                self.closeMarkup(lineNum, v, v.replace("/", ""))
+            else:
+                self.formattingStack.append((lineNum+1, v))
 
-    logging.info("Checking input file for markup errors")
+        if footnoteStart is not None:
+            self.checkFootnote(text, footnoteStart, lineNum)
 
-    inBuf = removeTrailingSpaces(inBuf)
+        # Extra text after out-of-line formatting markup
+        # ex. /*[**new stanza?]
+#       m = re.match(r"(\/\*|\/\#|\*\/|\#\/)(.+)", line)
+#       if m and m.group(2) not in markupTypes['/*'] and m.group(2) not in markupTypes['/#']:
+#           self.errorCount += 1
+#           logging.error("Line {}: Extra text after out-of-line formatting markup\n       {}".format(lineNum+1, line))
 
-    formattingStack = []
-    lineNum = 0
-    errorCount = 0
-    while lineNum < len(inBuf):
+    # Check for specific issues that have caused conversion issues in the past, on the
+    # [Footnote line at text[start]
+    def checkFootnote(self, text, start, lineNum):
+        lineStart = text.rfind("\n", 0, start) + 1
+        lineEnd = text.find("\n", start)
+        line = text[lineStart:lineEnd if lineEnd != -1 else len(text)].rstrip(" \t")
 
-        # Detect unbalanced out-of-line formatting markup /# #/ /* */
-        m = re.match(r"\/(\*|\#)", inBuf[lineNum])
-        if m:
-            d = ({'ln':lineNum+1, 'v':"/{}".format(m.group(1))})
-            formattingStack.append(d)
+        # Single line [Footnote] does not end at closing ]
+        # ex. [Footnote 1: Duine, <i>Saints de Domnonée</i>, pp. 5-12].
+        if line.count('[') - line.count(']') == 0: # ignore multiline footnotes with proofer notes or some other [] markup within them
+            if not (line[-1] == ']' or line[-2:] == ']*'):
+                self.error("Line {}: Extra characters found after closing ']' in [Footnote]\n       {}".format(lineNum+1, line),
+                           markupDiagnostic("markup.footnote-trailing-text", lineNum+1, line))
+
+    # Pops the open markup v closes, or reports v as unexpected
+    def closeMarkup(self, lineNum, v, openedBy):
+        stack = self.formattingStack
+        if stack and stack[-1][1] == openedBy:
+            stack.pop()
+        elif not stack and self.events is not None:
+            self.events.append((None, (lineNum+1, v, openedBy)))
+        else:
+            self.error(*unexpectedMarkup(lineNum+1, v, stack))
 
-        m = re.match(r"(\*|\#)\/", inBuf[lineNum])
-        if m:
-            v = m.group(1)
-            if len(formattingStack) == 0 or formattingStack[-1]['v'] != "/{}".format(v):
-                errorCount += 1
-                if len(formattingStack) == 0:
-                    logging.error("Line {}: Unexpected {}/".format(lineNum+1, v))
-                else:
-                    logging.error("Line {}: Unexpected {}/, previous ({}:{})".format(lineNum+1, v, formattingStack[-1]['ln'], formattingStack[-1]['v']))
+    def error(self, message, extra=None):
+        self.errorCount += 1
+        if self.events is None:
+            logging.error(message, extra=extra)
+        else:
+            self.events.append((message, extra))
+
+    # Reports markup left open at end of input, returns number of errors found
+    def finish(self):
+        errorCount = self.errorCount
+        formattingStack = self.formattingStack
+
+        # Look for unresolved <i></i>, [], {}
+        if formattingStack:
+            errorCount += 1
+            s = "Line {}: '{}'".format(formattingStack[0][0], formattingStack[0][1])
+            for ln, v in formattingStack[1:]:
+                s += ", Line {}: '{}'".format(ln, v)
+            logging.error("Reached end of file with unresolved formatting markup, (probably due to previous markup error(s))",
+                          extra=markupDiagnostic("markup.unresolved", formattingStack[0][0], s))
+
+            if errorCount == 1:
+                logging.error("Unresolved markup:", extra=diagnosticDetail)
+                logging.error(s, extra=diagnosticDetail)
             else:
-                formattingStack.pop()
+                logging.debug(formattingStack)
 
+        if errorCount > 0:
+            logging.info("Found {} markup errors".format(errorCount))
 
-#       # Check balance of [], {}, (), <i></i>
-#       m = re.findall(r"(\[|\]|\{|\}|\(|\)|<\/?\w+>)", inBuf[lineNum])
+        return errorCount
 
-#       # Check balance of [], {}, <i></i>
-#       m = re.findall(r"(\[|\]|\{|\}|<\/?\w+>)", inBuf[lineNum])
 
-        # Check balance of [], <i></i>
-        m = re.findall(r"(\[|\]|<\/?[^>]>)", inBuf[lineNum])
-        for v in m:
+# Diagnostic for markup errors, validation runs on the input so lines are input lines
+def markupDiagnostic(code, lineNum, snippet):
+    return diagnostic(code, lineNum-1, snippet=snippet, stage="validateDpMarkup", inputLine=lineNum)
 
-            if v == "<tb>": # ignore
-                pass
 
-            elif v == "]": # closing markup
-                if len(formattingStack) == 0 or formattingStack[-1]['v'] != "[":
-                    errorCount += 1
-                    if len(formattingStack) == 0:
-                        logging.error("Line {}: Unexpected {}".format(lineNum+1, v))
-                    else:
-                        logging.error("Line {}: Unexpected {}, previous ({}:{})".format(lineNum+1, v, formattingStack[-1]['ln'], formattingStack[-1]['v']))
-                else:
-                    formattingStack.pop()
-
-#           elif v == "}": # closing markup
-#               if len(formattingStack) == 0 or formattingStack[-1]['v'] != "{":
-#                   errorCount += 1
-#                   if len(formattingStack) == 0:
-#                       logging.error("Line {}: Unexpected {}".format(lineNum+1, v))
-#                   else:
-#                       logging.error("Line {}: Unexpected {}, previous ({}:{})".format(lineNum+1, v, formattingStack[-1]['ln'], formattingStack[-1]['v']))
-#                       logging.debug("{}".format(formattingStack))
-#               else:
-#                   formattingStack.pop()
-
-            # Disabled as this will get false positives from diacratic markup [)x] and won't affect conversion anyways
-#               if len(formattingStack) == 0 or formattingStack[-1]['v'] != "(":
-#                   errorCount += 1
-#                   if len(formattingStack) == 0:
-#                       logging.error("Line {}: Unexpected {}".format(lineNum+1, v))
-#                   else:
-#                       logging.error("Line {}: Unexpected {}, previous ({}:{})".format(lineNum+1, v, formattingStack[-1]['ln'], formattingStack[-1]['v']))
-#                       logging.debug("{}".format(formattingStack))
-#               else:
-#                   formattingStack.pop()
-
-            elif "/" in v: # closing markup
-                v2 = re.sub("/", "", v)
-                if len(formattingStack) == 0 or formattingStack[-1]['v'] != v2:
-                    errorCount += 1
-                    if len(formattingStack) == 0:
-                        logging.error("Line {}: Unexpected {}".format(lineNum+1, v))
-                    else:
-                        logging.error("Line {}: Unexpected {}, previous ({}:{})".format(lineNum+1, v, formattingStack[-1]['ln'], formattingStack[-1]['v']))
-                else:
-                    formattingStack.pop()
+# Returns (message, extra) for closing markup v that does not match what is open
+def unexpectedMarkup(lineNum, v, stack):
+    extra = markupDiagnostic("markup.unexpected", lineNum, v)
+    if not stack:
+        return "Line {}: Unexpected {}".format(lineNum, v), extra
+    return "Line {}: Unexpected {}, previous ({}:{})".format(lineNum, v, stack[-1][0], stack[-1][1]), extra
 
-            else:
-                d = ({'ln':lineNum+1, 'v':v})
-                formattingStack.append(d)
 
+def matchStart(m):
+    return m.start()
 
-        # Check for specific issues that have caused conversion issues in the past
 
-        # Single line [Footnote] does not end at closing ]
-        # ex. [Footnote 1: Duine, <i>Saints de Domnonée</i>, pp. 5-12].
-        if re.match(r"\*?\[Footnote(.*)\]\*?.*$", inBuf[lineNum]):
-            if inBuf[lineNum].count('[') - inBuf[lineNum].count(']') == 0: # ignore multiline footnotes with proofer notes or some other [] markup within them
-                if not (inBuf[lineNum][-1] == ']' or inBuf[lineNum][-2:] == ']*'):
-                    errorCount += 1
-                    logging.error("Line {}: Extra characters found after closing ']' in [Footnote]\n       {}".format(lineNum+1, inBuf[lineNum]))
+# True if the [Footnote at text[start] opens its line (after an optional *) and
+# the line has a ] after it
+def isFootnoteStart(text, start):
+    lineStart = text.rfind("\n", 0, start) + 1
+    if start - lineStart > 1 or (start - lineStart == 1 and text[lineStart] != "*"):
+        return False
+    lineEnd = text.find("\n", start)
+    return text.find("]", start+9, lineEnd if lineEnd != -1 else len(text)) != -1
 
-        # Extra text after out-of-line formatting markup
-        # ex. /*[**new stanza?]
-#       m = re.match(r"(\/\*|\/\#|\*\/|\#\/)(.+)", inBuf[lineNum])
-#       if m and m.group(2) not in markupTypes['/*'] and m.group(2) not in markupTypes['/#']:
-#           errorCount += 1
-#           logging.error("Line {}: Extra text after out-of-line formatting markup\n       {}".format(lineNum+1, inBuf[lineNum]))
 
-        lineNum += 1
+# Checks the lineCount lines of text starting at lineNum as a chunk of a book,
+# returns (events, formattingStack), see DpMarkupValidator
+def validateMarkupChunk(text, lineNum, lineCount):
+    validator = DpMarkupValidator(lineNum, chunk=True)
+    validator.checkText(text, lineCount)
+    return validator.events, validator.formattingStack
+
 
-        # Chapters
-        # Sections
+# Combines the results of two adjacent chunks into the result of checking both as
+# one chunk. Closers the right chunk could not match are matched against markup
+# left open by the left chunk, exactly as a sequential run would have done, so
+# chunks can be merged in any grouping.
+def mergeMarkupChunks(left, right):
+    events = list(left[0])
+    stack = list(left[1])
+    for event in right[0]:
+        if event[0] is None and stack:
+            lineNum, v, openedBy = event[1]
+            if stack[-1][1] == openedBy:
+                stack.pop()
+            else:
+                events.append(unexpectedMarkup(lineNum, v, stack))
+        else:
+            events.append(event)
+    stack.extend(right[1])
 
-    # Look for unresolved <i></i>, [], {}
-    if formattingStack:
-        errorCount += 1
-        logging.error("Reached end of file with unresolved formatting markup, (probably due to previous markup error(s))")
+    return events, stack
 
-        if errorCount == 1:
-            logging.error("Unresolved markup:")
-            s = "Line {}: '{}'".format(formattingStack[0]['ln'], formattingStack[0]['v'])
-            for v in formattingStack[1:]:
-                s += ", Line {}: '{}'".format(v['ln'], v['v'])
-            logging.error(s)
+
+# Start line of each chunk when splitting inBuf into about chunkCount chunks, chunks
+# end at a page break
+def markupChunkStarts(inBuf, chunkCount):
+    chunkLines = -(-len(inBuf) // chunkCount)
+    starts = [0]
+    lineNum = chunkLines
+    while lineNum < len(inBuf):
+        if inBuf[lineNum].startswith("-----File: "):
+            starts.append(lineNum)
+            lineNum += chunkLines
         else:
-            logging.debug(formattingStack)
+            lineNum += 1
+
+    return starts
+
+
+# Books shorter than this are validated in this process, starting workers would
+# take longer than the check
+parallelValidationMinLines = 200000
+
+# Limited check for syntax errors in dp markup of input file, large books are
+# split at page breaks and checked on up to jobs processes
+def validateDpMarkup(inBuf, jobs=1):
+
+    # TODO, someone must have written a more thorough version of this already.. use that instead
+
+    logging.info("Checking input file for markup errors")
+
+    validator = DpMarkupValidator()
+    if jobs < 2 or len(inBuf) < parallelValidationMinLines:
+        validator.checkLines(inBuf)
+        return validator.finish()
 
-    if errorCount > 0:
-        logging.info("Found {} markup errors".format(errorCount))
+    import concurrent.futures
 
-    return errorCount
+    starts = markupChunkStarts(inBuf, jobs)
+    ends = starts[1:] + [len(inBuf)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(starts))) as executor:
+        futures = [executor.submit(validateMarkupChunk, "\n".join(inBuf[start:end]), start, end-start) for start, end in zip(starts, ends)]
+        events, stack = functools.reduce(mergeMarkupChunks, [future.result() for future in futures])
+
+    # Closers still unmatched had nothing open before them
+    for message, extra in events:
+        if message is None:
+            message, extra = unexpectedMarkup(extra[0], extra[1], None)
+        validator.error(message, extra)
+    validator.formattingStack = stack
+    validator.lineNum = len(inBuf)
+
+    return validator.finish()
 
 
 # Format helper function, truncate to width and indicate truncation occured with ...
@@ -271,10 +412,12 @@ def removeTrailingSpaces(inBuf):
 
 # Replace : [Blank Page]
 # with    : // [Blank Page]
-def processBlankPages(inBuf, keepOriginal):
+def processBlankPages(inBuf, keepOriginal, edits=None):
     outBuf = []
     lineNum = 0
     count = 0
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Processing blank pages")
 
@@ -282,8 +425,9 @@ def processBlankPages(inBuf, keepOriginal):
         if inBuf[lineNum].startswith("[Blank Page]"):
             if keepOriginal:
                 outBuf.append("// *** DP2PPGEN ORIGINAL: {}".format(inBuf[lineNum]))
+                edits.insertBefore(lineNum)
             outBuf.append("// [Blank Page]")
-            logging.debug("{:>{:d}}: '{}' to '{}'".format(str(lineNum+1), len(str(len(inBuf))), inBuf[lineNum], outBuf[-1]))
+            logging.debug(LazyFormat("{:>{:d}}: '{}' to '{}'", lineNum+1, len(str(len(inBuf))), inBuf[lineNum], outBuf[-1]))
             lineNum += 1
             count += 1
 
@@ -298,10 +442,12 @@ def processBlankPages(inBuf, keepOriginal):
 
 # Replace : -----File: 001.png---\sparkleshine\swankypup\Kipling\SeaRose\Scholar\------
 # with    : // 001.png
-def processPageNumbers(inBuf, keepOriginal):
+def processPageNumbers(inBuf, keepOriginal, edits=None):
     outBuf = []
     lineNum = 0
     count = 0
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Processing page numbers")
 
@@ -310,10 +456,12 @@ def processPageNumbers(inBuf, keepOriginal):
             scanPageNum = parseScanPage(inBuf[lineNum])
             if keepOriginal:
                 outBuf.append("// *** DP2PPGEN ORIGINAL: {}".format(inBuf[lineNum]))
+                edits.insertBefore(lineNum)
             s = ".bn {0} // -----------------------({0})".format(scanPageNum)
             outBuf.append("{0}{1}".format(s, '-'*max(72-len(s), 0)))
             outBuf.append(".pn +1")
-            logging.debug("{}: Page {}".format(str(lineNum+1), scanPageNum))
+            edits.insertAfter(lineNum)
+            logging.debug(LazyFormat("{}: Page {}", lineNum+1, scanPageNum))
             lineNum += 1
             count += 1
 
@@ -452,14 +600,11 @@ def findPreviousLineOfText(buf, startLine):
 
 # find next line that contains original book text
 # (ignore ppgen markup, proofing markup, blank lines)
+# (returns None if there is no more text in buf)
 def findNextLineOfText(buf, startLine):
     lineNum = findNextNonEmptyLine(buf, startLine)
-    retVal = None
-    while lineNum < len(buf) and not retVal:
-        if isLineOriginalText(buf[lineNum]):
-            retVal = lineNum
-        elif lineNum < len(buf)-1:
-            lineNum = findNextNonEmptyLine(buf, lineNum+1)
+    while lineNum is not None and not isLineOriginalText(buf[lineNum]):
+        lineNum = findNextNonEmptyLine(buf, lineNum+1)
     return lineNum
 
 def findNextChapter(buf, startLine):
@@ -472,11 +617,12 @@ def findNextChapter(buf, startLine):
     return retVal
 
 
-def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, chapterMaxLines, sectionMaxLines):
+def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, chapterMaxLines, sectionMaxLines, edits=None):
     outBuf = []
     lineNum = 0
+    if edits is None:
+        edits = LineEdits()
     consecutiveEmptyLineCount = 0
-    rewrapLevel = 0
     foundChapterHeadingStart = False
     chapterCount = 0
     sectionCount = 0
@@ -488,6 +634,9 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
     elif doSectionHeadings:
         logging.info("Processing section headings")
 
+    # Headings are not looked for inside out-of-line formatting blocks /# #/ /* */
+    oolf = OOLFBlocks(inBuf)
+
     while lineNum < len(inBuf):
         # Chapter heading blocks are in the form:
             # (4 empty lines)
@@ -504,19 +653,15 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
             # can span more than one line
             # (1 empty line)
 
-        # Detect when inside out-of-line formatting block /# #/ /* */
-        if inBuf[lineNum].startswith("/*") or inBuf[lineNum].startswith("/#"):
-            rewrapLevel += 1
-        elif inBuf[lineNum].startswith("*/") or inBuf[lineNum].startswith("#/"):
-            rewrapLevel -= 1
-
         # Chapter heading
         if (doChapterHeadings and
                 consecutiveEmptyLineCount == 4 and
                 not isLineBlank(inBuf[lineNum]) and
-                rewrapLevel == 0):
+                oolf.depth(lineNum) == 0):
             inBlock = []
             outBlock = []
+            outSources = [] # Line of inBuf each line of outBlock is made from, None if generated
+            blockStart = lineNum
             foundChapterHeadingEnd = False
             consecutiveEmptyLineCount = 0
 
@@ -553,8 +698,9 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
             chapterID = formatAsID(inBlock[0])
             chapterLine = ""
             extra = []
+            extraSources = []
             doneChapterLine = False
-            for line in inBlock:
+            for k, line in enumerate(inBlock):
                 if not isLineOriginalText(line):
                     doneChapterLine = True
 
@@ -563,15 +709,21 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                     chapterLine += "|"
                 else:
                     extra.append(line)
+                    extraSources.append(blockStart+k)
+
+            # Blank lines at the end of the block are dropped
+            blockSources = list(range(blockStart, blockStart+len(inBlock)))
 
             if not chapterLine:
-                logging.warning("Line {}: Disregarding chapter heading; no text found\n         {}".format(lineNum+1, inBlock[0]))
+                logging.warning("Line {}: Disregarding chapter heading; no text found\n         {}".format(lineNum+1, inBlock[0]), extra=diagnostic("heading.no-text", lineNum, snippet=inBlock[0]))
                 for line in inBlock:
                     outBuf.append(line)
+                edits.replace(blockStart, lineNum-blockStart, blockSources)
             elif len(inBlock) > int(chapterMaxLines):
-                logging.warning("Line {}: Disregarding chapter heading; too many lines ({} > {}):\n ---\n{}\n ---".format((lineNum-len(inBlock))+1, len(inBlock), chapterMaxLines, "\n".join(inBlock[0:6])))
+                logging.warning("Line {}: Disregarding chapter heading; too many lines ({} > {}):\n ---\n{}\n ---".format((lineNum-len(inBlock))+1, len(inBlock), chapterMaxLines, "\n".join(inBlock[0:6])), extra=diagnostic("heading.too-long", lineNum-len(inBlock), snippet=inBlock[0]))
                 for line in inBlock:
                     outBuf.append(line)
+                edits.replace(blockStart, lineNum-blockStart, blockSources)
 
             else:
                 while chapterLine[-1] == "|":
@@ -582,9 +734,13 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                     outBlock.append("// ******** DP2PPGEN GENERATED ****************************************")
                 outBlock.append(".sp 4")
                 outBlock.append(".h2 id={}".format(chapterID))
+                outSources.extend([None] * len(outBlock))
                 outBlock.append(chapterLine)
                 outBlock.extend(extra)
                 outBlock.append(".sp 2")
+                outSources.append(blockStart)
+                outSources.extend(extraSources)
+                outSources.append(None)
 
                 if keepOriginal:
                     # Write out original as a comment
@@ -596,10 +752,16 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                         outBlock.append(line)
                     outBlock.append("")
                     outBlock.append(".ig- // *** END *****************************************************")
+                    outSources.extend([None] * 4 + blockSources + [None] * 2)
 
-                # Remove the consecutive blank lines that preceed chapter heading
+                # Remove the consecutive blank lines that preceed chapter heading,
+                # these are the input lines just before the block
+                removed = 0
                 while isLineBlank(outBuf[-1]):
                     outBuf = outBuf[:-1]
+                    removed += 1
+                edits.delete(blockStart-removed, removed)
+                edits.replace(blockStart, lineNum-blockStart, outSources)
 
                 # Write out chapter heading block
                 for line in outBlock:
@@ -610,9 +772,10 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                 chapterCount += 1
 
         # Section heading
-        elif doSectionHeadings and consecutiveEmptyLineCount == 2 and not isLineBlank(inBuf[lineNum]) and rewrapLevel == 0:
+        elif doSectionHeadings and consecutiveEmptyLineCount == 2 and not isLineBlank(inBuf[lineNum]) and oolf.depth(lineNum) == 0:
             inBlock = []
             outBlock = []
+            blockStart = lineNum
             foundSectionHeadingEnd = False
             consecutiveEmptyLineCount = 0
 
@@ -628,12 +791,13 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
 
             # Check if this is a heading
             if len(inBlock) > int(sectionMaxLines):
-                logging.debug("Line {}: Disregarding section heading; too many lines ({} > {}):\n ---\n{}\n ---".format((lineNum-len(inBlock))+1, len(inBlock), sectionMaxLines, "\n".join(inBlock[0:6])))
+                logging.debug(LazyFormat("Line {}: Disregarding section heading; too many lines ({} > {}):\n ---\n{}\n ---", (lineNum-len(inBlock))+1, len(inBlock), sectionMaxLines, "\n".join(inBlock[0:6])))
                 for line in inBlock:
                     outBuf.append(line)
             else:
                 # Remove one of the two consecutive blank lines that preceed section heading
                 outBuf = outBuf[:-1]
+                edits.delete(blockStart-1)
 
                 # .sp 2
                 # .h3 id=section_i
@@ -651,6 +815,7 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                     outBlock.append("// ******** DP2PPGEN GENERATED ****************************************")
                 outBlock.append(".sp 2")
                 outBlock.append(".h3 id={}".format(sectionID))
+                outSources = [None] * len(outBlock) + [blockStart, None]
                 outBlock.append(sectionLine)
                 outBlock.append(".sp 1")
 
@@ -661,6 +826,8 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
                     for line in inBlock:
                         outBlock.append(line)
                     outBlock.append(".ig- // *** END *****************************************************")
+                    outSources.extend([None] * 2 + list(range(blockStart, blockStart+len(inBlock))) + [None])
+                edits.replace(blockStart, len(inBlock), outSources)
 
                 # Write out chapter heading block
                 for line in outBlock:
@@ -688,130 +855,295 @@ def processHeadings(inBuf, doChapterHeadings, doSectionHeadings, keepOriginal, c
     return outBuf
 
 
-def detectMarkup(inBuf):
-    outBuf = []
-    lineNum = 0
-    rewrapLevel = 0
-    markupCount = {'nf':0, 'ta':0, 'table':0, 'toc':0, 'title':0, 'poetry':0, 'index':0, 'bq':0, 'hang':0 }
+# An out-of-line formatting block, start is the line of its opening marker (/* or /#)
+# and its lines run up to end. closed is set when line end is its closing marker
+# (*/ or #/), not for a block still open at the end of the buffer (end is then the
+# length of the buffer) or one ended by the closing marker of a block around it.
+# command is the rest of the opening line (/*poetry in=2).
+class OOLFBlock:
+    __slots__ = ('dpType', 'start', 'end', 'closed', 'command', 'children')
+
+    def __init__(self, dpType, start, command):
+        self.dpType = dpType
+        self.start = start
+        self.end = None
+        self.closed = False
+        self.command = command
+        self.children = []
+
+    # Line after the block
+    def next(self):
+        return self.end + 1 if self.closed else self.end
+
+
+# The out-of-line formatting blocks of a buffer, found in one pass with a stack so a
+# nested block (/# /* */ #/) ends at its own closing marker. blocks holds the
+# outermost blocks, each with the blocks nested in it as children. nowrapDepths and
+# quoteDepths give the number of /* */ and /# #/ blocks each line is inside, marker
+# lines counting as inside their block. A closing marker with no open block of its
+# kind is ignored, one that skips open blocks of the other kind closes them too.
+#
+#   oolf = OOLFBlocks(inBuf)
+#   if oolf.depth(lineNum) == 0: ...    # not in any /* */ or /# #/ block
+class OOLFBlocks:
+    def __init__(self, inBuf):
+        import array
+
+        self.blocks = []
+        self.nowrapDepths = array.array('H', bytes(2 * len(inBuf)))
+        self.quoteDepths = array.array('H', bytes(2 * len(inBuf)))
+        stack = []
+        depths = {"*": 0, "#": 0}
+
+        for i, line in enumerate(inBuf):
+            if line.startswith(("/*", "/#")):
+                block = OOLFBlock(line[1], i, line[2:])
+                (stack[-1].children if stack else self.blocks).append(block)
+                stack.append(block)
+                depths[block.dpType] += 1
+                self.nowrapDepths[i] = depths["*"]
+                self.quoteDepths[i] = depths["#"]
+            elif line.startswith(("*/", "#/")):
+                self.nowrapDepths[i] = depths["*"]
+                self.quoteDepths[i] = depths["#"]
+                dpType = line[0]
+                if any(block.dpType == dpType for block in stack):
+                    while True:
+                        block = stack.pop()
+                        block.end = i
+                        depths[block.dpType] -= 1
+                        if block.dpType == dpType:
+                            block.closed = True
+                            break
+            else:
+                self.nowrapDepths[i] = depths["*"]
+                self.quoteDepths[i] = depths["#"]
 
-    while lineNum < len(inBuf):
+        for block in stack:
+            block.end = len(inBuf)
 
-        # Process no-wrap /* */ markup
-        #   table
-        #   toc
-        #   titlepage
-        #   poetry
-        #   index
-        m = re.match(r"\/(\*|\#)(.*)", inBuf[lineNum])
-        if m:
-            inBlock = []
-            outBlock = []
-            foundChapterHeadingEnd = False
-            consecutiveEmptyLineCount = 0
-            markupType = m.group(2).split(" ")[0]
-            dpType = m.group(1)
+    def depth(self, lineNum):
+        return self.nowrapDepths[lineNum] + self.quoteDepths[lineNum]
 
-            # Copy nowrap block
-            #TODO handle nested case where /* /* */ */
-            lineNum += 1
-            while lineNum < len(inBuf) and not inBuf[lineNum].startswith("{}/".format(dpType)):
-                inBlock.append(inBuf[lineNum])
-                lineNum += 1
-            lineNum += 1
+    # Keep the depths in step with a stage deleting line lineNum of the buffer, block
+    # spans are not updated
+    def deleteLine(self, lineNum):
+        del self.nowrapDepths[lineNum]
+        del self.quoteDepths[lineNum]
+
+    # All blocks, outer blocks before the blocks nested in them
+    def walk(self, blocks=None):
+        for block in self.blocks if blocks is None else blocks:
+            yield block
+            yield from self.walk(block.children)
+
+
+def detectMarkup(inBuf):
+    outBuf = list(inBuf)
+    markupCount = collections.Counter()
 
-            # autodetect markup
-            if not markupType:
-                markupType = detectMarkupType(inBlock, dpType)
+    logging.info("Detecting out of line markup types")
 
+    # Blocks with no type on their opening line are given the best guess of their
+    # type (see detectMarkupType), including blocks nested in others
+    for block in OOLFBlocks(inBuf).walk():
+        markupType = block.command.split(" ")[0]
+        if not markupType:
+            markupType = detectMarkupType(inBuf[block.start+1:block.end], block.dpType)
             if markupType:
-                markupCount[markupType] += 1
+                outBuf[block.start] = "/{}{}".format(block.dpType, markupType)
 
-            outBuf.append("/{}{}".format(dpType, markupType))
-            for line in inBlock:
-                outBuf.append(line)
-            outBuf.append("{}/".format(dpType))
+        if markupType:
+            markupCount[markupType] += 1
 
-        else:
-            outBuf.append(inBuf[lineNum])
-            lineNum += 1
+    logging.info("Out of line markup types: {}".format(", ".join("{} {}".format(count, t) for t, count in markupCount.items()) or "none"))
 
     return outBuf
 
 
-def processOOLFMarkup(inBuf, keepOriginal):
-    outBuf = []
-    lineNum = 0
-    rewrapLevel = 0
-    markupCount = {'nf':0, 'ta':0, 'table':0, 'toc':0, 'title':0, 'poetry':0, 'index':0, 'bq':0, 'hang':0, 'signature':0 }
+# Converters of /* */ and /# #/ blocks by canonical markup type, and the canonical
+# type of each type name and alias. A handler is called as
+#   outBlock = handler(inBlock, keepOriginal, args)
+# with the lines between the block's markers and the arguments on its opening line
+# (see parseArgs), and returns the lines to replace the whole block with.
+markupHandlers = {}
+markupAliases = {}
 
-    while lineNum < len(inBuf):
+def registerMarkupHandler(markupType, handler, aliases=()):
+    if markupType in markupTypes and not aliases:
+        aliases = markupTypes[markupType]['alias'] or ()
+    markupHandlers[markupType] = handler
+    markupAliases[markupType] = markupType
+    for alias in aliases:
+        markupAliases[alias] = markupType
 
-        # Process no-wrap /* */ markup
-        #   table
-        #   toc
-        #   titlepage
-        #   poetry
-        #   index
-        m = re.match(r"\/(\*|\#)(.*)", inBuf[lineNum])
-        if m:
-            inBlock = []
-            outBlock = []
-            foundChapterHeadingEnd = False
-            consecutiveEmptyLineCount = 0
-            markupType = parseMarkupType(m.group(2))
-            args = parseArgs(m.group(2))
-            dpType = m.group(1)
 
-            # Copy nowrap block
-            #TODO handle nested case where /* /* */ */
-            nowrapStartLine = inBuf[lineNum]
-            lineNum += 1
-            while lineNum < len(inBuf) and not inBuf[lineNum].startswith("{}/".format(dpType)):
-                inBlock.append(inBuf[lineNum])
-                lineNum += 1
-            nowrapEndLine = inBuf[lineNum]
-            lineNum += 1
+# Handlers from other packages, declared as entry points in the dp2ppgen.markup
+# group, e.g. in setup.py
+#   entry_points={'dp2ppgen.markup': ['glossary = mypackage.blocks:processGlossary']}
+# The entry point name is the markup type (/*glossary), a handler's aliases
+# attribute may list other names for it. Loaded on first use, a plugin handler
+# replaces a built in one of the same type.
+markupPluginsLoaded = False
 
-            if markupType:
-                logging.info("----- Found {}, line {}".format(markupType, lineNum))
-
-                if markupType == "nf":
-                    outBlock = processNf(inBlock, keepOriginal, args)
-                elif markupType == "ta":
-                    outBlock = processTa(inBlock, keepOriginal, args)
-                elif markupType == "table":
-                    outBlock = processTable(inBlock, keepOriginal)
-                elif markupType == "toc":
-                    outBlock = processToc(inBlock, keepOriginal, args)
-                elif markupType == "title":
-                    outBlock = processTitlePage(inBlock, keepOriginal)
-                elif markupType == "poetry":
-                    outBlock = processPoetry(inBlock, keepOriginal)
-                elif markupType == "index":
-                    outBlock = processIndex(inBlock, keepOriginal, args)
-                elif markupType == "bq":
-                    outBlock = processBlockquote(inBlock, keepOriginal, args)
-                elif markupType == "hang":
-                    outBlock = processHangingIndent(inBlock, keepOriginal, args)
-                elif markupType == "signature":
-                    outBlock = processSignature(inBlock, keepOriginal, args)
-                else:
-                    logging.warn("{}: Unknown markup type '{}' found".format(lineNum+1, markupType))
+def loadMarkupPlugins():
+    global markupPluginsLoaded
+    import importlib.metadata
 
-                c = markupCount.get(markupType, 0)
-                markupCount[markupType] = c + 1
+    if markupPluginsLoaded:
+        return
+    markupPluginsLoaded = True
 
-                for line in outBlock:
-                    outBuf.append(line)
-            else:
-                outBuf.append(nowrapStartLine)
-                for line in inBlock:
-                    outBuf.append(line)
-                outBuf.append(nowrapEndLine)
+    try:
+        entryPoints = importlib.metadata.entry_points(group='dp2ppgen.markup')
+    except TypeError:
+        # Python < 3.10
+        entryPoints = importlib.metadata.entry_points().get('dp2ppgen.markup', [])
+
+    for entryPoint in entryPoints:
+        try:
+            handler = entryPoint.load()
+        except Exception as e:
+            logging.warning("Couldn't load markup handler {} ({}): {}".format(entryPoint.name, entryPoint.value, e))
+            continue
+        registerMarkupHandler(entryPoint.name, handler, getattr(handler, 'aliases', ()))
+        logging.debug("Loaded markup handler {} from {}".format(entryPoint.name, entryPoint.value))
+
+
+# Gives diagnostics logged by a markup handler, whose line is a line of the block it
+# was given, the line of the stage's buffer that block line comes from.
+# processOOLFMarkup sets lineMap while a handler runs. Converter.process adds it
+# to the root logger ahead of SourceMapLogFilter, which expects buffer lines.
+class BlockLineLogFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.lineMap = None
+
+    def filter(self, record):
+        fields = getattr(record, 'diagnostic', None)
+        if self.lineMap is not None and fields and 'line' in fields and 0 < fields['line'] <= len(self.lineMap):
+            record.diagnostic = dict(fields, line=self.lineMap[fields['line']-1]+1)
+        return True
 
-        else:
-            outBuf.append(inBuf[lineNum])
-            lineNum += 1
+
+# ppgen page links, #text:Page_12# and the short form #12#, the page is in group 1 or 2
+pageLinkRegex = re.compile(r"#(?:[^#\n]*?:Page_(\w+)|(\d+|[ivxlcdmIVXLCDM]+))#")
+
+def processOOLFMarkup(inBuf, keepOriginal, edits=None, blockLines=None):
+    outBuf = []
+    lineNum = 0
+    if edits is None:
+        edits = LineEdits()
+    rootLogger = logging.getLogger()
+    ownBlockLines = blockLines is None
+    if ownBlockLines:
+        blockLines = BlockLineLogFilter()
+    markupCount = collections.Counter()
+    pageAnchors = None
+
+    loadMarkupPlugins()
+
+    def pageLinks(lines):
+        return collections.Counter(m.group(1) or m.group(2) for line in lines if "#" in line for m in pageLinkRegex.finditer(line))
+
+    # Report the page links a handler made (toc, index..) to pages the book does not
+    # have, once per block. Links already in the lines it was given (inLinks, those
+    # of nested blocks) were checked with their own block. The page labels are found on first
+    # use, they are only known once a .pn statement gives an absolute page number.
+    def checkPageLinks(outBlock, inLinks, block, markupType):
+        nonlocal pageAnchors
+
+        links = list((pageLinks(outBlock) - inLinks).elements())
+        if not links:
+            return
+        if pageAnchors is None:
+            pageIndex = PageIndex(inBuf)
+            pageAnchors = pageIndex.labels()
+            if pageIndex.numberedFrom is None:
+                logging.info("No .pn statements with a page number found, page links are not checked")
+        if not pageAnchors:
+            return
+
+        dangling = [page for page in links if page not in pageAnchors]
+        if dangling:
+            logging.warning("Line {}: {} of {} page links in {} block point to pages that do not exist: {}".format(block.start+1, len(dangling), len(links), markupType, ", ".join(dict.fromkeys(dangling))), extra=diagnostic("links.dangling", block.start, snippet=inBuf[block.start], stage="processOOLFMarkup"))
+
+    # Handlers only return lines, each line they return is taken to be from the
+    # next line of the block with the same text, if there is one (None if not)
+    def matchSources(inBlock, sources, outBlock):
+        lines = collections.defaultdict(collections.deque)
+        for k, line in enumerate(inBlock):
+            if line.strip():
+                lines[line.strip()].append(k)
+
+        outSources = []
+        nextLine = 0
+        for line in outBlock:
+            candidates = lines.get(line.strip())
+            while candidates and candidates[0] < nextLine:
+                candidates.popleft()
+            if candidates:
+                nextLine = candidates.popleft() + 1
+                outSources.append(sources[nextLine-1])
+            else:
+                outSources.append(None)
+        return outSources
+
+    # Lines of a block converted by the handler for its type (see markupHandlers),
+    # untyped blocks are left as they are, and the line of inBuf each is from (None
+    # for generated lines). Nested blocks are converted first, their output is part
+    # of the lines handed to the handler of the block around them.
+    def processBlock(block):
+        inBlock = []
+        lineMap = [] # Line of inBuf each line of inBlock comes from, see BlockLineLogFilter
+        sources = []
+        start = block.start + 1
+        for child in block.children:
+            inBlock.extend(inBuf[start:child.start])
+            lineMap.extend(range(start, child.start))
+            sources.extend(range(start, child.start))
+            childBlock, childSources = processBlock(child)
+            inBlock.extend(childBlock)
+            lineMap.extend([child.start] * len(childBlock))
+            sources.extend(childSources)
+            start = child.next()
+        inBlock.extend(inBuf[start:block.end])
+        lineMap.extend(range(start, block.end))
+        sources.extend(range(start, block.end))
+
+        markupType = parseMarkupType(block.command)
+        if markupType:
+            logging.info("----- Found {}, line {}".format(markupType, block.start+1))
+            markupCount[markupType] += 1
+
+            handler = markupHandlers.get(markupType)
+            if handler:
+                # Handlers may change inBlock in place
+                inLinks = pageLinks(inBlock)
+                originalBlock = list(inBlock)
+                blockLines.lineMap = lineMap
+                if ownBlockLines:
+                    rootLogger.addFilter(blockLines)
+                try:
+                    outBlock = handler(inBlock, keepOriginal, parseArgs(block.command))
+                finally:
+                    blockLines.lineMap = None
+                    if ownBlockLines:
+                        rootLogger.removeFilter(blockLines)
+                checkPageLinks(outBlock, inLinks, block, markupType)
+                return outBlock, matchSources(originalBlock, sources, outBlock)
+            logging.warning("{}: Unknown markup type '{}' found".format(block.start+1, markupType), extra=diagnostic("markup.unknown-type", block.start, snippet=markupType))
+
+        return (inBuf[block.start:block.start+1] + inBlock + inBuf[block.end:block.next()],
+                [block.start] + sources + list(range(block.end, block.next())))
+
+    for block in OOLFBlocks(inBuf).blocks:
+        outBuf.extend(inBuf[lineNum:block.start])
+        outBlock, sources = processBlock(block)
+        outBuf.extend(outBlock)
+        edits.replace(block.start, block.next()-block.start, sources)
+        lineNum = block.next()
+    outBuf.extend(inBuf[lineNum:])
 
     # Add table CSS
     if markupCount['table'] > 0:
@@ -840,6 +1172,7 @@ def processOOLFMarkup(inBuf, keepOriginal):
         cssBlock.append("")
 
         outBuf[0:0] = cssBlock
+        edits.insertBefore(0, len(cssBlock))
 
     return outBuf
 
@@ -900,7 +1233,7 @@ def processTa(inBuf, keepOriginal, args):
     return outBuf
 
 
-def processTitlePage(inBuf, keepOriginal):
+def processTitlePage(inBuf, keepOriginal, args):
     outBuf = []
     lineNum = 0
 
@@ -1008,7 +1341,7 @@ def processIndex(inBuf, keepOriginal, args):
         if isLineOriginalText(inBuf[lineNum]):
             m = re.search(r"(\d{4,})", inBuf[lineNum])
             if m:
-                logging.warning("Link not created for digit in index: {}".format(m.group(1)))
+                logging.warning("Link not created for digit in index: {}".format(m.group(1)), extra=diagnostic("index.digit-link", lineNum, snippet=inBuf[lineNum]))
             inBuf[lineNum] = re.sub(s, r, inBuf[lineNum])
         outBuf.append(inBuf[lineNum])
         lineNum += 1
@@ -1026,6 +1359,8 @@ def processIndex(inBuf, keepOriginal, args):
 #   arg=val
 #   val val
 def parseArgs(commandLine):
+    import shlex
+
     args = {}
 
     # break up command line
@@ -1044,87 +1379,198 @@ def parseArgs(commandLine):
     return(args)
 
 
+# Canonical markup type (see markupTypes) of the first word of a /* or /# line
 def parseMarkupType(commandLine):
     markupType = commandLine.split(" ")[0]
 
-    if markupType == "sig":
-        markupType == "signature"
-    elif markupType == "poem":
-        markupType == "poetry"
-
-    return(markupType)
-
-
+    return markupAliases.get(markupType, markupType)
+
+
+# TOC line styles in the order they are tried, s matches a line and r is its
+# replacement, columns the .ta columns the replacement fills
+tocStyles = (
+    # 3. County and Shire. Meaning of the Words      42
+    { 's': re.compile(r'^(\d+?\.) (.+?) {6,}(\d+)'), 'r': r'\1|#\2:Page_\3#|#\3#', 'columns': 'rlr' },
+    # XI. Columbus and the Savages      48
+    { 's': re.compile(r'^([XIVLC]+?\.) (.+?) {6,}(\d+)'), 'r': r'\1|#\2:Page_\3#|#\3#', 'columns': 'rlr' },
+    # SIR CHRISTOPHER WREN      24
+    { 's': re.compile(r'^(.+?) {6,}(\d+)'), 'r': r'#\1:Page_\2#|#\2#', 'columns': 'lr' },
+)
+
+# Each line of a TOC (or list of illustrations, tables..) is matched once against
+# the styles (or the s argument) and converted with the match found, so a TOC can
+# mix styles. Rows of a style with fewer columns than the widest style used get
+# empty cells in front to line up with the others. A TOC in no known style is kept
+# as a .nf l block.
 def processToc(inBuf, keepOriginal, args):
     outBuf = []
-    lineNum = 0
 
-    tocStyles = (
-        # 3. County and Shire. Meaning of the Words      42
-        { 's': r'^(\d+?\.) (.+?) {6,}(\d+)', 'r': r'\1|#\2:Page_\3#|#\3#', 'count': 0, 'columns': 'rlr' },
-        # XI. Columbus and the Savages      48
-        { 's': r'^([XIVLC]+?\.) (.+?) {6,}(\d+)', 'r': r'\1|#\2:Page_\3#|#\3#', 'count': 0, 'columns': 'rlr' },
-        # SIR CHRISTOPHER WREN      24
-        { 's': r'^(.+?) {6,}(\d+)', 'r': r'#\1:Page_\2#|#\2#', 'count': 0, 'columns': 'lr' },
-   )
-
-    # Does toc fit a known style?
-    for style in tocStyles:
-        for line in inBuf:
-            if re.search(style['s'], line):
-                style['count'] += 1
-
-    styleUsed = ""
-    maxCount = 0
-    for style in tocStyles:
-        if style['count'] > 0:
-            styleUsed = style
-            break
+    styles = tocStyles
+    if 's' in args:
+        styles = ({ 's': re.compile(args['s']), 'r': None, 'columns': None },)
+
+    # (lineNum, style, match) of each line in a known style
+    rows = []
+    for lineNum, line in enumerate(inBuf):
+        if isLineOriginalText(line):
+            for style in styles:
+                m = style['s'].search(line)
+                if m:
+                    rows.append((lineNum, style, m))
+                    break
 
-    # Use arguments if provided
-    columns = style['columns']
-    if 'columns' in args:
-        columns = args['columns']
-    s = styleUsed['s']
+    if not rows:
+        logging.warning("TOC is in no known style, kept as .nf l\n       {}".format(inBuf[0] if inBuf else ""), extra=diagnostic("toc.unknown-style", 0 if inBuf else None, snippet=inBuf[0] if inBuf else None))
+        return [".nf l"] + inBuf + [".nf-"]
+
+    # A custom s takes the replacement (if no r is given) and columns of the first
+    # built in style the TOC's rows are in
     if 's' in args:
-        s = args['s']
-    r = styleUsed['r']
-    if 'r' in args:
-        r = args['r']
+        firstStyle = next((style for style in tocStyles for lineNum, _, _ in rows if style['s'].search(inBuf[lineNum])), tocStyles[-1])
+        style = dict(styles[0], r=args.get('r', firstStyle['r']), columns=firstStyle['columns'])
+        rows = [(lineNum, style, m) for lineNum, _, m in rows]
 
-    outBuf.append(".ta {}".format(columns))
+    usedColumns = [style['columns'] for _, style, _ in rows]
+    columns = args.get('columns', max(usedColumns, key=len))
 
-    while lineNum < len(inBuf):
-        m = re.search(s, inBuf[lineNum])
-        if m:
-            print("{}: {}".format(lineNum+1, inBuf[lineNum]))
+    outBuf.append(".ta {}".format(columns))
 
-        if isLineOriginalText(inBuf[lineNum]):
-            inBuf[lineNum] = re.sub(s, r, inBuf[lineNum])
-        outBuf.append(inBuf[lineNum])
-        lineNum += 1
+    rowNum = 0
+    for lineNum, line in enumerate(inBuf):
+        if rowNum < len(rows) and rows[rowNum][0] == lineNum:
+            _, style, m = rows[rowNum]
+            rowNum += 1
+            logging.debug(LazyFormat("{}: {}", lineNum+1, line))
+            r = m.expand(args.get('r', style['r']))
+            line = "|" * (len(columns) - len(style['columns'])) + line[:m.start()] + r + line[m.end():]
+        outBuf.append(line)
 
     outBuf.append(".ta-")
 
     return outBuf
 
 
-def processPoetry(inBuf, keepOriginal):
+# Line number in the right margin of a poem, set off from the verse by 3 or more spaces
+poetryLineNumberRegex = re.compile(r"^(.*?\S) {3,}(\d{1,5})$")
+
+# Indentation profile of a poetry block, from one pass over its lines. indents holds
+# the leading spaces of each line, -1 for blank lines and -2 for lines that are not
+# verse (markup, page breaks). Indents are clustered into levels: the most used
+# indents become levels first and an indent one space off a level joins it, so
+# stray spaces do not make levels of their own. levels maps each indent to its
+# level's indent relative to the least indented level. lineNumbers maps the
+# index of a line with a margin line number to (verse, number); only numbers
+# that rise through the block are taken as line numbers.
+#
+#   profile = PoetryProfile(inBlock)
+#   profile.relativeIndent(i)    # spaces to indent line i by within .nf b
+class PoetryProfile:
+    def __init__(self, buf):
+        import array
+
+        self.indents = array.array('h', [-1]) * len(buf)
+        self.lineNumbers = {}
+        counts = collections.Counter()
+        lastNumber = 0
+
+        for i, line in enumerate(buf):
+            if not line.strip():
+                continue
+            if markupNonTextRegex.match(line) or (line.startswith(pageBreakPrefixes) and isLinePageBreak(line)):
+                self.indents[i] = -2
+                continue
+            text = line.lstrip(" ")
+            self.indents[i] = len(line) - len(text)
+            counts[self.indents[i]] += 1
+            if text[-1].isdigit():
+                m = poetryLineNumberRegex.match(line)
+                if m and int(m.group(2)) > lastNumber:
+                    lastNumber = int(m.group(2))
+                    self.lineNumbers[i] = (m.group(1).lstrip(" "), m.group(2))
+
+        self.levels = {}
+        for indent, count in sorted(counts.items(), key=lambda c: (-c[1], c[0])):
+            if indent-1 in self.levels and self.levels[indent-1] == indent-1:
+                self.levels[indent] = indent-1
+            elif indent+1 in self.levels and self.levels[indent+1] == indent+1:
+                self.levels[indent] = indent+1
+            else:
+                self.levels[indent] = indent
+        base = min(self.levels.values(), default=0)
+        for indent in self.levels:
+            self.levels[indent] -= base
+
+    def relativeIndent(self, i):
+        return self.levels[self.indents[i]]
+
+
+# Poetry in a .nf b block, its lines are kept as they are. /*poetry normalize
+# indents each line relative to the least indented level (see PoetryProfile),
+# leaves one blank line between stanzas, and sets margin line numbers off by two
+# spaces so they do not widen the block.
+def processPoetry(inBuf, keepOriginal, args):
     outBuf = []
-    lineNum = 0
 
     outBuf.append(".nf b")
 
-    while lineNum < len(inBuf):
-        outBuf.append(inBuf[lineNum])
-        lineNum += 1
+    if 'normalize' not in args:
+        outBuf.extend(inBuf)
+        outBuf.append(".nf-")
+        return outBuf
+
+    profile = PoetryProfile(inBuf)
+    for i, line in enumerate(inBuf):
+        indent = profile.indents[i]
+        if indent == -1:
+            if outBuf[-1] not in ("", ".nf b"):
+                outBuf.append("")
+        elif indent == -2:
+            outBuf.append(line)
+        elif i in profile.lineNumbers:
+            verse, number = profile.lineNumbers[i]
+            outBuf.append("{}{}  {}".format(" " * profile.relativeIndent(i), verse, number))
+        else:
+            outBuf.append(" " * profile.relativeIndent(i) + line.lstrip(" "))
+
+    # No blank line before the end of the block
+    if outBuf[-1] == "":
+        outBuf.pop()
 
     outBuf.append(".nf-")
 
+    logging.debug(LazyFormat("Poetry indent levels {}, {} line numbers", sorted(set(profile.levels.values())), len(profile.lineNumbers)))
+
     return outBuf
 
 
-def processTable(inBuf, keepOriginal):
+# Dictionary holding at most maxSize entries, the least recently used entry is
+# dropped to make room. Used by the caches kept for the life of the process so a
+# long running server does not grow without limit.
+class LRUCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+
+# rst2html output by rst table block, kept for the life of the process
+tableHTMLCache = LRUCache(256)
+
+def processTable(inBuf, keepOriginal, args):
     outBuf = []
     lineNum = 0
 
@@ -1135,8 +1581,13 @@ def processTable(inBuf, keepOriginal):
     rstBlock = dpTableToRst(inBuf)
 
     # Run through rst2html
-    logging.info("\n----- Generating HTML with rst2html")
-    tableHTML = rstTableToHTML(rstBlock)
+    cacheKey = tuple(rstBlock)
+    tableHTML = tableHTMLCache.get(cacheKey)
+    if tableHTML is None:
+        logging.info("\n----- Generating HTML with rst2html")
+        tableHTML = rstTableToHTML(rstBlock)
+        if tableHTML:
+            tableHTMLCache[cacheKey] = tableHTML
 
     # Build ppgen code
     outBuf.append(".if t")
@@ -1156,6 +1607,8 @@ def processTable(inBuf, keepOriginal):
 
 
 def rstTableToHTML(inBuf):
+    import subprocess
+    import tempfile
 
     # Build input to rstToHtml
     inFile = tempfile.NamedTemporaryFile(delete=False)
@@ -1176,7 +1629,8 @@ def rstTableToHTML(inBuf):
     # Parse table HTML from rst2html output
     outBuf = []
     inTable = False
-    for line in loadFile(outFileName):
+    inBuf, encoding = loadFile(outFileName)
+    for line in inBuf:
         if "<table" in line:
             line = '<table class="tableU1">'
             inTable = True
@@ -1229,6 +1683,8 @@ def rstTableToHTML(inBuf):
 
 
 def makeTempFile():
+    import tempfile
+
     tf = tempfile.NamedTemporaryFile(delete=False)
     fn = tf.name
     tf.close()
@@ -1238,6 +1694,7 @@ def makeTempFile():
 def dpTableToRst(inBuf):
     outBuf = inBuf[:]
     tableWidth = 0
+    deleted = 0 # Lines removed so far, i+deleted is the line in inBuf
 
     # Trim whitespace
     for i, line in enumerate(outBuf):
@@ -1275,89 +1732,310 @@ def dpTableToRst(inBuf):
 
         # Ignore lines not inside table (title etc.)
         if not inTable and line != "":
-            logging.warn("Ignoring line outside table:\n{}".format(line))
+            logging.warning("Ignoring line outside table:\n{}".format(line), extra=diagnostic("table.line-outside", i+deleted, snippet=line))
             del outBuf[i]
+            deleted += 1
 
     return outBuf
 
 
-def detectMarkupType(buf, dpType):
-    # Tables
-    matches = {
-              "table": {
-                       "--------+": 0,
-                       "=========": 0,
-                       "---------": 0,
-                       #TODO update and test better markup
-                       # "[-=]{6,}+": False,
-                       # "[-=]{6,}": False,
-                       "|": 0,
-                       "T[aAbBlLeE]": 0
-              },
-              "toc": {
-                       " {6,}\d+": 0,
-              },
-              "titlepage": {
-                       "": 0,
-                       #TODO.. close to top? is autodetect possible?
-              }
-    }
+# Built in markup handlers
+registerMarkupHandler('nf', processNf)
+registerMarkupHandler('ta', processTa)
+registerMarkupHandler('table', processTable)
+registerMarkupHandler('toc', processToc)
+registerMarkupHandler('title', processTitlePage)
+registerMarkupHandler('halftitle', processTitlePage)
+registerMarkupHandler('poetry', processPoetry)
+registerMarkupHandler('index', processIndex)
+registerMarkupHandler('blockquote', processBlockquote)
+registerMarkupHandler('hangingindent', processHangingIndent)
+registerMarkupHandler('signature', processSignature)
+
+
+# Line tests for markupBlockFeatures, each only tried on lines a cheaper test picks out
+markupNonTextRegex = re.compile(r"(\.[a-z0-9]{2} |[*#]\/|\/[*#]|\*?\[\w+|\/\/)")
+markupRuleRegex = re.compile(r"^[-=+|_ ]*[-=]{6,}[-=+|_ ]*$")
+markupTocLineRegex = re.compile(r"\S {6,}\d+$")
+markupIndexLineRegex = re.compile(r",\s*\d{1,4}(?:[-–]\d{1,4})?\.?$")
+markupColumnGapRegex = re.compile(r"\S {2,}(?=\S)")
+markupTableTitleRegex = re.compile(r"^\s*(?:TABLE|Table)\b")
+markupSignatureRegex = re.compile(r"^\s*(?:Yours|Sincerely|Faithfully|Respectfully|Truly)\b")
+markupSalutationRegex = re.compile(r"^\s*(?:Dear|My dear|Sir|Madam|Gentlemen)\b")
+markupContentsRegex = re.compile(r"^\s*(?:CONTENTS|Contents|TABLE OF CONTENTS)\.?\s*$")
+
+# Features of a block's lines for detectMarkupType, from one pass over them. Counts
+# are of lines of original text (not blank, markup or page breaks) unless named
+# otherwise. signatureLines only counts closing phrases (Yours truly..) in the last
+# two lines and salutationLines (Dear Sir..) the first line, proseLines are lines
+# long enough to be part of a paragraph.
+def markupBlockFeatures(buf):
+    f = dict.fromkeys(('lines', 'blankLines', 'ruleLines', 'borderLines', 'pipeLines', 'columnLines',
+                       'tableTitles', 'tocLines', 'contentsTitles', 'indexLines', 'indentedLines',
+                       'deepIndentLines', 'capsLines', 'capStartLines', 'endPunctuationLines',
+                       'byLines', 'signatureLines', 'salutationLines', 'proseLines', 'stanzaBreaks'), 0)
+    indents = set()
+    lengths = []
+    signatureAt = []
+    previousBlank = False
 
     for line in buf:
-        for key in matches:
-            for s in matches[key]:
-                if re.search(s, line) and isLineOriginalText(line):
-                    matches[key][s] += 1
-
-    if (matches["table"]["--------+"] and matches["table"]["|"]) or (matches["table"]["T[aAbBlLeE]"] and matches["table"]["--------+"]):
-        return "table"
-    elif matches["toc"][" {6,}\d+"]:
-        return "toc"
-
-    return ""
+        if not line:
+            f['blankLines'] += 1
+            previousBlank = True
+            continue
+        if markupNonTextRegex.match(line) or (line.startswith(pageBreakPrefixes) and isLinePageBreak(line)):
+            continue
+
+        text = line.lstrip()
+        indent = len(line) - len(text)
+        f['lines'] += 1
+        lengths.append(len(text))
+        indents.add(indent)
+        if previousBlank and f['lines'] > 1:
+            f['stanzaBreaks'] += 1
+        previousBlank = False
+
+        if indent:
+            f['indentedLines'] += 1
+            if indent >= 8:
+                f['deepIndentLines'] += 1
+        if ("---" in line or "===" in line) and markupRuleRegex.match(line):
+            f['ruleLines'] += 1
+            if "+" in line:
+                f['borderLines'] += 1
+            continue
+        if "|" in line:
+            f['pipeLines'] += 1
+        if text[0] == "T" and markupTableTitleRegex.match(line):
+            f['tableTitles'] += 1
+        if text[0] in "CT" and markupContentsRegex.match(line):
+            f['contentsTitles'] += 1
+        if line[-1].isdigit():
+            if markupTocLineRegex.search(line):
+                f['tocLines'] += 1
+            elif markupIndexLineRegex.search(line):
+                f['indexLines'] += 1
+        if "  " in text and len(markupColumnGapRegex.findall(text)) >= 2:
+            f['columnLines'] += 1
+        if text.isupper():
+            f['capsLines'] += 1
+        if text[0].isupper():
+            f['capStartLines'] += 1
+            if text.startswith(("BY ", "By ")):
+                f['byLines'] += 1
+            elif markupSignatureRegex.match(line):
+                signatureAt.append(f['lines'])
+            elif f['lines'] == 1 and markupSalutationRegex.match(line):
+                f['salutationLines'] += 1
+        if text[-1] in ".,;:!?":
+            f['endPunctuationLines'] += 1
+        if len(text) >= 50 and text.count(" ") >= 7:
+            f['proseLines'] += 1
+
+    f['signatureLines'] = sum([1 for k in signatureAt if k > f['lines'] - 2])
+    f['indents'] = len(indents)
+    f['meanLength'] = sum(lengths) / len(lengths) if lengths else 0
+    f['maxLength'] = max(lengths, default=0)
+
+    return f
+
+
+# detectMarkupType only chooses a type that scores at least markupDetectionThreshold
+# and leads the next best type by markupDetectionMargin. Blocks it is less sure of
+# are left untyped, as they were before --detectmarkup looked at them.
+markupDetectionThreshold = 1.5
+markupDetectionMargin = 0.5
+
+# Score of each markup type for a block's features (see markupBlockFeatures)
+def markupTypeScores(f, dpType):
+    n = f['lines'] or 1
+    share = lambda key: f[key] / n
+
+    scores = {}
+    scores['table'] = (f['borderLines'] > 0) + 0.5*(f['pipeLines'] > 0) + 0.5*(f['tableTitles'] > 0) + 0.5*(f['ruleLines'] > 0) \
+        + share('pipeLines') + share('columnLines') - share('tocLines')
+    scores['toc'] = 2*share('tocLines') + 0.5*(f['contentsTitles'] > 0) - share('columnLines')
+    scores['index'] = 2*share('indexLines')
+    scores['title'] = 1.5*share('capsLines') + 0.5*(f['blankLines'] >= f['lines']) + 0.5*(f['byLines'] > 0) \
+        - share('endPunctuationLines') - 0.5*(f['lines'] > 12)
+    # A letter (salutation or paragraphs) ends with a signature but is not one
+    scores['signature'] = 0.5*(f['lines'] <= 4) + share('deepIndentLines') + (f['signatureLines'] > 0)
+    if f['proseLines'] or f['salutationLines']:
+        scores['signature'] = 0.0
+    scores['poetry'] = 0.5*(f['meanLength'] < 50) + 0.5*share('capStartLines') + 0.25*(f['indents'] > 1) \
+        + 0.25*(f['stanzaBreaks'] > 0) + 0.25*(f['lines'] > 2) - 0.5*(f['lines'] < 2) - 0.5*(f['signatureLines'] > 0) \
+        - share('capsLines') - share('tocLines') - share('indexLines') - share('pipeLines') - share('ruleLines')
+    # An untyped /# #/ is already a block quote, only paragraphs of text make it bq
+    scores['bq'] = 1.0 + share('proseLines') if dpType == "#" else 0.0
+
+    return scores
+
+
+# Best guess of the type of a /* */ or /# #/ block, "" if nothing fits well
+def detectMarkupType(buf, dpType):
+    f = markupBlockFeatures(buf)
+    if not f['lines']:
+        return ""
+
+    scores = markupTypeScores(f, dpType)
+    markupType, runnerUp = sorted(scores, key=scores.get, reverse=True)[:2]
+    logging.debug(LazyFormat("Markup scores {}", scores))
+    if scores[markupType] < markupDetectionThreshold or scores[markupType] - scores[runnerUp] < markupDetectionMargin:
+        return ""
+
+    return markupType
+
+
+# Raised by fatal() so a caller converting many books can recover from a failure in one of them
+class ConversionError(Exception):
+    pass
+
+
+# Log message formatted only if a handler emits it, for messages logged per line or
+# per item that the log level usually filters out
+#   logging.debug(LazyFormat("{}: Page {}", lineNum+1, scanPageNum))
+class LazyFormat:
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+
+# For loops that would build debug output only to have it filtered out
+def isDebugEnabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+# Extra fields for a warning or error log record, written out by --diagnostics (see
+# DiagnosticsHandler). code names the problem, lineNum is the 0-based line in the
+# buffer the stage was working on (or in the block a markup handler was given, see
+# BlockLineLogFilter), fields adds any other of diagnosticFields.
+def diagnostic(code, lineNum=None, scanPage=None, snippet=None, **fields):
+    fields['code'] = code
+    if lineNum is not None:
+        fields['line'] = lineNum+1
+    if scanPage is not None:
+        fields['scanPage'] = scanPage
+    if snippet is not None:
+        fields['snippet'] = snippet
+    return {'diagnostic': fields}
+
+# Extra for log records that continue the previous message, these are not written
+# out as diagnostics of their own
+diagnosticDetail = {'diagnostic': None}
+
+diagnosticFields = ('code', 'severity', 'stage', 'line', 'inputLine', 'outputLine', 'scanPage', 'page', 'snippet', 'message')
+
+# Writes every warning and error logged to fn as a JSON object per line
+# (--diagnostics). Fields the logging call gave no value for are null, stage
+# defaults to the function that logged the record. In batch mode each book
+# appends to the same file and its records carry the book name. Records are held
+# until flush() at the end of a conversion, their output line is only known then
+# (see SourceMapLogFilter.finish).
+class DiagnosticsHandler(logging.Handler):
+    def __init__(self, fn, mode='w'):
+        super().__init__(logging.WARNING)
+        self.f = open(fn, mode, encoding='utf-8')
+        self.pending = []
+
+    def emit(self, record):
+        fields = getattr(record, 'diagnostic', {})
+        if fields is None:
+            return
+
+        self.pending.append((fields, record.levelname.lower(), record.funcName, record.getMessage(), getattr(record, 'book', None)))
+
+    def flush(self):
+        import json
+
+        self.acquire()
+        try:
+            for fields, severity, funcName, message, book in self.pending:
+                d = dict.fromkeys(diagnosticFields)
+                d.update(fields)
+                d['severity'] = severity
+                d['stage'] = d['stage'] or funcName
+                d['message'] = message
+                if book is not None:
+                    d['book'] = book
+
+                # One write per record keeps lines whole when batch workers share the file
+                self.f.write(json.dumps(d, ensure_ascii=False) + "\n")
+            self.pending = []
+            self.f.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        super().close()
+
+
+# Writes out the diagnostics held by --diagnostics, called once a conversion is done
+def flushDiagnostics():
+    for h in logging.getLogger().handlers:
+        if isinstance(h, DiagnosticsHandler):
+            h.flush()
 
 
 def fatal(errorMsg):
     logging.critical(errorMsg)
-    exit(1)
-    return
-
+    raise ConversionError(errorMsg)
 
-def loadFile(fn):
-    inBuf = []
-    encoding = ""
 
+def loadFile(fn, compact=False):
     if not os.path.isfile(fn):
         fatal("File not found: {}".format(fn))
 
+    with open(fn, "rb") as f:
+        data = f.read()
+
+    return decodeText(data, compact)
+
+
+# The lines of a book read into data, and its encoding, see loadFile. Each encoding
+# is tried on the bytes read.
+def decodeText(data, compact=False):
+    inBuf = []
+    wbuf = ""
+    encoding = ""
+
     if encoding == "":
         try:
-            wbuf = open(fn, "r", encoding='ascii').read()
+            wbuf = data.decode('ascii')
             encoding = "ASCII" # we consider ASCII as a subset of Latin-1 for DP purposes
-            inBuf = wbuf.split("\n")
-        except Exception as e:
+        except UnicodeDecodeError:
             pass
 
     if encoding == "":
         try:
-            wbuf = open(fn, "rU", encoding='UTF-8').read()
+            wbuf = data.decode('utf_8')
             encoding = "utf_8"
-            inBuf = wbuf.split("\n")
             # remove BOM on first line if present
-            t = ":".join("{0:x}".format(ord(c)) for c in inBuf[0])
-            if t[0:4] == 'feff':
-                inBuf[0] = inBuf[0][1:]
-        except:
+            if wbuf.startswith("\ufeff"):
+                wbuf = wbuf[1:]
+        except UnicodeDecodeError:
             pass
 
     if encoding == "":
         try:
-            wbuf = open(fn, "r", encoding='latin_1').read()
+            wbuf = data.decode('latin_1')
             encoding = "latin_1"
-            inBuf = wbuf.split("\n")
-        except Exception as e:
+        except UnicodeDecodeError:
             pass
 
+    del data
+
+    # Line ends as text mode reading would give them
+    if "\r" in wbuf:
+        wbuf = wbuf.replace("\r\n", "\n").replace("\r", "\n")
+
     if encoding == "":
         fatal("Cannot determine input file decoding")
     else:
@@ -1365,10 +2043,452 @@ def loadFile(fn):
         if encoding == "ASCII":
             encoding = "latin_1" # handle ASCII as Latin-1 for DP purposes
 
+    # Keep the file as read rather than as one string per line (--compact)
+    if compact:
+        return LineBuffer.fromText(wbuf, rstrip=True), encoding
+
+    inBuf = wbuf.split("\n")
     for i in range(len(inBuf)):
         inBuf[i] = inBuf[i].rstrip()
 
-    return inBuf
+    return inBuf, encoding
+
+
+# Determine the encoding of fn as loadFile does, without reading it all into memory
+def detectFileEncoding(fn, chunkSize=1 << 20):
+    if not os.path.isfile(fn):
+        fatal("File not found: {}".format(fn))
+
+    with open(fn, "rb") as f:
+        return detectStreamEncoding(f, chunkSize)
+
+
+# Determine the encoding of the binary file object f as loadFile does, reading it
+# in chunks
+def detectStreamEncoding(f, chunkSize=1 << 20):
+    import codecs
+
+    decoders = {
+        'ASCII': codecs.getincrementaldecoder('ascii')(),
+        'utf_8': codecs.getincrementaldecoder('utf_8')(),
+    }
+    while decoders:
+        chunk = f.read(chunkSize)
+        for encoding in list(decoders):
+            try:
+                decoders[encoding].decode(chunk, final=not chunk)
+            except UnicodeDecodeError:
+                del decoders[encoding]
+        if not chunk:
+            break
+
+    # ASCII is handled as Latin-1 for DP purposes, anything else that is not UTF-8 is Latin-1
+    if 'utf_8' in decoders and 'ASCII' not in decoders:
+        return "utf_8"
+    return "latin_1"
+
+
+# Yields the lines of fn one at a time, the same lines loadFile would return
+def iterFileLines(fn, encoding):
+    with open(fn, "r", encoding=encoding) as f:
+        for line in iterTextLines(f):
+            yield line
+
+
+# Yields the lines of the text file object f as loadFile would return them
+def iterTextLines(f):
+    line = ""
+    for lineNum, line in enumerate(f):
+        # remove BOM on first line if present
+        if lineNum == 0 and line.startswith("\ufeff"):
+            yield line[1:].rstrip()
+        else:
+            yield line.rstrip()
+
+    # A trailing newline (or an empty file) leaves one last empty line
+    if line == "" or line.endswith("\n"):
+        yield ""
+
+
+# Every line parseScanPage recognizes starts with one of these
+pageBreakPrefixes = ("-----File: ", "// ", ".bn ")
+
+# Groups lines into pages, each page starts with its page break line (any lines
+# before the first page break form a page of their own)
+def iterPages(lines):
+    page = []
+    for line in lines:
+        # Cheap test first, this runs on every line after every stage
+        if page and line.startswith(pageBreakPrefixes) and isLinePageBreak(line):
+            yield page
+            page = []
+        page.append(line)
+
+    if page:
+        yield page
+
+
+# Opens fn for reading through a memory map (--mmap), returns (lines, encoding) with
+# lines a MappedFile giving the same lines loadFile would. Files mmap cannot handle
+# (empty files) or that are not split on \n (old Mac line ends) go through loadFile.
+def mapFile(fn):
+    import mmap
+
+    if not os.path.isfile(fn):
+        fatal("File not found: {}".format(fn))
+
+    if os.path.getsize(fn) == 0:
+        return loadFile(fn)
+
+    with open(fn, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if re.search(rb"\r(?!\n)", mm):
+        mm.close()
+        return loadFile(fn)
+
+    # Only a file with non-ASCII bytes needs to be decoded to find its encoding
+    encoding = "latin_1"
+    start = 0
+    if re.search(rb"[\x80-\xff]", mm):
+        encoding = detectFileEncoding(fn)
+        if encoding == "utf_8" and mm[:3] == b"\xef\xbb\xbf":
+            start = 3
+
+    return MappedFile(mm, encoding, start), encoding
+
+
+# The lines of a memory mapped file (see mapFile). Line boundaries are found as far
+# as the lines asked for, and lines are decoded a block at a time with only the
+# last few blocks kept, so reading a few lines of a large book touches only the
+# pages of the file they are on. The conversion stages, --report and --tnote
+# included, read every line, so a conversion still decodes the whole book once;
+# what --mmap saves is holding the file's text and its lines in memory together.
+class MappedFile(collections.abc.Sequence):
+    blockLines = 256
+    cachedBlocks = 8
+
+    def __init__(self, mm, encoding, start=0):
+        from array import array
+
+        self.mm = mm
+        self.encoding = encoding
+        self.lineStarts = array('Q', [start])
+        self.indexed = False
+        self.blocks = {}
+
+    # Find line starts up to that of the line after lineNum (or all of them)
+    def indexTo(self, lineNum=None):
+        starts = self.lineStarts
+        find = self.mm.find
+        while not self.indexed and (lineNum is None or len(starts) < lineNum+2):
+            pos = find(b"\n", starts[-1])
+            if pos == -1:
+                starts.append(len(self.mm)+1)
+                self.indexed = True
+            else:
+                starts.append(pos+1)
+
+    def block(self, blockNum):
+        lines = self.blocks.pop(blockNum, None)
+        if lines is None:
+            first = blockNum * self.blockLines
+            self.indexTo(first + self.blockLines)
+            starts = self.lineStarts
+            last = min(first + self.blockLines, len(starts)-1)
+            if first >= last:
+                raise IndexError("line index out of range")
+
+            text = self.mm[starts[first]:starts[last]-1].decode(self.encoding)
+            lines = [line.rstrip() for line in text.split("\n")]
+
+            if len(self.blocks) >= self.cachedBlocks:
+                del self.blocks[next(iter(self.blocks))]
+
+        self.blocks[blockNum] = lines
+        return lines
+
+    def __len__(self):
+        self.indexTo()
+        return len(self.lineStarts)-1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+            if i < 0:
+                raise IndexError("line index out of range")
+        blockNum, n = divmod(i, self.blockLines)
+        return self.block(blockNum)[n]
+
+    def __iter__(self):
+        blockNum = 0
+        while True:
+            try:
+                lines = self.block(blockNum)
+            except IndexError:
+                return
+            for line in lines:
+                yield line
+            blockNum += 1
+
+    def close(self):
+        self.blocks = {}
+        self.mm.close()
+
+
+# Lines with trailing whitespace, for LineBuffer.fromText
+trailingSpaceRegex = re.compile(r"[^\S\n]+$", re.MULTILINE)
+
+# A buffer of lines held as one string plus an array of line start offsets, a large
+# book takes a fraction of the memory of a list of str (--compact). It behaves as a
+# list for everything the stages do with one: indexing, slicing, iteration,
+# assignment, insertion and deletion. Assigned and inserted lines are kept in an
+# overlay until the buffer is packed again; slices are views sharing the text of
+# the buffer they were taken from, only their line index is copied.
+#
+#   buf = LineBuffer.fromText("first\nsecond")
+#   buf[1] = "2nd"
+#   packLines(buf)  # new buffer with the edit folded into the text
+class LineBuffer(collections.abc.MutableSequence):
+
+    def __init__(self, lines=()):
+        lines = iter(lines)
+        first = next(lines, None)
+        if first is None:
+            self.load("", 0)
+        else:
+            text = "\n".join(itertools.chain([first], lines))
+            self.load(text, text.count("\n")+1)
+
+    @classmethod
+    def fromText(cls, text, rstrip=False):
+        if rstrip and trailingSpaceRegex.search(text):
+            text = trailingSpaceRegex.sub("", text)
+        buf = cls.__new__(cls)
+        buf.load(text, text.count("\n")+1)
+        return buf
+
+    def load(self, text, lineCount):
+        from array import array
+
+        # 32 bit offsets unless the text is too large for them
+        typecode = 'I' if len(text) < 1 << 32 else 'Q'
+        starts = array(typecode, [0]) * (lineCount+1)
+        pos = -1
+        for i in range(1, lineCount):
+            pos = text.find("\n", pos+1)
+            starts[i] = pos+1
+        starts[lineCount] = len(text)+1
+
+        self.text = text
+        self.starts = starts
+        self.textLines = lineCount
+        self.index = array(typecode, range(lineCount))
+        self.overlay = {}
+        self.newIds = itertools.count(lineCount)
+        self.pristine = True
+
+    # A buffer over the same text and overlay holding the given line index
+    def view(self, index):
+        buf = self.__class__.__new__(self.__class__)
+        buf.__dict__.update(self.__dict__)
+        buf.index = index
+        buf.pristine = False
+        return buf
+
+    def line(self, lineId):
+        if lineId < self.textLines:
+            return self.text[self.starts[lineId]:self.starts[lineId+1]-1]
+        return self.overlay[lineId]
+
+    def addLine(self, line):
+        lineId = next(self.newIds)
+        self.overlay[lineId] = line
+        return lineId
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.view(self.index[i])
+        return self.line(self.index[i])
+
+    def __iter__(self):
+        for lineId in self.index:
+            yield self.line(lineId)
+
+    def __setitem__(self, i, value):
+        self.pristine = False
+        if isinstance(i, slice):
+            ids = self.index[0:0]
+            ids.extend(self.addLine(line) for line in value)
+            self.index[i] = ids
+        else:
+            self.index[i] = self.addLine(value)
+
+    def __delitem__(self, i):
+        self.pristine = False
+        del self.index[i]
+
+    def insert(self, i, value):
+        self.pristine = False
+        self.index.insert(i, self.addLine(value))
+
+    def __repr__(self):
+        return "LineBuffer({} lines)".format(len(self))
+
+    def toText(self):
+        if self.pristine:
+            return self.text
+        return "\n".join(self)
+
+
+# Packs lines into a new LineBuffer, a LineBuffer that has not been changed since
+# it was packed (and has no trailing whitespace to strip) is returned as is
+def packLines(lines, rstrip=False):
+    if isinstance(lines, LineBuffer):
+        if lines.pristine and not (rstrip and trailingSpaceRegex.search(lines.text)):
+            return lines
+        if len(lines) == 0:
+            return LineBuffer()
+        return LineBuffer.fromText(lines.toText(), rstrip)
+    if rstrip:
+        lines = (line.rstrip() for line in lines)
+    return LineBuffer(lines)
+
+
+# Writes lines to fn as they are produced. Output goes to a temporary file in the
+# same directory which replaces fn only once everything has been written, so an
+# interrupted run never leaves a truncated file behind.
+#
+#   with AtomicLineWriter(outfile, encoding) as w:
+#       w.writeLines(outBuf)
+#
+# If a line cannot be represented in the requested encoding (ASCII/Latin-1 input
+# converted with --utf8 for example) the output is switched to UTF-8: writing goes
+# on in a new temporary file and what was written before is re-encoded on commit.
+# Lines only known at the end (the .cv statements of --stream) are put before the
+# others with writeHeader. Either way the parts are joined on commit in one copy,
+# a chunk at a time; output needing neither is never copied.
+class AtomicLineWriter:
+    bufferSize = 1 << 16
+
+    def __init__(self, fn, encoding="utf_8"):
+        self.fn = fn
+        self.encoding = encoding
+        self.lineCount = 0
+        self.header = []
+        self.parts = [] # (tempName, encoding) of what was written before switching to UTF-8
+        self.f = None
+        self.tempName = None
+
+    def __enter__(self):
+        self.f, self.tempName = self.openTemp(self.encoding)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+    def openTemp(self, encoding):
+        import tempfile
+
+        d, name = os.path.split(os.path.abspath(self.fn))
+        fd, tempName = tempfile.mkstemp(prefix=".{}.".format(name), suffix=".tmp", dir=d)
+        return open(fd, 'w', encoding=encoding, buffering=self.bufferSize), tempName
+
+    def write(self, line):
+        if self.lineCount > 0:
+            line = "\n" + line
+        try:
+            self.f.write(line)
+        except UnicodeEncodeError:
+            self.switchToUTF8()
+            self.f.write(line)
+        self.lineCount += 1
+
+    def writeLines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def writeHeader(self, lines):
+        self.header.extend(lines)
+
+    # Continue in UTF-8 in a new temporary file, see join
+    def switchToUTF8(self):
+        logging.info("Output contains characters that cannot be encoded as {}, saving as UTF-8".format(self.encoding))
+        self.f.close()
+        self.parts.append((self.tempName, self.encoding))
+        self.encoding = "utf_8"
+        self.f, self.tempName = self.openTemp(self.encoding)
+
+    # Copy the header and every part written, in the encoding of the last part
+    # (UTF-8 if the header needs it), to a new temporary file
+    def join(self):
+        import shutil
+
+        headerText = "\n".join(self.header)
+        if self.header and self.lineCount > 0:
+            headerText += "\n"
+        encoding = self.encoding
+        try:
+            headerText.encode(encoding)
+        except UnicodeEncodeError:
+            logging.info("Output contains characters that cannot be encoded as {}, saving as UTF-8".format(encoding))
+            encoding = "utf_8"
+
+        self.f.close()
+        parts = self.parts + [(self.tempName, self.encoding)]
+        out, tempName = self.openTemp(encoding)
+        try:
+            with out:
+                out.write(headerText)
+                for partName, partEncoding in parts:
+                    with open(partName, 'r', encoding=partEncoding) as f:
+                        shutil.copyfileobj(f, out, self.bufferSize)
+        except BaseException:
+            os.remove(tempName)
+            raise
+
+        for partName, partEncoding in parts:
+            os.remove(partName)
+        self.parts = []
+        self.header = []
+        self.tempName = tempName
+        self.encoding = encoding
+        self.f = open(self.tempName, 'a', encoding=self.encoding)
+
+    def commit(self):
+        import stat
+
+        if self.header or self.parts:
+            self.join()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+        # mkstemp creates the file private, give it the permissions a plain open() would have
+        if os.path.exists(self.fn):
+            mode = stat.S_IMODE(os.stat(self.fn).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(self.tempName, mode)
+
+        os.replace(self.tempName, self.fn)
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.tempName)
+        for partName, partEncoding in self.parts:
+            os.remove(partName)
 
 
 def createOutputFileName(infile):
@@ -1376,13 +2496,16 @@ def createOutputFileName(infile):
     outfile = "{}-out.txt".format(infile.split('.')[0])
     return outfile
 
-def stripFootnoteMarkup(inBuf):
+def stripFootnoteMarkup(inBuf, edits=None):
     outBuf = []
     lineNum = 0
+    if edits is None:
+        edits = LineEdits()
 
     while lineNum < len(inBuf):
         # copy inBuf to outBuf throwing away all footnote markup [Footnote...]
         if re.match(r"\*?\[Footnote", inBuf[lineNum]):
+            startLine = lineNum
             bracketLevel = 0
             done = False
             while lineNum < len(inBuf)-1 and not done:
@@ -1399,6 +2522,7 @@ def stripFootnoteMarkup(inBuf):
                     lineNum += 1
                 else:
                     lineNum += 1
+            edits.delete(startLine, lineNum-startLine)
         else:
             outBuf.append(inBuf[lineNum])
             lineNum += 1
@@ -1406,10 +2530,12 @@ def stripFootnoteMarkup(inBuf):
     return outBuf
 
 
-def processSidenotes(inBuf, keepOriginal, keepBreaks):
+def processSidenotes(inBuf, keepOriginal, keepBreaks, edits=None):
     sidenotesCount = 0
     lineNum = 0
     outBuf = []
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Processing sidenotes")
     while lineNum < len(inBuf):
@@ -1435,8 +2561,10 @@ def processSidenotes(inBuf, keepOriginal, keepBreaks):
                 snText.append(line)
 
             # Need to relocate *[Sidenote
+            sources = [startLine]
             if inBuf[startLine][0] == '*':
                 outBuf.append("// *** DP2PPGEN: RELOCATE SIDENOTE")
+                sources.insert(0, None)
 
             # Ouput ppgen style sidenote
             if keepBreaks:
@@ -1445,6 +2573,7 @@ def processSidenotes(inBuf, keepOriginal, keepBreaks):
                 joinChar = ' '
             s = ".sn {}".format(joinChar.join(snText))
             outBuf.append(s)
+            edits.replace(startLine, endLine-startLine+1, sources)
             sidenotesCount += 1
             lineNum += 1
 
@@ -1463,6 +2592,7 @@ def parseFootnotes(inBuf):
 #   endLine - line number of last line of [Footnote] block
 #   fnBlock - list of lines containing full [Footnote:]
 #   fnText - list of lines containing footnote text
+#   fnLines - line number of inBuf each line of fnText is from
 #   paragraphEnd - line number of the blank line following the paragraph this footnote is located in
 #   chapterEnd - line number of the blank line following the last paragraph in the chapter this footnote is located in
 #   scanPageNumber - scan page this footnote is located on
@@ -1512,7 +2642,7 @@ def parseFootnotes(inBuf):
             joinToPrevious = fnBlock[0].startswith("*[Footnote")
             joinToNext = fnBlock[-1].endswith("]*")
             if joinToPrevious or joinToNext:
-                logging.debug("Footnote requires joining at line {}: {}".format(lineNum+1, inBuf[lineNum]))
+                logging.debug(LazyFormat("Footnote requires joining at line {}: {}", lineNum+1, inBuf[lineNum]))
                 foundFootnote = True
 
             # Find end of paragraph
@@ -1533,9 +2663,10 @@ def parseFootnotes(inBuf):
                 line = re.sub(r"^\[Footnote \d+: ?", "", line)
                 fnText.append(line)
             fnText[-1] = re.sub(r"][\*]*$", "", fnText[-1])
+            fnLines = list(range(startLine, endLine+1))
 
             # Add entry
-            footnotes.append({'fnBlock':fnBlock, 'fnText':fnText, 'fnID':fnID, 'startLine':startLine, 'endLine':endLine, 'paragraphEnd':paragraphEnd, 'chapterEnd':chapterEnd, 'joinToPrevious':joinToPrevious, 'joinToNext':joinToNext, 'scanPageNum':currentScanPage})
+            footnotes.append({'fnBlock':fnBlock, 'fnText':fnText, 'fnLines':fnLines, 'fnID':fnID, 'startLine':startLine, 'endLine':endLine, 'paragraphEnd':paragraphEnd, 'chapterEnd':chapterEnd, 'joinToPrevious':joinToPrevious, 'joinToNext':joinToNext, 'scanPageNum':currentScanPage})
 
         lineNum += 1
 
@@ -1543,11 +2674,12 @@ def parseFootnotes(inBuf):
 
     # Join footnotes marked above during parsing
     joinCount = 0
+    debug = isDebugEnabled()
     i = len(footnotes) - 1
     while i > 0:
         if footnotes[i]['joinToNext']:
-            logging.error("Unresolved join detected")
-            logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[i]['scanPageNum'], i, footnotes[i]['startLine']+1, footnotes[i]['fnBlock'][0]))
+            logging.error("Unresolved join detected", extra=diagnostic("footnote.unresolved-join", footnotes[i]['startLine'], footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0]))
+            logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[i]['scanPageNum'], i, footnotes[i]['startLine']+1, footnotes[i]['fnBlock'][0]), extra=diagnosticDetail)
 
         if footnotes[i]['joinToPrevious']:
             if joinCount == 0:
@@ -1560,26 +2692,27 @@ def parseFootnotes(inBuf):
                 toFn -= 1
 
             # debug message
-            logging.debug("Merging footnote [{}]".format(i+1))
-            if len(footnotes[toFn]['fnBlock']) > 1:
-                logging.debug("  ScanPg {}: {} ... {} ".format(footnotes[toFn]['scanPageNum'], footnotes[toFn]['fnBlock'][0], footnotes[toFn]['fnBlock'][-1]))
-            else:
-                logging.debug("  ScanPg {}: {}".format(footnotes[toFn]['scanPageNum'], footnotes[toFn]['fnBlock'][0]))
-            if len(footnotes[i]['fnBlock']) > 1:
-                logging.debug("  ScanPg {}: {} ... {} ".format(footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0], footnotes[i]['fnBlock'][-1]))
-            else:
-                logging.debug("  ScanPg {}: {}".format(footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0]))
+            if debug:
+                logging.debug("Merging footnote [{}]".format(i+1))
+                if len(footnotes[toFn]['fnBlock']) > 1:
+                    logging.debug("  ScanPg {}: {} ... {} ".format(footnotes[toFn]['scanPageNum'], footnotes[toFn]['fnBlock'][0], footnotes[toFn]['fnBlock'][-1]))
+                else:
+                    logging.debug("  ScanPg {}: {}".format(footnotes[toFn]['scanPageNum'], footnotes[toFn]['fnBlock'][0]))
+                if len(footnotes[i]['fnBlock']) > 1:
+                    logging.debug("  ScanPg {}: {} ... {} ".format(footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0], footnotes[i]['fnBlock'][-1]))
+                else:
+                    logging.debug("  ScanPg {}: {}".format(footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0]))
 
             if not footnotes[toFn]['joinToNext']:
-                logging.error("Attempt to join footnote failed!")
-                logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[toFn]['scanPageNum'], i+1, footnotes[toFn]['startLine']+1, footnotes[toFn]['fnBlock'][0]))
-                logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[i]['scanPageNum'], i, footnotes[i]['startLine']+1, footnotes[i]['fnBlock'][0]))
+                logging.error("Attempt to join footnote failed!", extra=diagnostic("footnote.join-failed", footnotes[i]['startLine'], footnotes[i]['scanPageNum'], footnotes[i]['fnBlock'][0]))
+                logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[toFn]['scanPageNum'], i+1, footnotes[toFn]['startLine']+1, footnotes[toFn]['fnBlock'][0]), extra=diagnosticDetail)
+                logging.error("ScanPg {} Footnote {} ({}): {}".format(footnotes[i]['scanPageNum'], i, footnotes[i]['startLine']+1, footnotes[i]['fnBlock'][0]), extra=diagnosticDetail)
             else:
                 # handle spanned hyphenation within spanned footnote
                 needsHyphenJoin = False
                 if re.search(r"(?<![-—])-\*?$", footnotes[toFn]['fnText'][-1]):
                     if footnotes[i]['fnText'][0][0] != '*':
-                        logging.error("Footnote {}: Unresolved hyphenation\n       {}\n       {}".format(toFn, footnotes[toFn]['fnText'][-1], footnotes[i]['fnText'][0][0]))
+                        logging.error("Footnote {}: Unresolved hyphenation\n       {}\n       {}".format(toFn, footnotes[toFn]['fnText'][-1], footnotes[i]['fnText'][0][0]), extra=diagnostic("footnote.unresolved-hyphenation", footnotes[toFn]['startLine'], footnotes[toFn]['scanPageNum'], footnotes[toFn]['fnText'][-1]))
                     else:
                         needsHyphenJoin = True
 
@@ -1591,6 +2724,7 @@ def parseFootnotes(inBuf):
                     else:
                         # Single word on from line, remove blank line
                         del footnotes[i]['fnText'][0]
+                        del footnotes[i]['fnLines'][0]
 
                     # Append it to toline
                     footnotes[toFn]['fnText'][-1] = footnotes[toFn]['fnText'][-1] + fromWord
@@ -1598,6 +2732,7 @@ def parseFootnotes(inBuf):
                 # merge fnBlock and fnText from second into first
                 footnotes[toFn]['fnBlock'].extend(footnotes[i]['fnBlock'])
                 footnotes[toFn]['fnText'].extend(footnotes[i]['fnText'])
+                footnotes[toFn]['fnLines'].extend(footnotes[i]['fnLines'])
                 footnotes[toFn]['joinToNext'] = False
                 del footnotes[i]
                 joinCount += 1
@@ -1614,6 +2749,8 @@ def parseFootnotes(inBuf):
 def processFootnoteAnchors(inBuf, footnotes, useAutoNumbering):
 
     outBuf = inBuf
+    debug = isDebugEnabled()
+    pageIndex = PageIndex(outBuf)
 
     # process footnote anchors
     fnUniqueAnchorCount = 0
@@ -1630,6 +2767,7 @@ def processFootnoteAnchors(inBuf, footnotes, useAutoNumbering):
         if isLinePageBreak(outBuf[lineNum]):
             anchorsThisPage = []
             currentScanPage = parseScanPage(inBuf[lineNum])
+            currentScanPageLabel = pageIndex.labelAt(lineNum) or ""
 
             # Make list of footnotes found on this page
             fnIDs = []
@@ -1647,7 +2785,7 @@ def processFootnoteAnchors(inBuf, footnotes, useAutoNumbering):
         for anchor in m:
             # Check that anchor found belongs to a footnote on this page
             if not anchor in fnIDs:
-                logging.error("No matching footnote for anchor [{}] on scan page {} (line {} in output file):\n       {}".format(anchor, currentScanPage, lineNum+1, outBuf[lineNum]))
+                logging.error("No matching footnote for anchor [{}] on scan page {} (line {} in output file):\n       {}".format(anchor, currentScanPage, lineNum+1, outBuf[lineNum]), extra=diagnostic("footnote.no-match", lineNum, currentScanPage, outBuf[lineNum], page=pageIndex.labelAt(lineNum)))
                 logging.debug(fnIDs)
 
             else:
@@ -1657,16 +2795,17 @@ def processFootnoteAnchors(inBuf, footnotes, useAutoNumbering):
                     fnUniqueAnchorCount += 1
                     anchorsThisPage.append(curAnchor)
                 elif useAutoNumbering:
-                    logging.error("Duplicate anchors ([{}]) detected ({}); ppgen autonumbering may not function correctly".format(anchor, currentScanPage))
+                    logging.error("Duplicate anchors ([{}]) detected ({}); ppgen autonumbering may not function correctly".format(anchor, currentScanPage), extra=diagnostic("footnote.duplicate-anchor", lineNum, currentScanPage, outBuf[lineNum], page=pageIndex.labelAt(lineNum)))
 
                 if useAutoNumbering:
                     newAnchor = "[#]"
                 else:
                     newAnchor = "[{}]".format(fnUniqueAnchorCount)
 
-                logging.debug("{:>5s}: ({}|{}) ... {} ...".format(newAnchor, lineNum+1, currentScanPageLabel, outBuf[lineNum]))
-                for line in footnotes[fnUniqueAnchorCount-1]['fnText']:
-                    logging.debug("       {}".format(line))
+                if debug:
+                    logging.debug("{:>5s}: ({}|{}) ... {} ...".format(newAnchor, lineNum+1, currentScanPageLabel, outBuf[lineNum]))
+                    for line in footnotes[fnUniqueAnchorCount-1]['fnText']:
+                        logging.debug("       {}".format(line))
 
                 # sanity check (anchor and footnote should be on same scan page)
                 if currentScanPage != footnotes[fnUniqueAnchorCount-1]['scanPageNum']:
@@ -1694,8 +2833,10 @@ def processFootnoteAnchors(inBuf, footnotes, useAutoNumbering):
     return outBuf, fnUniqueAnchorCount
 
 
-def processFootnotes(inBuf, footnoteDestination, keepOriginal, lzdestt, lzdesth, useAutoNumbering):
+def processFootnotes(inBuf, footnoteDestination, keepOriginal, lzdestt, lzdesth, useAutoNumbering, edits=None):
     outBuf = []
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Processing footnotes")
 
@@ -1705,38 +2846,53 @@ def processFootnotes(inBuf, footnoteDestination, keepOriginal, lzdestt, lzdesth,
     while lineNum < len(inBuf):
         if re.match(r"\*?\[Footnote", inBuf[lineNum]):
             # delete previous blank line(s)
+            removed = 0
             while isLineBlank(outBuf[-1]):
                 del outBuf[-1]
+                removed += 1
+            edits.delete(lineNum-removed, removed)
 
         outBuf.append(inBuf[lineNum])
         lineNum += 1
     inBuf = outBuf
+    edits.nextStep()
 
     # parse footnotes into list of dictionaries
     footnotes = parseFootnotes(outBuf)
 
-    outBuf = stripFootnoteMarkup(outBuf)
+    # The footnote text moves, so the markup generated for it is recorded in the
+    # same step as the [Footnote] blocks it comes from are removed
+    outBuf = stripFootnoteMarkup(outBuf, edits)
 
     # find and markup footnote anchors
     outBuf, fnUniqueAnchorCount = processFootnoteAnchors(outBuf, footnotes, useAutoNumbering)
 
     if len(footnotes) != fnUniqueAnchorCount:
-        logging.error("Footnote anchor count does not match footnote count")
+        logging.error("Footnote anchor count does not match footnote count", extra=diagnostic("footnote.count-mismatch"))
 
     if footnotes:
-        outBuf = generatePpgenFootnoteMarkup(outBuf, footnotes, footnoteDestination, lzdestt, lzdesth, useAutoNumbering)
+        outBuf = generatePpgenFootnoteMarkup(outBuf, footnotes, footnoteDestination, lzdestt, lzdesth, useAutoNumbering, edits, len(inBuf))
         if lzdestt or lzdesth:
-            outBuf = generateLandingZones(outBuf, footnotes, lzdestt, lzdesth)
+            edits.nextStep()
+            outBuf = generateLandingZones(outBuf, footnotes, lzdestt, lzdesth, edits)
 
     logging.info("Processed {} footnotes".format(len(footnotes)))
 
-    return outBuf
+    return outBuf, footnotes
 
 
-# Generate ppgen footnote markup
-def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt, lzdesth, useAutoNumbering):
+# Generate ppgen footnote markup. edits holds the removal of the [Footnote] blocks
+# from the lineCount lines they were parsed from, the markup is recorded as
+# inserted among those lines so the footnote text maps back to its block
+def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt, lzdesth, useAutoNumbering, edits=None, lineCount=None):
 
     outBuf = inBuf
+    if edits is None:
+        edits = LineEdits()
+    if lineCount is None:
+        lineCount = len(inBuf)
+    keptLines = edits.keptLines(lineCount)
+    inserted = {} # Position in inBuf -> sources of the lines inserted there
 
     logging.info("-- Generating footnote markup")
 
@@ -1763,13 +2919,17 @@ def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt,
         fnMarkup.append(".h2 id=footnotes nobreak")
         fnMarkup.append("FOOTNOTES:")
         fnMarkup.append(".sp 2")
+        sources = [None] * len(fnMarkup)
         for i, fn in enumerate(footnotes):
             fnMarkup.append(".fn {}  // {}".format(i+1, fn['scanPageNum']))
             for line in fn['fnText']:
                 fnMarkup.append(line)
             fnMarkup.append(".fn-")
+            sources.extend([None] + fn['fnLines'] + [None])
         fnMarkup.append(".dv-")
+        sources.append(None)
 
+        inserted[len(outBuf)] = sources
         outBuf.extend(fnMarkup)
 
     elif footnoteDestination == "chapterend":
@@ -1780,6 +2940,7 @@ def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt,
             if curChapterEnd != fn['chapterEnd']:
                 # finish off last group
                 outBuf.insert(curChapterEnd, fmText)
+                inserted[curChapterEnd] = [None] + inserted.get(curChapterEnd, [])
                 curChapterEnd = fn['chapterEnd']
 
             # build markup for this footnote
@@ -1796,8 +2957,10 @@ def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt,
 
             # insert it
             outBuf[curChapterEnd:curChapterEnd] = fnMarkup
+            inserted[curChapterEnd] = [None] + fn['fnLines'] + [None] + inserted.get(curChapterEnd, [])
 
         outBuf.insert(curChapterEnd, fmText)
+        inserted[curChapterEnd] = [None] + inserted.get(curChapterEnd, [])
 
     elif footnoteDestination == "paragraphend":
         logging.info("-- Adding ppgen style footnotes to end of paragraphs")
@@ -1806,6 +2969,7 @@ def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt,
 
             if curParagraphEnd != fn['paragraphEnd']:
                 outBuf.insert(curParagraphEnd, fmText)
+                inserted[curParagraphEnd] = [None] + inserted.get(curParagraphEnd, [])
                 curParagraphEnd = fn['paragraphEnd']
 
             # build markup for this footnote
@@ -1818,18 +2982,32 @@ def generatePpgenFootnoteMarkup(inBuf, footnotes, footnoteDestination, lzdestt,
 
             # insert it
             outBuf[curParagraphEnd:curParagraphEnd] = fnMarkup
+            inserted[curParagraphEnd] = [None] + fn['fnLines'] + [None] + inserted.get(curParagraphEnd, [])
 
         outBuf.insert(curParagraphEnd, fmText)
+        inserted[curParagraphEnd] = [None] + inserted.get(curParagraphEnd, [])
 
     else:
         logging.error("Unrecognized value for --fndest ({})".format(footnoteDestination))
 
+    # Footnotes are inserted from the last one back, so each position is still a
+    # position in inBuf as it was passed in
+    for pos, sources in inserted.items():
+        if pos < len(keptLines):
+            edits.replace(keptLines[pos], 0, sources)
+        else:
+            edits.replace(lineCount, 0, sources, lineCount-1)
+
     return outBuf
 
 
-def generateLandingZones(inBuf, footnotes, lzdestt, lzdesth):
+def generateLandingZones(inBuf, footnotes, lzdestt, lzdesth, edits=None):
 
     outBuf = inBuf
+    lineCount = len(inBuf)
+    appended = 0
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("-- Generating footnote landing zones (lzdestt={} lzdesth={})".format(lzdestt, lzdesth))
 
@@ -1864,6 +3042,7 @@ def generateLandingZones(inBuf, footnotes, lzdestt, lzdesth):
             fnMarkup.append(".if-")
 
         outBuf.extend(fnMarkup)
+        appended += len(fnMarkup)
 
     if lzdestt == "chapterend" or lzdesth == "chapterend":
         lzs = ""
@@ -1873,18 +3052,30 @@ def generateLandingZones(inBuf, footnotes, lzdestt, lzdesth):
             lzs += "h"
 
         nextChapterStart = findNextChapter(outBuf, 0)
+        insertedCount = 0
         while nextChapterStart:
             # Find end of chapter (line after last line of last paragraph)
             # Chapter headings must be marked in ppgen format (.h2)
             lastChapterEnd = findPreviousEmptyLine(outBuf, nextChapterStart)
             outBuf.insert(lastChapterEnd, ".fm lz={}".format(lzs))
+            # Chapters are found front to back, landing zones in the bookend
+            # markup above go with it
+            if lastChapterEnd - insertedCount < lineCount:
+                edits.insertBefore(lastChapterEnd - insertedCount)
+            else:
+                appended += 1
+            insertedCount += 1
             nextChapterStart = findNextChapter(outBuf, nextChapterStart+2)
 
+    edits.insertAfter(lineCount-1, appended)
+
     return outBuf
 
 
-def joinSpannedFormatting(inBuf, keepOriginal):
+def joinSpannedFormatting(inBuf, keepOriginal, edits=None):
     outBuf = []
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Joining spanned out-of-line formatting markup")
 
@@ -1915,16 +3106,19 @@ def joinSpannedFormatting(inBuf, keepOriginal):
             if ln < len(inBuf) and isLinePageBreak(inBuf[ln]):
                 outBlock.append(inBuf[ln])
                 ln += 1
-                while ln < len(inBuf)-1 and isLineBlank(inBuf[ln]) or re.match(r".pn", inBuf[ln]) or re.match(r"\/\/", inBuf[ln]):
+                while ln < len(inBuf)-1 and (isLineBlank(inBuf[ln]) or re.match(r".pn", inBuf[ln]) or re.match(r"\/\/", inBuf[ln])):
                     outBlock.append(inBuf[ln])
                     ln += 1
 
-                if re.match(joinEndLineRegex, inBuf[ln]) and (ln-1)-findPreviousNonEmptyLine(inBuf, ln-1) < 4:
+                if ln < len(inBuf) and re.match(joinEndLineRegex, inBuf[ln]) and (ln-1)-findPreviousNonEmptyLine(inBuf, ln-1) < 4:
                     for line in outBlock:
                         outBuf.append(line)
+                    # The closing and opening markers are dropped
+                    edits.delete(lineNum)
+                    edits.delete(ln)
                     joinWasMade = True
                     joinCount += 1
-                    logging.debug("Lines {}, {}: Joined spanned markup /{} {}/".format(lineNum+1, ln, m.group(1)[0], m.group(1)[0]))
+                    logging.debug(LazyFormat("Lines {}, {}: Joined spanned markup /{} {}/", lineNum+1, ln, m.group(1)[0], m.group(1)[0]))
                     lineNum = ln + 1
 
         if not joinWasMade:
@@ -1935,30 +3129,50 @@ def joinSpannedFormatting(inBuf, keepOriginal):
     return outBuf
 
 
-def buildImageDictionary():
+# Image dimensions by (path, size, mtime), kept for the life of the process so
+# repeated conversions (server mode) do not decode the same images again
+imageDimensionCache = LRUCache(4096)
+
+# imageDir is a folder or the images/ folder of a project zip (see ZipImageDir)
+def buildImageDictionary(imageDir="images"):
+    from PIL import Image
+
     # Build dictionary of image files in images/ directory
-    files = sorted(glob.glob("images/*"))
+    files = listImageFiles(imageDir)
 
     logging.info("--- Taking inventory of /image folder")
     images = {}
-    for f in files:
+    for fn, f in files:
         try:
-            img = Image.open(f)
-            img.load()
+            if isinstance(f, str):
+                st = os.stat(f)
+                cacheKey = (os.path.abspath(f), st.st_size, st.st_mtime)
+            else:
+                cacheKey = (os.path.abspath(imageDir.zipFile.filename), f.filename, f.file_size, f.CRC)
+            dimensions = imageDimensionCache.get(cacheKey)
+            if dimensions is None:
+                if isinstance(f, str):
+                    img = Image.open(f)
+                    img.load()
+                    dimensions = img.size
+                else:
+                    # Only the image header is read from the archive
+                    with imageDir.zipFile.open(f) as imageFile:
+                        dimensions = Image.open(imageFile).size
+                imageDimensionCache[cacheKey] = dimensions
         except IOError:
-            logging.warning("Error loading '{}' ... skipping".format(f))
+            logging.warning("Error loading '{}' ... skipping".format(f if isinstance(f, str) else f.filename), extra=diagnostic("illustration.load-failed", snippet=fn))
         except:
             raise
         else:
-            fn = os.path.basename(f)
             anchorID = idFromFilename(fn)
-            logging.debug("Found image id={} fn='{}' size={}".format(anchorID, fn, img.size))
+            logging.debug(LazyFormat("Found image id={} fn='{}' size={}", anchorID, fn, dimensions))
             scanPageNum = re.sub("[^0-9]", "", fn)
             key = idFromFilename(fn)
-            images[key] = ({'anchorID':anchorID, 'fileName':fn, 'scanPageNum':scanPageNum, 'dimensions':img.size, 'caption':"", 'usageCount':0 })
+            images[key] = ({'anchorID':anchorID, 'fileName':fn, 'scanPageNum':scanPageNum, 'dimensions':dimensions, 'caption':"", 'usageCount':0 })
 
             if not re.match(r"i_\d{3,4}[a-z]?\.", fn) and fn != "cover.jpg":
-                logging.warning("File '{}' does not match expected naming convention (i_001, i_001a)".format(fn))
+                logging.warning("File '{}' does not match expected naming convention (i_001, i_001a)".format(fn), extra=diagnostic("illustration.bad-filename", snippet=fn))
 
 #   print(images)
     logging.info("----- Found {} images".format(len(images)))
@@ -1966,6 +3180,29 @@ def buildImageDictionary():
     return images
 
 
+# The images/ folder of a project zip (see openZipProject), folder is the name its
+# entries start with in the open zipFile
+class ZipImageDir:
+    def __init__(self, zipFile, folder):
+        self.zipFile = zipFile
+        self.folder = folder
+
+
+# Returns (fileName, file) for the files in imageDir, with file a path or the
+# ZipInfo of the entry when imageDir is a ZipImageDir
+def listImageFiles(imageDir):
+    if isinstance(imageDir, str):
+        import glob
+        return [(os.path.basename(f), f) for f in sorted(glob.glob(os.path.join(imageDir, "*")))]
+
+    files = []
+    for info in imageDir.zipFile.infolist():
+        fn = info.filename[len(imageDir.folder):]
+        if info.filename.startswith(imageDir.folder) and fn and "/" not in fn:
+            files.append((fn, info))
+    return sorted(files, key=lambda e: e[0])
+
+
 def idFromFilename(fn):
     id = os.path.basename(fn) # strip to filename only
     id = os.path.splitext(id)[0] # strip off extension
@@ -1975,18 +3212,22 @@ def idFromPageNumber(pn):
     s =  'i_{}'.format(pn)
     return s
 
-def processIllustrations(inBuf):
+def processIllustrations(inBuf, imageDir="images", illustrations=None, edits=None):
     # Replace [Illustration: caption] markup with equivalent .il/.ca statements
     outBuf = []
     lineNum = 0
+    if edits is None:
+        edits = LineEdits()
     currentScanPage = 0
+    currentScanPageFile = None
     illustrationTagCount = 0
     asteriskIllustrationTagCount = 0
     #TODO use format() instead of +
 
     logging.info("-- Processing illustrations")
 
-    illustrations = buildImageDictionary()
+    if illustrations is None:
+        illustrations = buildImageDictionary(imageDir)
 
     logging.info("--- Converting [Illustration] tags")
     while lineNum < len(inBuf):
@@ -1994,11 +3235,13 @@ def processIllustrations(inBuf):
         pn = parseScanPage(inBuf[lineNum])
         if pn:
             currentScanPage = os.path.splitext(pn)[0]
+            currentScanPageFile = pn
 
         # Copy until next illustration block
         if re.match(r"\[Illustration", inBuf[lineNum]) or re.match(r"\*\[Illustration", inBuf[lineNum]):
             inBlock = []
             outBlock = []
+            blockStart = lineNum
 
             # *[Illustration:] tags need to be handled manually afterward (can't reposition before or illustration will change page location)
             ilNeedsRelocation = False
@@ -2043,7 +3286,7 @@ def processIllustrations(inBuf):
             if ilID is None and testID in illustrations:
                 ilID = testID
             elif ilID is None:
-                logging.error("No image file for illustration located on scan page {}".format(currentScanPage))
+                logging.error("No image file for illustration located on scan page {}".format(currentScanPage), extra=diagnostic("illustration.no-image", lineNum-len(inBlock), currentScanPageFile, inBuf[lineNum-len(inBlock)]))
 
             if ilNeedsRelocation:
                 outBlock.append("// *** DP2PPGEN *[Illustration] NEEDS RELOCATION ***")
@@ -2055,17 +3298,24 @@ def processIllustrations(inBuf):
                 illustrations[ilID]['usageCount'] += 1
             else:
                 outBlock.append(".il id={} fn={}.jpg alt=''".format(testID, testID))
+            # The .il statement stands for the [Illustration line
+            outSources = [None] * (len(outBlock)-1) + [blockStart]
 
             # Extract caption from illustration block
             captionBlock = []
-            for line in inBlock:
+            captionSources = []
+            for k, line in enumerate(inBlock):
                 if line == "]":
                     continue
+                captionSources.append(blockStart+k)
                 line = re.sub(r"^\*?\[Illustration: ?", "", line)
                 line = re.sub(r"^\*?\[Illustration", "", line)
                 line = re.sub(r"]$", "", line)
                 captionBlock.append(line)
 
+            if ilID in illustrations:
+                illustrations[ilID]['caption'] = "\n".join(captionBlock)
+
             # .ca SOUTHAMPTON BAR IN THE OLDEN TIME.
             if len(captionBlock) == 0 or (len(captionBlock) == 1 and captionBlock[0] == ""):
                 # No caption
@@ -2073,25 +3323,28 @@ def processIllustrations(inBuf):
             elif len(captionBlock) == 1:
                 # One line caption
                 outBlock.append(".ca " + captionBlock[0])
+                outSources.append(captionSources[0])
             else:
                 # Multiline caption
                 outBlock.append(".ca")
                 for line in captionBlock:
                     outBlock.append(line)
                 outBlock.append(".ca-")
+                outSources.extend([None] + captionSources + [None])
+            edits.replace(blockStart, len(inBlock), outSources)
 
             # Write out ppgen illustration block
             for line in outBlock:
                 outBuf.append(line)
 
-            logging.debug("{}: ScanPage {}: convert {}".format(str(lineNum+1), str(currentScanPage), str(inBlock)))
+            logging.debug(LazyFormat("{}: ScanPage {}: convert {}", lineNum+1, currentScanPage, inBlock))
         else:
             outBuf.append(inBuf[lineNum])
             lineNum += 1
 
     logging.info("--- Processed {} [Illustrations] tags".format(illustrationTagCount))
     if asteriskIllustrationTagCount > 0:
-        logging.warning("Found {} *[Illustrations] tags; ppgen .il/.ca statements have been generated, but relocation to paragraph break must be performed manually.".format(asteriskIllustrationTagCount))
+        logging.warning("Found {} *[Illustrations] tags; ppgen .il/.ca statements have been generated, but relocation to paragraph break must be performed manually.".format(asteriskIllustrationTagCount), extra=diagnostic("illustration.asterisk-tags"))
 
     return outBuf
 
@@ -2107,8 +3360,10 @@ def getLinesUntil(inBuf, startLineNum, endRegex, direction=1):
     return outBlock
 
 
-def joinSpannedHyphenations(inBuf, keepOriginal):
+def joinSpannedHyphenations(inBuf, keepOriginal, edits=None):
     outBuf = []
+    if edits is None:
+        edits = LineEdits()
 
     logging.info("Joining spanned hyphenations")
 
@@ -2148,7 +3403,10 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
 
     lineNum = 0
     joinCount = 0
-    nowrapLevel = 0
+    # Unclothed dashes are not reported inside no-wrap /* */ blocks
+    oolf = OOLFBlocks(inBuf)
+    # Lines are deleted from inBuf as it is worked through, the input line of each line left
+    inputLines = list(range(len(inBuf)))
     while lineNum < len(inBuf):
         needsJoin = False
         joinToLineNum = 0
@@ -2156,11 +3414,6 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
         solInlineMarkup = ""
         eolInlineMarkup = ""
 
-        if inBuf[lineNum].startswith("/*"):
-            nowrapLevel += 1
-        elif inBuf[lineNum].startswith("*/"):
-            nowrapLevel -= 1
-
         # spanned hyphenation
         #TODO skip multiline [] markup between spanned hyphenation
 
@@ -2171,15 +3424,17 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
                 #logging.debug("spanned hyphenation found: {}".format(inBuf[lineNum]))
                 joinToLineNum = lineNum
                 joinFromLineNum = findNextLineOfText(inBuf, lineNum+1)
-                m = re.match(r"\*?(<(i|b|sc|g|f)>)", inBuf[joinFromLineNum])
-                if m:
-                    solInlineMarkup = m.group(1)
-                if inBuf[joinFromLineNum][0] != '*' and not inBuf[joinFromLineNum].startswith("{}*".format(solInlineMarkup)):
-                    logging.error("Line {}: Unresolved hyphenation\n       {}\n       {}".format(lineNum+1, inBuf[joinToLineNum], inBuf[joinFromLineNum]))
-                else:
-                    needsJoin = True
+                # No text left to join with (end of book, or of the pages read so far with --stream)
+                if joinFromLineNum is not None:
+                    m = re.match(r"\*?(<(i|b|sc|g|f)>)", inBuf[joinFromLineNum])
+                    if m:
+                        solInlineMarkup = m.group(1)
+                    if inBuf[joinFromLineNum][0] != '*' and not inBuf[joinFromLineNum].startswith("{}*".format(solInlineMarkup)):
+                        logging.error("Line {}: Unresolved hyphenation\n       {}\n       {}".format(lineNum+1, inBuf[joinToLineNum], inBuf[joinFromLineNum]), extra=diagnostic("hyphenation.unresolved", lineNum, snippet=inBuf[joinToLineNum]))
+                    else:
+                        needsJoin = True
             elif not isDotCommand(inBuf[lineNum]) and not isLinePageBreak(inBuf[lineNum]):
-                logging.warning("Line {}: Unmarked end of line hyphenation\n         {}".format(lineNum+1, inBuf[lineNum]))
+                logging.warning("Line {}: Unmarked end of line hyphenation\n         {}".format(lineNum+1, inBuf[lineNum]), extra=diagnostic("hyphenation.unmarked", lineNum, snippet=inBuf[lineNum]))
 
         # em-dash / long dash end of last line
         if re.search(r"(?<![-—])(--|—)\*?$", inBuf[lineNum]) or re.search(r"(?<![-—])(----|——)\*?$", inBuf[lineNum]):
@@ -2187,9 +3442,9 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
                 #logging.debug("end of line emdash found: {}".format(inBuf[lineNum]))
                 joinToLineNum = lineNum
                 joinFromLineNum = findNextLineOfText(inBuf, lineNum+1)
-                needsJoin = True
-            elif nowrapLevel == 0 and not isNextOriginalLineBlank(inBuf, lineNum+1) and not isLinePageBreak(inBuf[lineNum]):
-                logging.warning("Line {}: Unclothed end of line dashes\n         {}".format(lineNum+1, inBuf[lineNum]))
+                needsJoin = joinFromLineNum is not None
+            elif oolf.nowrapDepths[lineNum] == 0 and not isNextOriginalLineBlank(inBuf, lineNum+1) and not isLinePageBreak(inBuf[lineNum]):
+                logging.warning("Line {}: Unclothed end of line dashes\n         {}".format(lineNum+1, inBuf[lineNum]), extra=diagnostic("dashes.unclothed-end", lineNum, snippet=inBuf[lineNum]))
 
         # em-dash / long dash start of first line
         if re.match(r"\*?(--|—)(?![-—])", inBuf[lineNum]) or re.match(r"\*?(----|——)(?![-—])", inBuf[lineNum]):
@@ -2198,8 +3453,8 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
                 joinToLineNum = findPreviousLineOfText(inBuf, lineNum-1)
                 joinFromLineNum = lineNum
                 needsJoin = True
-            elif nowrapLevel == 0 and not isPreviousOriginalLineBlank(inBuf, lineNum-1) and not isLinePageBreak(inBuf[lineNum]):
-                logging.warning("Line {}: Unclothed start of line dashes\n         {}".format(lineNum+1, inBuf[lineNum]))
+            elif oolf.nowrapDepths[lineNum] == 0 and not isPreviousOriginalLineBlank(inBuf, lineNum-1) and not isLinePageBreak(inBuf[lineNum]):
+                logging.warning("Line {}: Unclothed start of line dashes\n         {}".format(lineNum+1, inBuf[lineNum]), extra=diagnostic("dashes.unclothed-start", lineNum, snippet=inBuf[lineNum]))
 
         if needsJoin:
             #logging.debug("  joinToLineNum: {}".format(inBuf[joinToLineNum]))
@@ -2211,6 +3466,8 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
             else:
                 # Single word on from line, remove blank line
                 del inBuf[joinFromLineNum]
+                oolf.deleteLine(joinFromLineNum)
+                edits.delete(inputLines.pop(joinFromLineNum))
 
             # Append it to toline
             if joinToLineNum == lineNum:
@@ -2228,7 +3485,7 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
             inBuf[joinToLineNum] = inBuf[joinToLineNum].replace('-*{}*{}'.format(eolInlineMarkup, solInlineMarkup), '-**')
             inBuf[joinToLineNum] = inBuf[joinToLineNum].replace('-*{}{}*'.format(eolInlineMarkup, solInlineMarkup), '-**')
 
-            logging.debug("{}: Resolved hyphenation, ...{}".format(joinToLineNum+1, inBuf[joinToLineNum][-30:]))
+            logging.debug(LazyFormat("{}: Resolved hyphenation, ...{}", joinToLineNum+1, inBuf[joinToLineNum][-30:]))
             joinCount += 1
 
         outBuf.append(inBuf[lineNum])
@@ -2238,8 +3495,11 @@ def joinSpannedHyphenations(inBuf, keepOriginal):
     return outBuf
 
 
-def addBoilerplate(inBuf):
+def addBoilerplate(inBuf, edits=None):
     outBuf = inBuf
+    lineCount = len(inBuf)
+    if edits is None:
+        edits = LineEdits()
 
     headerBlock = []
     fn = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'header.txt')
@@ -2252,6 +3512,7 @@ def addBoilerplate(inBuf):
         logging.info("Couldn't load {}, skipping header boilerplate".format(fn))
 
     outBuf[0:0] = headerBlock
+    edits.insertBefore(0, len(headerBlock))
 
     footerBlock = []
     fn = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'footer.txt')
@@ -2264,54 +3525,128 @@ def addBoilerplate(inBuf):
         logging.info("Couldn't load {}, skipping footer boilerplate".format(fn))
 
     outBuf.extend(footerBlock)
+    edits.insertAfter(lineCount-1, len(footerBlock))
 
     return outBuf
 
 
-def tabsToSpaces(inBuf, tabSize):
-    outBuf = []
-
-    for line in inBuf:
-        spaces = " " * tabSize
-        line = line.replace("\t", spaces)
-        outBuf.append(line)
-
-    return outBuf
-
+# DP diacritic markup, [=o] for a mark above a letter and [o=] for one below (see
+# the DP proofreading guidelines), with the combining character of each mark
+dpDiacriticMarks = {
+    '=': ("\u0304", "\u0331"), # macron
+    ':': ("\u0308", "\u0324"), # diaeresis
+    '.': ("\u0307", "\u0323"), # dot
+    '`': ("\u0300", "\u0316"), # grave
+    "'": ("\u0301", "\u0317"), # acute
+    '^': ("\u0302", "\u032d"), # circumflex
+    'v': ("\u030c", "\u032c"), # caron
+    ')': ("\u0306", "\u032e"), # breve
+    '~': ("\u0303", "\u0330"), # tilde
+    '°': ("\u030a", "\u0325"), # ring
+    ',': (None, "\u0327"),       # cedilla
+}
 
-def convertUTF8(inBuf):
+dpLigatures = {"[oe]": "œ", "[OE]": "Œ", "[ae]": "æ", "[AE]": "Æ"}
+
+# DP markup to character for convertUTF8, built on first use. Only marks that
+# compose with their letter into a single character are listed, other markup is
+# left for the post-processor. [vi] is left alone too, it is far more often a
+# roman numeral than ǐ.
+@functools.lru_cache(maxsize=None)
+def getUTF8Table():
+    import string
+    import unicodedata
+
+    table = {}
+    for letter in string.ascii_letters:
+        for mark, (above, below) in dpDiacriticMarks.items():
+            for markup, combining in (("[{}{}]".format(mark, letter), above), ("[{}{}]".format(letter, mark), below)):
+                if combining:
+                    c = unicodedata.normalize("NFC", letter + combining)
+                    if len(c) == 1:
+                        table[markup] = c
+    del table["[vi]"]
+    table.update(dpLigatures)
+
+    return table
+
+# Lines at the start of a text that stay ahead of the .cv statements: ppgen
+# comments and the document settings (.dt title, .it, .nr, .de css, .sr)
+utf8HeaderRegex = re.compile(r"^(//|\.(dt|it|nr|de|sr|cv)\b)")
+
+# Everything convertUTF8 converts in one pass: -- and ---- (not longer or shorter
+# runs of dashes) and any two characters other than dashes in brackets, looked up
+# in the table
+utf8Regex = re.compile(r"(?<!-)(?:----|--)(?!-)|\[[^\[\]-]{2}\]")
+utf8MarkupRegex = re.compile(r"\[[^\[\]-]{2}\]")
+
+# cvs, if given, collects the .cv statements needed instead of adding them to the
+# start of the buffer (--stream converts a page at a time, see cvStatements)
+def convertUTF8(inBuf, cvs=None, edits=None):
     outBuf = []
     lineCount = 0
+    debug = isDebugEnabled()
+    table = getUTF8Table()
+    addCvs = cvs is None
+    if addCvs:
+        cvs = {}
+    if edits is None:
+        edits = LineEdits()
+
+    def convert(m):
+        s = m.group()
+        if s[0] == "-":
+            # -- becomes a unicode mdash, ---- becomes 2 unicode mdashes
+            return "—" * (len(s) // 2)
+        c = table.get(s, s)
+        # Characters outside Latin-1 need a .cv for the Latin-1 text output
+        if ord(c[0]) > 255 and s not in dpLigatures:
+            cvs.setdefault(c, s)
+        return c
 
     logging.info("Converting characters to UTF-8")
 
     for i, line in enumerate(inBuf):
         originalLine = line
-        if not isLinePageBreak(line):
-            # -- becomes a unicode mdash, ---- becomes 2 unicode mdashes
-            line = re.sub(r"(?<!-)-{2}(?!-)", "—", line)
-            line = re.sub(r"(?<!-)-{4}(?!-)", "——", line)
+        if line.startswith(pageBreakPrefixes) and isLinePageBreak(line):
+            # [oe] becomes œ, [:a] becomes ä ...
+            line = utf8MarkupRegex.sub(convert, line)
+        else:
+            line = utf8Regex.sub(convert, line)
             if "--" in line:
-                logging.warn("Unconverted dashes: {}".format(line))
-
-        # [oe] becomes œ
-        # [OE] becomes Œ
-        line = line.replace("[oe]", "œ")
-        line = line.replace("[OE]", "Œ")
+                logging.warning("Unconverted dashes: {}".format(line), extra=diagnostic("utf8.unconverted-dashes", i, snippet=line))
 
         if line != originalLine:
             lineCount += 1
-            logging.debug("{}: {}".format(i, originalLine))
-            logging.debug("{}{}".format(" "*(len(str(i))+2), line))
+            if debug:
+                logging.debug("{}: {}".format(i, originalLine))
+                logging.debug("{}{}".format(" "*(len(str(i))+2), line))
 
         outBuf.append(line)
 
         # Fractions?
 
+    if addCvs:
+        cvLines = cvStatements(cvs)
+        headerLines = 0
+        while headerLines < len(outBuf) and utf8HeaderRegex.match(outBuf[headerLines]):
+            headerLines += 1
+        outBuf[headerLines:headerLines] = cvLines
+        edits.insertBefore(headerLines, len(cvLines))
+
     logging.info("Converted characters on {} lines to UTF-8".format(lineCount))
     return outBuf
 
 
+# .cv statements for the characters convertUTF8 collected in cvs
+def cvStatements(cvs):
+    if not cvs:
+        return []
+
+    logging.info("Adding {} .cv statements for characters outside Latin-1".format(len(cvs)))
+    return [".cv {} {}".format(c, markup) for c, markup in sorted(cvs.items(), key=lambda cv: cv[1])]
+
+
 def convertThoughtBreaks(inBuf):
     outBuf = []
 
@@ -2323,209 +3658,131 @@ def convertThoughtBreaks(inBuf):
     return outBuf
 
 
-def removeBlankLinesAtPageEnds(inBuf):
+# Fixup rules, (name, on by default, blocks skipped, pattern, replacement), in the
+# order they are tried. Blocks skipped are the out-of-line blocks a rule leaves
+# alone, "*" for /* */ and "#" for /# #/. Patterns use lookarounds rather than
+# groups so all enabled rules can be matched by one combined regex; where two
+# rules match at the same place the one listed first wins. The rules that are off
+# by default are the guiguts fixup set, they can be turned on (or the others off)
+# with a "fixupRules" object in the --config file, defaults.json lists them all:
+#   "fixupRules": {"spacesBeforePunctuation": true, "tabsToSpaces": false}
+fixupRules = [
+    # Line of 4 or more asterisks and whitespace to .tb
+    ("asteriskThoughtBreaks",   False, "*#", r"^[ \t]*(?:\*[ \t]*){4,}$", ".tb"),
+    # <tb> to .tb
+    ("thoughtBreaks",           True,  "",   r"^<tb>(?=[ \t]*$)", ".tb"),
+    # Remove spaces and tabs at end of line
+    ("trailingSpaces",          True,  "",   r"[ \t]+$", ""),
+    # Tabs to 4 spaces
+    ("tabsToSpaces",            True,  "",   r"\t", "    "),
+    # Remove spaces before a hyphen (unless it starts the line, like poetry) and after
+    # one, except after a run of 3 or more
+    ("spacesAroundHyphens",     False, "*#", r"(?<=\S) +(?=-)|(?<=-)(?<!---) +", ""),
+    # Leave a space after a run of 3 or more hyphens
+    ("spaceAfterLongDashes",    False, "*#", r'(?<=---)(?=[^\s\\"F-])', " "),
+    # Remove space before . ! ? ; : and , (unless first on line, like poetry's ellipses)
+    ("spacesBeforePunctuation", False, "*#", r"(?<=\S) +(?=\.(?![\d.])|[!?;:,])", ""),
+    # Remove space after a double quote starting the line and before one ending it
+    ("spacesInsideQuotes",      False, "*#", r'(?<=^") +| +(?="$)', ""),
+    # Remove space after opening and before closing brackets
+    ("spacesInsideBrackets",    False, "*#", r"(?<=[(\[{]) +| +(?=[)\]}])", ""),
+    # Space before ellipses except after a period (or ! and ?)
+    ("spaceBeforeEllipses",     False, "*#", r"(?<=[^\s.!?])(?=\.\.\.(?!\.))", " "),
+    # Remove space after « and before » (french)
+    ("frenchGuillemets",        False, "*#", r"(?<=«)\s+|\s+(?=»)", ""),
+    # Remove space before « and after » (german)
+    ("germanGuillemets",        False, "*#", r"\s+(?=«)|(?<=»)\s+", ""),
+    # Multiple spaces between words to one
+    ("multipleSpaces",          False, "*",  r"(?<=\S) {2,}(?=\S)", " "),
+    # Obvious l<-->1 problems, llth and lst
+    ("llth",                    False, "*#", r"llth", "11th"),
+    ("lst",                     False, "*#", r"(?<![^\s\d])lst", "1st"),
+    # Remove blank lines at the end of pages, applied to whole lines
+    ("blankLinesAtPageEnds",    True,  "",   None, None),
+]
+
+outOfLineFlags = {"*": 1, "#": 2}
+
+# Flags of the out-of-line blocks (see outOfLineFlags) each line is in, block
+# start and end lines count as inside the block (see OOLFBlocks)
+def outOfLineRegions(inBuf):
+    oolf = OOLFBlocks(inBuf)
+
+    return bytearray((nowrap > 0) * outOfLineFlags["*"] | (quote > 0) * outOfLineFlags["#"] for nowrap, quote in zip(oolf.nowrapDepths, oolf.quoteDepths))
+
+
+# Enabled fixup rules for the "fixupRules" settings from --config
+def enabledFixupRules(settings=None):
+    settings = settings or {}
+    names = [rule[0] for rule in fixupRules]
+
+    for name in settings:
+        if name not in names:
+            logging.warning("Unknown fixup rule {}, expected one of {}".format(name, ", ".join(names)))
+
+    return [rule for rule in fixupRules if settings.get(rule[0], rule[1])]
+
+
+# Applies the enabled fixup rules to each line in a single combined pass, hits is
+# filled with the number of replacements made by each rule
+def fixup(inBuf, keepOriginal, settings=None, hits=None, edits=None):
     outBuf = []
+    debug = isDebugEnabled()
+    rules = enabledFixupRules(settings)
+    lineRules = [rule for rule in rules if rule[3]]
+    replacements = {name: replacement for name, _, _, _, replacement in lineRules}
+    removeBlankLines = "blankLinesAtPageEnds" in [rule[0] for rule in rules]
+    if hits is None:
+        hits = {}
+    if edits is None:
+        edits = LineEdits()
+    for name, *_ in rules:
+        hits[name] = 0
+
+    logging.info("Fixing up text")
+
+    # Only lines inside out-of-line blocks need their own regex, built once for each
+    # combination of blocks
+    regions = bytearray(len(inBuf))
+    if any(rule[2] for rule in lineRules):
+        regions = outOfLineRegions(inBuf)
+    masks = [sum(outOfLineFlags[c] for c in rule[2]) for rule in lineRules]
+    regexes = {}
+    for flags in set(regions):
+        patterns = ["(?P<{}>{})".format(rule[0], rule[3]) for rule, mask in zip(lineRules, masks) if not flags & mask]
+        regexes[flags] = re.compile("|".join(patterns)) if patterns else None
+
+    def replace(m):
+        hits[m.lastgroup] += 1
+        return replacements[m.lastgroup]
 
-    for line in inBuf:
-        if isLinePageBreak(line):
+    for i, line in enumerate(inBuf):
+        regex = regexes[regions[i]]
+        if regex:
+            originalLine = line
+            line = regex.sub(replace, line)
+            if debug and line != originalLine:
+                logging.debug("{}: {}".format(i, originalLine))
+                logging.debug("{}{}".format(" "*(len(str(i))+2), line))
+
+        if removeBlankLines and isLinePageBreak(line):
+            # The blank lines removed are the lines just before this one
+            removed = 0
             while outBuf and isLineBlank(outBuf[-1]):
                 outBuf.pop()
+                removed += 1
+            if removed:
+                edits.delete(i-removed, removed)
+                hits["blankLinesAtPageEnds"] += removed
 
         outBuf.append(line)
 
-    return outBuf
-
-
-# TODO: Make this a tool in itself?
-def fixup(inBuf, keepOriginal):
-#    • Remove spaces at end of line.
-#    • Remove blank lines at end of pages.
-#    • Remove spaces on either side of hyphens.
-#    • Remove space before periods.
-#    • Remove space before exclamation points.
-#    • Remove space before question marks.
-#    • Remove space before commas.
-#    • Remove space before semicolons.
-#    • Remove space before colons.
-#    • Remove space after opening and before closing brackets. () [] {}
-#    • Remove space after open angle quote and before close angle quote.
-#    • Remove space after beginning and before ending double quote.
-#    • Ensure space before ellipses except after period.
-#    • Format any line that contains only 5 *s and whitespace to be the standard 5 asterisk thought break.
-#    • Convert multiple space to single space.
-#    • Fix obvious l<-->1 problems.
-#    You can also specify whether to skip text inside the /* */ markers or not.
-
-
-    outBuf = inBuf
-
-    outBuf = tabsToSpaces(outBuf, 4)
-    outBuf = removeTrailingSpaces(outBuf)
-    outBuf = convertThoughtBreaks(outBuf)
-    outBuf = removeBlankLinesAtPageEnds(outBuf)
-#   outBuf = removeExtraSpaces(outBuf)
+    for name, count in hits.items():
+        if count:
+            logging.info("Fixup {}: {}".format(name, count))
 
     return outBuf
 
-#TODO: Full guiguts fixit seems error prone.. maybe only do safe defaults or break off into seperate tool with each setting configurable, does gutsweeper do this already?
-#def removeExtraSpaces(inBuf):
-#    • Remove spaces on either side of hyphens.
-#    • Remove space before periods.
-#    • Remove space before exclamation points.
-#    • Remove space before question marks.
-#    • Remove space before commas.
-#    • Remove space before semicolons.
-#    • Remove space before colons.
-#    • Remove space after opening and before closing brackets. () [] {}
-#    • Remove space after open angle quote and before close angle quote.
-#    • Remove space after beginning and before ending double quote.
-#    • Ensure space before ellipses except after period.
-#   rewrapLevel = 0
-#   for line in inBuf:
-#       # Detect when inside out-of-line formatting block /# #/ /* */
-#       if re.match(r"\/[\*\#]", inBuf[lineNum]):
-#           rewrapLevel += 1
-#       elif re.match(r"[\*\#]\/", inBuf[lineNum]):
-#           rewrapLevel -= 1
-#
-#       if rewrapLevel == 0:
-#           # Remove multiple spaces
-#           # $line =~ s/(?<=\S)\s\s+(?=\S)/
-#           line = re.sub(r"(?<=\S)\s\s+(?=\S)", "", line)
-#
-#           # Remove spaces on either side of hyphens.
-#           # Remove spaces before hyphen (only if hyphen isn't first on line, like poetry)
-#           # $line =~ s/(\S) +-/$1-/g;
-#           line = re.sub(r"(\S) +-", "\1-", line)
-#
-#           # Remove space after hyphen
-#           # $line =~ s/- /-/g;
-#           line = re.sub(r"- ", "-", line)
-#
-#           # Except leave a space after a string of three or more hyphens
-#           # $line =~ s/(?<![-])([-]*---)(?=[^\s\\"F-])/$1 /g
-#           line = re.sub(r'(?<!-)(-*---)(?=[^\s\\"F-])', "\1", line)
-#
-#       outBuf.append(line)
-#
-#   return outBuf
-#
-#               $edited++ if $line =~ s/- /-/g;    # Remove space after hyphen
-#               $edited++
-#                 if $line =~ s/(?<![-])([-]*---)(?=[^\s\\"F-])/$1 /g
-#               ; # Except leave a space after a string of three or more hyphens
-#
-#
-#
-#           if (${ $::lglobal{fixopt} }[1]) {
-#               ; # Remove spaces before hyphen (only if hyphen isn't first on line, like poetry)
-#               $edited++ if $line =~ s/(\S) +-/$1-/g;
-#               $edited++ if $line =~ s/- /-/g;    # Remove space after hyphen
-#               $edited++
-#                 if $line =~ s/(?<![-])([-]*---)(?=[^\s\\"F-])/$1 /g
-#               ; # Except leave a space after a string of three or more hyphens
-#           }
-#           if (${ $::lglobal{fixopt} }[3]) {
-#               ; # Remove space before periods (only if not first on line, like poetry's ellipses)
-#               $edited++ if $line =~ s/(\S) +\.(?=\D)/$1\./g;
-#           }
-#           ;     # Get rid of space before periods
-#           if (${ $::lglobal{fixopt} }[4]) {
-#               $edited++
-#                 if $line =~ s/ +!/!/g;
-#           }
-#           ;     # Get rid of space before exclamation points
-#           if (${ $::lglobal{fixopt} }[5]) {
-#               $edited++
-#                 if $line =~ s/ +\?/\?/g;
-#           }
-#           ;     # Get rid of space before question marks
-#           if (${ $::lglobal{fixopt} }[6]) {
-#               $edited++
-#                 if $line =~ s/ +\;/\;/g;
-#           }
-#           ;     # Get rid of space before semicolons
-#           if (${ $::lglobal{fixopt} }[7]) {
-#               $edited++
-#                 if $line =~ s/ +:/:/g;
-#           }
-#           ;     # Get rid of space before colons
-#           if (${ $::lglobal{fixopt} }[8]) {
-#               $edited++
-#                 if $line =~ s/ +, /, /g;
-#           }
-#           ;     # Get rid of space before commas
-#                 # FIXME way to go on managing quotes
-#           if (${ $::lglobal{fixopt} }[9]) {
-#               $edited++
-#                 if $line =~ s/^\" +/\"/
-#               ; # Remove space after doublequote if it is the first character on a line
-#               $edited++
-#                 if $line =~ s/ +\"$/\"/
-#               ; # Remove space before doublequote if it is the last character on a line
-#           }
-#           if (${ $::lglobal{fixopt} }[10]) {
-#               $edited++
-#                 if $line =~ s/(?<=(\(|\{|\[)) //g
-#               ;    # Get rid of space after opening brackets
-#               $edited++
-#                 if $line =~ s/ (?=(\)|\}|\]))//g
-#               ;    # Get rid of space before closing brackets
-#           }
-#           ;        # FIXME format to standard thought breaks - changed to <tb>
-#           if (${ $::lglobal{fixopt} }[11]) {
-#               $edited++
-#
-#          #                  if $line =~
-#          # s/^\s*(\*\s*){5}$/       \*       \*       \*       \*       \*\n/;
-#                 if $line =~ s/^\s*(\*\s*){4,}$/<tb>\n/;
-#           }
-#           $edited++ if ($line =~ s/ +$//);
-#           ;        # Fix llth, lst
-#           if (${ $::lglobal{fixopt} }[12]) {
-#               $edited++ if $line =~ s/llth/11th/g;
-#               $edited++ if $line =~ s/(?<=\d)lst/1st/g;
-#               $edited++ if $line =~ s/(?<=\s)lst/1st/g;
-#               $edited++ if $line =~ s/^lst/1st/;
-#           }
-#           ;        # format ellipses correctly
-#           if (${ $::lglobal{fixopt} }[13]) {
-#               $edited++ if $line =~ s/(?<![\.\!\?])\.{3}(?!\.)/ \.\.\./g;
-#               $edited++ if $line =~ s/^ \./\./;
-#           }
-#           ;        # format guillemets correctly
-#           ;        # french guillemets
-#           if (${ $::lglobal{fixopt} }[14] and ${ $::lglobal{fixopt} }[15]) {
-#               $edited++ if $line =~ s/«\s+/«/g;
-#               $edited++ if $line =~ s/\s+»/»/g;
-#           }
-#           ;        # german guillemets
-#           if (${ $::lglobal{fixopt} }[14] and !${ $::lglobal{fixopt} }[15])
-#           {
-#               $edited++ if $line =~ s/\s+«/«/g;
-#               $edited++ if $line =~ s/»\s+/»/g;
-#           }
-#           $update++ if (($index % 250) == 0);
-#           $textwindow->see($index) if ($edited || $update);
-#           if ($edited) {
-#               $textwindow->replacewith($lastindex, $index, $line);
-#           }
-#       }
-#       $textwindow->markSet('insert', $index) if $update;
-#       $textwindow->update   if ($edited || $update);
-#       ::update_indicators() if ($edited || $update);
-#       $edited    = 0;
-#       $update    = 0;
-#       $lastindex = $index;
-#       $index++;
-#       $index .= '.0';
-#       if ($index > $end) { $index = $end }
-#       if ($::operationinterrupt) { $::operationinterrupt = 0; return }
-#   }
-#   $textwindow->markSet('insert', 'end');
-#   $textwindow->see('end');
-#   ::update_indicators();
-#}
 
 def doStandardConversions(inBuf, keepOriginal):
     outBuf = inBuf
@@ -2536,107 +3793,120 @@ def doStandardConversions(inBuf, keepOriginal):
     return outBuf
 
 
-def generateTransNote(inBuf):
-    outBuf = []
-    tnote = []
-
-    pageNumbers = calcPageNumbers(inBuf)
-#   print(pageNumbers)
-    lineNum = 0
-    currentPageNum = 0
-    currentScanPage = 0
-    isPageNumRoman = True
-
-    logging.info("-- Generating transcriber's note")
-    while lineNum < len(inBuf):
-        # Keep track of active scanpage
-        if isLinePageBreak(inBuf[lineNum]):
-            currentScanPage = parseScanPage(inBuf[lineNum])
-
-        # Look for proofers notes [**
-        m = re.search(r"\[\*\*([^\]]+)]", inBuf[lineNum])
-        if m:
-            #print("[{}] {}".format(pageNumbers[currentScanPage]['pageNum'], inBuf[lineNum]))
-            logging.info("[**note] found {}: {}".format(lineNum,m.group(0)))
-
-            if not pageNumbers:
-                logging.warning("Page number for proofers note could not be determined, add .pn statements and run again")
-                pageLabel = "???"
-            elif pageNumbers[currentScanPage]['isPageNumRoman']:
-                pageLabel = str(toRoman(pageNumbers[currentScanPage]['pageNum']))
-            else:
-                pageLabel = str(pageNumbers[currentScanPage]['pageNum'])
-
-            t = m.group(1).split('|')
-            if len(t) > 2: # sanity check
-                fatal("Error parsing proofer note [{}] {}".format(pageNumbers[currentScanPage]['pageNum'], m.group(0)))
-
-            beforeText = "{}".format(inBuf[lineNum][m.start(0)-20:m.start(0)])
-            afterText = "{}".format(inBuf[lineNum][m.end(0):m.end(0)+20])
-
+proofersNoteRegex = re.compile(r"\[\*\*([^\]]+)]")
+
+# Every proofers note [**...] of a buffer, in one pass, as a list of dicts with
+#   lineNum, start, end - where the note is in the buffer, end is the index after its ]
+#   text - the whole note, parts - what is inside split on | ([**old|new])
+#   label - label of the page it is on, None if there are no .pn statements yet
+#   beforeText, afterText - some words of the line on either side of it
+#   id - tnote_<lineNum>, with _<k> added for the k-th other note on the same line
+def indexProofersNotes(inBuf, pageIndex=None):
+    notes = []
+    labels = {}
+    if pageIndex is None:
+        pageIndex = PageIndex(inBuf)
+
+    for lineNum, line in enumerate(inBuf):
+        if "[**" not in line:
+            continue
+        page = pageIndex.pageOf(lineNum)
+        if page not in labels:
+            labels[page] = pageIndex.labelAt(lineNum)
+        for k, m in enumerate(proofersNoteRegex.finditer(line)):
+            # About 20 characters either side, cut back to whole words
+            beforeText = line[m.start(0)-20:m.start(0)]
+            afterText = line[m.end(0):m.end(0)+20]
             try:
                 beforeText = beforeText.split(' ', 1)[1]
-            except IndexError as e:
-                beforeText = "{}".format(inBuf[lineNum][:m.start(0)])
-
-            try:
-                afterText = afterText.rsplit(' ', 1)[0]
-            except IndexError as e:
-                afterText = "{}".format(inBuf[lineNum][m.end(0):])
-
-            #print(inBuf[lineNum])
-            if len(t) == 1: # Non-substitution type note, or unprocessed note
-                tnote.append("• #{}:Page_{}#".format(m.group(0), pageLabel))
-            else:
-                if t[0] == "":
-                    oldText = "{}{}{}".format(beforeText, t[0], afterText)
-                else:
-                    oldText = "{}<B>{}</B>{}".format(beforeText, t[0], afterText)
+            except IndexError:
+                beforeText = line[:m.start(0)]
+            afterText = afterText.rsplit(' ', 1)[0]
 
-                if t[1] == "":
-                    newText = "{}{}{}".format(beforeText, t[1], afterText)
-                else:
-                    newText = "{}<B>{}</B>{}".format(beforeText, t[1], afterText)
-
-                newText = "{}<B>{}</B>{}".format(beforeText, t[1], afterText)
-                tnote.append("#Page {}:tnote_{}#: {} → {}".format(pageLabel, lineNum, oldText, newText))
+            notes.append({'lineNum':lineNum, 'start':m.start(0), 'end':m.end(0), 'text':m.group(0), 'parts':m.group(1).split('|'),
+                          'label':labels[page], 'beforeText':beforeText, 'afterText':afterText,
+                          'id':"tnote_{}".format(lineNum) if k == 0 else "tnote_{}_{}".format(lineNum, k)})
 
-                inBuf[lineNum] = inBuf[lineNum].replace(m.group(0), "<span id='tnote_{}'>{}</span>".format(lineNum, t[1]))
+    return notes
 
-        outBuf.append(inBuf[lineNum])
-        lineNum += 1
 
-    outBuf.append("")
-    outBuf.append("// Transcriber’s note")
-    outBuf.append(".sp 4")
-    outBuf.append(".pb")
-    outBuf.append(".na")
-    outBuf.append(".ni")
-    outBuf.append(".de div.transnote { background-color: #eef; border: dashed 1px #aaa; color: black; padding: 1em; font-family: sans-serif, serif; }")
-    outBuf.append(".de div.transnote h2 { margin-top: 1em; }")
-    outBuf.append(".ma • *")
-    outBuf.append('.ma → "->"')
-    outBuf.append('.dv class="transnote"')
-    outBuf.append(".sp 2")
-    outBuf.append(".h2 nobreak //id=transnote")
-    outBuf.append("TRANSCRIBER’S NOTE:")
-    outBuf.append(".sp 2")
-    outBuf.append(".in 1")
-    outBuf.append("• Silently corrected obvious punctuation and capitalization errors.")
-    outBuf.append("")
-    outBuf.append("• Other changes:")
-    outBuf.append(".in +2")
-    outBuf.append(".nf l")
+# Changes inBuf in place, the notes are found by their place in it (see
+# indexProofersNotes) and the transcriber's note is added at its end
+def generateTransNote(inBuf, edits=None):
+    lineCount = len(inBuf)
+    tnote = []
+    if edits is None:
+        edits = LineEdits()
 
-    outBuf.extend(tnote)
+    logging.info("-- Calculating page numbers")
+    pageIndex = PageIndex(inBuf)
 
-    outBuf.append(".nf-")
-    outBuf.append(".in")
-    outBuf.append(".in")
-    outBuf.append(".dv-")
-    outBuf.append("")
+    logging.info("-- Generating transcriber's note")
+    notes = indexProofersNotes(inBuf, pageIndex)
+
+    # Substitution notes are replaced by a span the note links to, from the end of
+    # the line back so the earlier notes' positions still hold
+    for note in reversed(notes):
+        if len(note['parts']) == 2:
+            line = inBuf[note['lineNum']]
+            inBuf[note['lineNum']] = "{}<span id='{}'>{}</span>{}".format(line[:note['start']], note['id'], note['parts'][1], line[note['end']:])
+
+    for note in notes:
+        logging.info("[**note] found {}: {}".format(note['lineNum'], note['text']))
+
+        noteLabel = note['label']
+        if noteLabel is None:
+            logging.warning("Page number for proofers note could not be determined, add .pn statements and run again", extra=diagnostic("tnote.no-page-number", note['lineNum'], snippet=note['text']))
+            noteLabel = "???"
+
+        t = note['parts']
+        if len(t) > 2: # sanity check
+            fatal("Error parsing proofer note [{}] {}".format(noteLabel, note['text']))
+
+        beforeText = note['beforeText']
+        afterText = note['afterText']
+        if len(t) == 1: # Non-substitution type note, or unprocessed note
+            tnote.append("• #{}:Page_{}#".format(note['text'], noteLabel))
+        else:
+            if t[0] == "":
+                oldText = "{}{}{}".format(beforeText, t[0], afterText)
+            else:
+                oldText = "{}<B>{}</B>{}".format(beforeText, t[0], afterText)
+            newText = "{}<B>{}</B>{}".format(beforeText, t[1], afterText)
+            tnote.append("#Page {}:{}#: {} → {}".format(noteLabel, note['id'], oldText, newText))
+
+    inBuf.append("")
+    inBuf.append("// Transcriber’s note")
+    inBuf.append(".sp 4")
+    inBuf.append(".pb")
+    inBuf.append(".na")
+    inBuf.append(".ni")
+    inBuf.append(".de div.transnote { background-color: #eef; border: dashed 1px #aaa; color: black; padding: 1em; font-family: sans-serif, serif; }")
+    inBuf.append(".de div.transnote h2 { margin-top: 1em; }")
+    inBuf.append(".ma • *")
+    inBuf.append('.ma → "->"')
+    inBuf.append('.dv class="transnote"')
+    inBuf.append(".sp 2")
+    inBuf.append(".h2 nobreak //id=transnote")
+    inBuf.append("TRANSCRIBER’S NOTE:")
+    inBuf.append(".sp 2")
+    inBuf.append(".in 1")
+    inBuf.append("• Silently corrected obvious punctuation and capitalization errors.")
+    inBuf.append("")
+    inBuf.append("• Other changes:")
+    inBuf.append(".in +2")
+    inBuf.append(".nf l")
+
+    inBuf.extend(tnote)
+
+    inBuf.append(".nf-")
+    inBuf.append(".in")
+    inBuf.append(".in")
+    inBuf.append(".dv-")
+    inBuf.append("")
+    edits.insertAfter(lineCount-1, len(inBuf)-lineCount)
 
-    return outBuf
+    return inBuf
 
 
 def stripHtml(inBuf):
@@ -2677,41 +3947,82 @@ def fromRoman(s):
     return result
 
 
-def calcPageNumbers(inBuf):
-    pageNumbers = {}
-    lineNum = 0
-    currentPageNum = 0
-    currentScanPage = 0
-    isPageNumRoman = True
-
-    logging.info("-- Calculating page numbers")
-    while lineNum < len(inBuf):
-        # Keep track of page number
-        m = re.match(r".pn (.+)", inBuf[lineNum])
-        if m:
-            pn = "{}".format(m.group(1))
-            if pn[0] == '+':
-                d = int(pn[1:])
-                currentPageNum += d
-
-            elif pn[0] in [i[0][0] for i in romanNumeralMap]:
-                num = fromRoman(pn)
-                currentPageNum = int(num)
-                isPageNumRoman = True
-            else:
-                currentPageNum = int(pn)
-                isPageNumRoman = False
-
-#           print("[{}] {} {} {}".format(currentScanPage, currentPageNum, d, isPageNumRoman))
-            pageNumbers[currentScanPage] = ({'pageNum':currentPageNum, 'isPageNumRoman':isPageNumRoman })
+def pageLabel(pageNum, isPageNumRoman):
+    if isPageNumRoman:
+        return str(toRoman(pageNum))
+    return str(pageNum)
 
-        # Keep track of active scanpage
-        if isLinePageBreak(inBuf[lineNum]):
-            currentScanPage = parseScanPage(inBuf[lineNum])
 
-        lineNum += 1
+# Printed page numbers of a buffer: where each scan page starts and the page number
+# its .pn statements give it (the last one on the page), built in one pass. A page
+# without a .pn carries the number of the page before it. Lines before the first
+# page break are on scan page 0.
+#
+#   pageIndex = PageIndex(inBuf)
+#   pageIndex.labelAt(lineNum)    # "xii", "12", or None before any .pn
+class PageIndex:
+    def __init__(self, inBuf):
+        self.starts = [0]
+        self.scanPages = [0]
+        self.pageNums = [None] # (pageNum, isPageNumRoman) of each page
+        self.numberedFrom = None # First page given an absolute number by .pn
+
+        currentPageNum = 0
+        isPageNumRoman = True
+        for lineNum, line in enumerate(inBuf):
+            # Cheap tests first, only .pn statements and page breaks matter
+            if line[1:4] == "pn ":
+                m = re.match(r".pn (.+)", line)
+                if m:
+                    pn = m.group(1)
+                    if pn[0] == '+':
+                        currentPageNum += int(pn[1:])
+                    else:
+                        if pn[0] in [i[0][0] for i in romanNumeralMap]:
+                            currentPageNum = fromRoman(pn)
+                            isPageNumRoman = True
+                        else:
+                            currentPageNum = int(pn)
+                            isPageNumRoman = False
+                        if self.numberedFrom is None:
+                            self.numberedFrom = len(self.starts) - 1
+                    self.pageNums[-1] = (currentPageNum, isPageNumRoman)
+
+            elif line.startswith(pageBreakPrefixes) and isLinePageBreak(line):
+                self.starts.append(lineNum)
+                self.scanPages.append(parseScanPage(line))
+                self.pageNums.append(self.pageNums[-1])
+
+    # Index of the page lineNum is on
+    def pageOf(self, lineNum):
+        import bisect
+
+        return bisect.bisect_right(self.starts, lineNum) - 1
+
+    def scanPageAt(self, lineNum):
+        return self.scanPages[self.pageOf(lineNum)]
+
+    # (pageNum, isPageNumRoman) of the page lineNum is on, None before any .pn
+    def pageNumAt(self, lineNum):
+        return self.pageNums[self.pageOf(lineNum)]
+
+    def labelAt(self, lineNum):
+        pageNum = self.pageNumAt(lineNum)
+        if pageNum is None:
+            return None
+        return pageLabel(*pageNum)
+
+    # Labels of every page numbered from an absolute .pn on, the pages ppgen makes
+    # Page_ anchors for. Numbers counted (.pn +1) before that are only a guess.
+    def labels(self):
+        if self.numberedFrom is None:
+            return set()
+        return {pageLabel(*pageNum) for pageNum in self.pageNums[self.numberedFrom:] if pageNum is not None}
+
+    # (firstLine, scanPage) of each page break
+    def pageBreaks(self):
+        return list(zip(self.starts[1:], self.scanPages[1:]))
 
-    return pageNumbers
 
 def autoFixHyphens(inBuf):
     logging.info("-- Automatically fixing hyphenation issues")
@@ -2782,6 +4093,177 @@ def analyzeHyphenation(inBuf):
     return hyphenation
 
 
+# Character sequences OCR mistakes for one another, each way round
+scannoPairs = [("l", "1"), ("rn", "m"), ("cl", "d")]
+
+# Swaps to try at a character, by the first character of the text swapped
+scannoSwaps = {}
+for a, b in scannoPairs:
+    scannoSwaps.setdefault(a[0], []).append((a, b))
+    scannoSwaps.setdefault(b[0], []).append((b, a))
+
+# A variant must be used this many times more than the word to be a scanno, words
+# in the --wordlist count this many uses on top of those in the book
+scannoRatio = 10
+scannoWordlistCount = 10
+
+scannoWordRegex = re.compile(r"\w+(?:'\w+)*")
+
+# Word use counts as a trie of dicts, one level per character. A word's count is
+# kept under "" in its last node, and None is set there for words from the word
+# list. A lookup walks the length of the word only.
+class WordTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, word, count=1, known=False):
+        node = self.root
+        for c in word:
+            node = node.setdefault(c, {})
+        node[""] = node.get("", 0) + count
+        if known:
+            node[None] = True
+
+    def find(self, word):
+        node = self.root
+        for c in word:
+            node = node.get(c)
+            if node is None:
+                return None
+        return node
+
+    def count(self, word):
+        node = self.find(word)
+        return node.get("", 0) if node else 0
+
+    # Words in the trie that word becomes with up to maxSwaps scanno swaps, yields
+    # (swaps, count) where swaps is a tuple of (position, text, replacement). Only
+    # paths through the trie are followed, so this stays close to a plain lookup.
+    def variants(self, word, maxSwaps=2):
+        stack = [(self.root, 0, ())]
+        while stack:
+            node, i, swaps = stack.pop()
+            if i == len(word):
+                if swaps and node.get(""):
+                    yield swaps, node[""]
+                continue
+            child = node.get(word[i])
+            if child is not None:
+                stack.append((child, i+1, swaps))
+            if len(swaps) < maxSwaps:
+                for text, replacement in scannoSwaps.get(word[i], ()):
+                    if word.startswith(text, i):
+                        child = node
+                        for c in replacement:
+                            child = child.get(c)
+                            if child is None:
+                                break
+                        if child is not None:
+                            stack.append((child, i+len(text), swaps + ((i, text, replacement),)))
+
+
+# Apply swaps from WordTrie.variants to word, keeping the case of what is replaced
+def swapScanno(word, swaps):
+    for i, text, replacement in sorted(swaps, reverse=True):
+        original = word[i:i+len(text)]
+        if original.isupper() and len(original) > 1:
+            replacement = replacement.upper()
+        elif original[0].isupper():
+            replacement = replacement.capitalize()
+        word = word[:i] + replacement + word[i+len(text):]
+    return word
+
+
+# Word use counts of the book, plus the words of wordList (one per line) if given
+def buildWordTrie(wordCounts, wordList=None):
+    trie = WordTrie()
+    for word, count in wordCounts.items():
+        trie.add(word, count)
+
+    if wordList:
+        words, encoding = loadFile(wordList)
+        for word in words:
+            word = word.strip().lower()
+            if word:
+                trie.add(word, scannoWordlistCount, known=True)
+
+    return trie
+
+
+# Scannos among the book's words, {word: swaps} in lower case. A word is a scanno
+# when a variant (see WordTrie.variants) is used far more often, words with no
+# letters and words from the word list are left alone.
+def findScannos(trie, wordCounts):
+    scannos = {}
+
+    for word in wordCounts:
+        node = trie.find(word)
+        if len(word) < 2 or None in node or not any(c.isalpha() for c in word):
+            continue
+        best = max(trie.variants(word), key=lambda v: v[1], default=None)
+        if best and best[1] >= scannoRatio * node[""]:
+            scannos[word] = best[0]
+
+    return scannos
+
+
+# Report (mode "report") or fix (mode "fix") words that look like l/1, rn/m or cl/d
+# scannos of a word used far more often in the book or the word list
+def processScannos(inBuf, mode, wordList=None, keepOriginal=False, edits=None):
+    if mode not in ("report", "fix"):
+        fatal("Unknown --scannos mode {}, expected report or fix".format(mode))
+
+    logging.info("Checking for scannos")
+
+    isPageBreak = lambda line: line.startswith(pageBreakPrefixes) and isLinePageBreak(line)
+    text = "\n".join(line for line in inBuf if not isPageBreak(line)).lower()
+    wordCounts = collections.Counter(scannoWordRegex.findall(text))
+    trie = buildWordTrie(wordCounts, wordList)
+    scannos = findScannos(trie, wordCounts)
+    if not scannos:
+        logging.info("Found no scannos")
+        return inBuf
+
+    # Only the scannos are searched for, with the same word boundaries as scannoWordRegex
+    scannoRegex = re.compile(r"(?<!\w)(?<!\w')(?:{})(?!\w)(?!'\w)".format("|".join(re.escape(w) for w in sorted(scannos, key=len, reverse=True))), re.IGNORECASE)
+
+    def replace(m):
+        word = m.group()
+        swaps = scannos.get(word.lower())
+        if swaps is None or len(word) != len(word.lower()):
+            return word
+        return swapScanno(word, swaps)
+
+    outBuf = []
+    count = 0
+    if edits is None:
+        edits = LineEdits()
+    for lineNum, line in enumerate(inBuf):
+        if scannoRegex.search(line) and not isPageBreak(line):
+            newLine = scannoRegex.sub(replace, line)
+            if mode == "report":
+                for m in scannoRegex.finditer(line):
+                    word = m.group()
+                    variant = replace(m)
+                    if variant != word:
+                        logging.warning("Line {}: Possible scanno {} for {} ({} vs {} uses)\n       {}".format(lineNum+1, word, variant, trie.count(word.lower()), trie.count(variant.lower()), line), extra=diagnostic("scanno.suspect", lineNum, snippet=line))
+            elif newLine != line:
+                if keepOriginal:
+                    outBuf.append("// *** DP2PPGEN ORIGINAL: {}".format(line))
+                    edits.insertBefore(lineNum)
+                logging.debug(LazyFormat("{:>{:d}}: '{}' to '{}'", lineNum+1, len(str(len(inBuf))), line, newLine))
+                line = newLine
+                count += 1
+        outBuf.append(line)
+
+    if mode == "report":
+        logging.info("Found {} possible scannos".format(len(scannos)))
+    else:
+        logging.info("Fixed scannos on {} lines".format(count))
+
+    return outBuf
+
+
 def generateReport(inBuf,reportFormat):
 
     def parseOutline(inBuf):
@@ -2856,20 +4338,7 @@ def generateReport(inBuf,reportFormat):
 
 
 
-def main():
-    args = docopt(__doc__, version="dp2ppgen v{}".format(__version__))
-
-    # Process required command line arguments
-    outfile = createOutputFileName(args['<infile>'])
-    if args['<outfile>']:
-        outfile = args['<outfile>']
-
-    infile = args['<infile>']
-
-    # Open source file and represent as an array of lines
-    inBuf = loadFile(infile)
-
-    # Configure logging
+def configureLogging(args):
     logLevel = logging.INFO #default
     if args['--verbose']:
         logLevel = logging.DEBUG
@@ -2877,10 +4346,9 @@ def main():
         logLevel = logging.ERROR
 
     logging.basicConfig(format='%(levelname)s: %(message)s', level=logLevel)
-    logging.debug(args)
 
-    # Process processing options
 
+def resolveOptions(args):
     #TODO, load config file and use those options if one is present
     if args['--config']:
         args = mergeDict(args,loadJson(args['--config']))
@@ -2899,6 +4367,7 @@ def main():
         not args['--report'] and \
         not args['--tnote'] and \
         not args['--autofixhyphens'] and \
+        not args['--scannos'] and \
         not args['--joinspanned']:
 
         logging.info("No processing options were given, using default options from defaults.json\n      Run 'dp2ppgen -h' for a full list of options")
@@ -2906,82 +4375,1129 @@ def main():
         defaultConfig = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'defaults.json')
         args = mergeDict(args,loadJson(defaultConfig))
 
+    return args
+
+
+# Build a complete set of options from a list of command line flags (["--pages", "--utf8"])
+# or a dict of option values ({'--pages': True}); unset options take their command line defaults
+def parseOptions(options=None):
+    if options is None:
+        options = []
+
+    if isinstance(options, dict):
+        args = docopt(__doc__, argv=["-"], help=False)
+        unknown = [k for k in options if k.startswith("-") and k not in args]
+        if unknown:
+            raise ValueError("Unknown option(s): {}".format(", ".join(unknown)))
+        args.update(options)
+    else:
+        options = [str(o) for o in options]
+        try:
+            # "-" stands in for <infile>
+            args = docopt(__doc__, argv=options + ["-"], help=False)
+        except SystemExit:
+            raise ValueError("Invalid options: {}".format(" ".join(options)))
+
+    return args
+
+
+# Collects the warnings and errors logged during a conversion
+class LogCaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.captured = []
+
+    def emit(self, record):
+        self.captured.append((record.levelname, record.getMessage(), getattr(record, 'diagnostic', None)))
+
+    # Built when asked for, SourceMapLogFilter.finish adds output lines to the
+    # diagnostic fields once the conversion is done
+    @property
+    def records(self):
+        records = []
+        for level, message, fields in self.captured:
+            r = {'level':level, 'message':message}
+            if fields:
+                r.update(fields)
+            records.append(r)
+        return records
+
+
+# Applied while a stage runs on a window of pages in --stream mode. Progress messages
+# are dropped as every window would repeat them, "Line N" in warnings and errors is
+# made a line of the stage's whole input rather than of the window, the line the
+# stage would give run on the whole book, and messages already given for the
+# look-ahead pages of the previous window are not given again. pageStarts holds
+# (line in the window, line in the stage's input) of the start of each page of the
+# window, see streamStage.
+class StreamLogFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.pageStarts = [(0, 0)]
+        self.seen = set()
+        self.previouslySeen = set()
+
+    def nextWindow(self, pageStarts):
+        self.pageStarts = pageStarts
+        self.previouslySeen = self.seen
+        self.seen = set()
+
+    # 1-based line of the stage's input for line of the window
+    def inputLine(self, line):
+        import bisect
+
+        k = max(bisect.bisect_right(self.pageStarts, (line-1, float('inf'))) - 1, 0)
+        windowStart, inputStart = self.pageStarts[k]
+        return inputStart + line - windowStart
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return False
+
+        msg = record.getMessage()
+        m = re.match(r"Line (\d+)", msg)
+        if m:
+            msg = "Line {}{}".format(self.inputLine(int(m.group(1))), msg[m.end():])
+            record.msg = msg
+            record.args = None
+
+        fields = getattr(record, 'diagnostic', None)
+        if fields and 'line' in fields:
+            record.diagnostic = dict(fields, line=self.inputLine(fields['line']))
+
+        # Line numbers of the look-ahead pages shift when the stage joins lines, compare without them
+        key = re.sub(r"^Line \d+", "", msg)
+        self.seen.add(key)
+        return key not in self.previouslySeen
+
+
+# Conversions that need the whole book at once, these are skipped with --stream
+streamSkippedOptions = ['--chapters', '--sections', '--footnotes', '--autofixhyphens', '--detectmarkup', '--markup', '--boilerplate', '--tnote', '--report', '--sourcemap', '--scannos']
+
+# Runs stage (a function from a buffer of lines to a buffer of lines) over pages in
+# --stream mode. A stage with a window of n sees each page together with the n-1
+# pages that follow it, so it can join text across page breaks; those pages are
+# passed through it again when their turn comes, it must leave text it has already
+# converted unchanged.
+def streamStage(pages, stage, window=1):
+    logFilter = StreamLogFilter()
+    rootLogger = logging.getLogger()
+    inputOffset = 0
+    pending = []
+    pendingStarts = [] # Line of the stage's input each page of pending starts at
+
+    def run(pending):
+        pageStarts = []
+        windowLine = 0
+        for page, inputStart in zip(pending, pendingStarts):
+            pageStarts.append((windowLine, inputStart))
+            windowLine += len(page)
+        logFilter.nextWindow(pageStarts)
+        rootLogger.addFilter(logFilter)
+        try:
+            return list(iterPages(stage([line for page in pending for line in page])))
+        finally:
+            rootLogger.removeFilter(logFilter)
+
+    for page in pages:
+        pending.append(page)
+        pendingStarts.append(inputOffset)
+        inputOffset += len(page)
+        if len(pending) < window:
+            continue
+
+        outPages = run(pending)
+        done = max(len(outPages) - (window-1), 0)
+        for outPage in outPages[:done]:
+            yield outPage
+        # The look-ahead pages keep the input lines of the pages they were, the last
+        # ones if the stage changed the number of pages
+        pending = outPages[done:]
+        pendingStarts = pendingStarts[len(pendingStarts)-len(pending):]
+
+    if pending:
+        for outPage in run(pending):
+            yield outPage
+
+
+# Lines a stage inserted into or deleted from the buffer it was given, recorded as
+# it runs for the source map (see SourceMapBuilder). Line numbers are those of the
+# stage's input buffer, lines it kept (changed or not) are not recorded.
+#
+#   edits.insertBefore(lineNum, 2)              # two new lines in front of line lineNum
+#   edits.insertAfter(lineNum)                  # a new line after it
+#   edits.delete(lineNum, 3)                    # lines lineNum to lineNum+2 removed
+#   edits.replace(lineNum, 3, [None, lineNum])  # the same 3 lines replaced by 2
+#
+# replace is given the input line each new line was made from, or None for a line
+# the stage generated, which is traced to line anchor (lineNum unless given) but
+# not exactly. A stage that works through more than one buffer calls nextStep()
+# when it moves on to the next one, the edits after it are in that buffer's lines.
+class LineEdits:
+    def __init__(self):
+        self.steps = [[]]
+
+    def replace(self, lineNum, count, sources, anchor=None):
+        self.steps[-1].append((lineNum, count, sources, lineNum if anchor is None else anchor))
+
+    def insertBefore(self, lineNum, count=1):
+        self.replace(lineNum, 0, [None] * count)
+
+    def insertAfter(self, lineNum, count=1):
+        self.replace(lineNum+1, 0, [None] * count, lineNum)
+
+    def delete(self, lineNum, count=1):
+        self.replace(lineNum, count, [])
+
+    def nextStep(self):
+        self.steps.append([])
+
+    # Lines of the current step's input (of lineCount lines) that are still in its
+    # output, in order, for a stage going on to insert lines into the output
+    def keptLines(self, lineCount):
+        kept = []
+        pos = 0
+        for lineNum, count, sources, anchor in sorted(self.steps[-1], key=lambda edit: edit[0]):
+            kept.extend(range(pos, lineNum))
+            pos = max(pos, lineNum + count)
+        kept.extend(range(pos, lineCount))
+        return kept
+
+
+# The sources and exact flags (see SourceMapBuilder) of a buffer after one step of
+# edits (see LineEdits) to it
+def applyLineEdits(sources, exact, edits):
+    import array
+
+    if not edits:
+        return sources, exact
+
+    n = len(sources)
+    newSources = array.array('q')
+    newExact = bytearray()
+    pos = 0
+    for lineNum, count, lineSources, anchor in sorted(edits, key=lambda edit: (edit[0], edit[1] != 0)):
+        if lineNum > pos:
+            newSources.extend(sources[pos:lineNum])
+            newExact.extend(exact[pos:lineNum])
+        for source in lineSources:
+            isExact = source is not None
+            source = min(anchor if source is None else source, n-1)
+            if source < 0:
+                newSources.append(-1)
+                newExact.append(0)
+            else:
+                newSources.append(sources[source])
+                newExact.append(exact[source] if isExact else 0)
+        pos = max(pos, lineNum + count)
+    newSources.extend(sources[pos:])
+    newExact.extend(exact[pos:])
+
+    return newSources, newExact
+
+
+# Tracks the input line each line of the buffer came from while Converter.process
+# runs its stages (--sourcemap). Each stage records its edits in edits, update()
+# applies them once it has run. Lines of a book with no input (empty input) have
+# source -1. A line is exact when it is an input line, changed or not, and not one
+# a stage generated.
+class SourceMapBuilder:
+    def __init__(self, inBuf):
+        import array
+
+        self.sources = array.array('q', range(len(inBuf)))
+        self.exact = bytearray(b'\x01') * len(inBuf)
+        self.pageIndex = PageIndex(inBuf)
+        self.edits = LineEdits()
+
+    def update(self, buf):
+        for step in self.edits.steps:
+            self.sources, self.exact = applyLineEdits(self.sources, self.exact, step)
+        self.edits = LineEdits()
+
+        # A stage that did not record all of its edits
+        if len(self.sources) != len(buf):
+            logging.warning("Source map has {} lines for {} output lines, the lines after the stage's edits may map to the wrong input line".format(len(self.sources), len(buf)))
+            missing = len(buf) - len(self.sources)
+            if missing > 0:
+                self.sources.extend([self.sources[-1] if self.sources else -1] * missing)
+                self.exact.extend(bytes(missing))
+            else:
+                del self.sources[len(buf):]
+                del self.exact[len(buf):]
+
+    # Input line (0-based) of line lineNum of the current buffer
+    def inputLineOf(self, lineNum):
+        if 0 <= lineNum < len(self.sources):
+            return self.sources[lineNum]
+        return -1
+
+    # The map as written to <outfile>.map, lines are 1-based. lines holds runs of
+    # [outputLine, inputLine, count, exact]: an exact run maps its lines one to one,
+    # an inexact one was generated by a conversion and all its lines map to the input
+    # line it was generated for. pages holds [inputLine, scanPage] for each page break.
+    def toDict(self):
+        runs = []
+        sources, exact = self.sources, self.exact
+        for j in range(len(sources)):
+            if runs:
+                run = runs[-1]
+                if run[3] == exact[j] and sources[j] == run[1]-1 + (run[2] if exact[j] else 0):
+                    run[2] += 1
+                    continue
+            runs.append([j+1, sources[j]+1, 1, exact[j]])
+
+        for run in runs:
+            if run[1] == 0:
+                run[1] = None
+
+        return {'version':1, 'lines':runs, 'pages':[[lineNum+1, page] for lineNum, page in self.pageIndex.pageBreaks()]}
+
+
+# Resolves lines of a converted book to input lines and scan pages from a source
+# map (see SourceMapBuilder.toDict), each lookup is a binary search
+#
+#   sourceMap = loadSourceMap("book-src.txt.map")
+#   inputLine, scanPage, exact = sourceMap.resolve(120)
+class SourceMap:
+    def __init__(self, d):
+        self.runs = d['lines']
+        self.runStarts = [run[0] for run in self.runs]
+        self.pages = d['pages']
+        self.pageStarts = [page[0] for page in self.pages]
+
+    # Returns (inputLine, scanPage, exact) for 1-based outputLine, inputLine and
+    # scanPage are None where unknown
+    def resolve(self, outputLine):
+        import bisect
+
+        k = bisect.bisect_right(self.runStarts, outputLine) - 1
+        if k < 0 or outputLine >= self.runs[k][0] + self.runs[k][2]:
+            return None, None, False
+
+        start, inputLine, count, exact = self.runs[k]
+        if inputLine is None:
+            return None, None, False
+        if exact:
+            inputLine += outputLine - start
+
+        p = bisect.bisect_right(self.pageStarts, inputLine) - 1
+        scanPage = self.pages[p][1] if p >= 0 else None
+
+        return inputLine, scanPage, bool(exact)
+
+
+def loadSourceMap(fn):
+    return SourceMap(loadJson(fn))
+
+
+def writeSourceMap(sourceMap, fn):
+    import json
+
+    logging.info("Saving source map to '{}'".format(fn))
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(sourceMap, f, separators=(',', ':'))
+
+
+# Adds inputLine, and scanPage where missing, to diagnostics logged by a stage while
+# a source map is kept, their line is a line of the stage's input buffer. finish()
+# adds their outputLine once the last stage has run.
+class SourceMapLogFilter(logging.Filter):
+    def __init__(self, builder):
+        super().__init__()
+        self.builder = builder
+        self.diagnostics = []
+
+    def filter(self, record):
+        fields = getattr(record, 'diagnostic', None)
+        if fields and 'line' in fields:
+            fields = dict(fields)
+            if 'inputLine' not in fields:
+                inputLine = self.builder.inputLineOf(fields['line']-1)
+                if inputLine >= 0:
+                    fields['inputLine'] = inputLine+1
+            if 'inputLine' in fields and 'scanPage' not in fields:
+                scanPage = self.builder.pageIndex.scanPageAt(fields['inputLine']-1)
+                if scanPage:
+                    fields['scanPage'] = scanPage
+            if 'inputLine' in fields:
+                self.diagnostics.append(fields)
+            record.diagnostic = fields
+        return True
+
+    # The output line of a diagnostic is the first line made from its input line,
+    # one that maps to it exactly if there is one, or from the input lines after it
+    # if the line was removed
+    def finish(self):
+        import bisect
+
+        if not self.diagnostics:
+            return
+
+        sources, exact = self.builder.sources, self.builder.exact
+        exactLines = {}
+        outputLines = {}
+        for j, i in enumerate(sources):
+            if exact[j]:
+                exactLines.setdefault(i, j)
+            else:
+                outputLines.setdefault(i, j)
+        outputLines.update(exactLines)
+        inputLines = sorted(outputLines)
+
+        for fields in self.diagnostics:
+            k = bisect.bisect_left(inputLines, fields['inputLine']-1)
+            if k < len(inputLines):
+                fields['outputLine'] = outputLines[inputLines[k]]+1
+
+
+# Processes validating the markup of a book, only more than one when --jobs asks
+# for it, and none in batch mode as books are already converted in parallel there
+def validationJobs(args):
+    if args['--batch']:
+        return 1
+    if args['--jobs']:
+        return parseJobs(args['--jobs'])
+    return 1
+
+
+# Number of parallel processes given by --jobs
+def parseJobs(value):
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise ValueError("--jobs must be a whole number of 1 or more, not '{}'".format(value))
+    return jobs
+
+
+# In-process conversion of a buffer of lines, no file I/O is done
+#
+#   converter = Converter(["--pages", "--utf8"])
+#   outBuf, result = converter.convert(lines)
+#
+# options are command line flags or a dict of option values (see parseOptions).
+# A Converter can be reused for any number of conversions; image dimensions and
+# rendered tables are cached between them. fatal() errors raise ConversionError,
+# its result attribute holds the partial result.
+class Converter:
+    def __init__(self, options=None, imageDir="images"):
+        self.configure(resolveOptions(parseOptions(options)), imageDir)
+
+    # Build from a full set of arguments already passed through resolveOptions,
+    # as main and the batch workers have
+    @classmethod
+    def fromArgs(cls, args, imageDir="images"):
+        converter = cls.__new__(cls)
+        converter.configure(args, imageDir)
+        return converter
+
+    def configure(self, args, imageDir):
+        self.args = args
+        self.imageDir = imageDir
+        self.conversionCount = 0
+        self.cvs = {}
+
+    # Returns the converted lines and a result dictionary with
+    #   counts - input/output lines, markup errors, footnotes, illustrations, warnings, errors
+    #   warnings - list of {level, message} for every warning and error logged, plus
+    #              code, line, scanPage, snippet etc. where given (see diagnostic)
+    #   footnotes - list of {id, scanPageNum, startLine, text} for each converted footnote
+    #   illustrations - list of {id, fileName, dimensions, caption, usageCount} for each placed image
+    #   fixups - with --fixup, the number of replacements made by each fixup rule
+    #   sourceMap - with --sourcemap, the input line of every output line (see SourceMapBuilder.toDict)
+    #   seconds - time taken
+    def convert(self, lines):
+        # --compact holds the input packed, the steps read it through the LineBuffer.
+        # A MappedFile (--mmap) is read as it is, its lines are decoded as the first
+        # stage comes to them.
+        if self.args['--compact']:
+            if isinstance(lines, LineBuffer):
+                inBuf = packLines(lines, rstrip=True)
+            else:
+                inBuf = LineBuffer(line.rstrip() for line in lines)
+        elif isinstance(lines, MappedFile):
+            inBuf = lines
+        else:
+            inBuf = [line.rstrip() for line in lines]
+        result = {'counts':{}, 'warnings':[], 'footnotes':[], 'illustrations':[], 'seconds':0.0}
+
+        capture = LogCaptureHandler()
+        rootLogger = logging.getLogger()
+        rootLogger.addHandler(capture)
+        startTime = time.perf_counter()
+        try:
+            outBuf = self.process(inBuf, result)
+        except ConversionError as e:
+            # Let the caller see what was logged before the failure
+            e.result = result
+            raise
+        finally:
+            result['seconds'] = time.perf_counter() - startTime
+            rootLogger.removeHandler(capture)
+            result['warnings'] = capture.records
+            flushDiagnostics()
+
+        counts = result['counts']
+        counts['inputLines'] = len(inBuf)
+        counts['outputLines'] = len(outBuf)
+        counts['footnotes'] = len(result['footnotes'])
+        counts['illustrations'] = len(result['illustrations'])
+        counts['warnings'] = sum([1 for r in result['warnings'] if r['level'] == 'WARNING'])
+        counts['errors'] = len(result['warnings']) - counts['warnings']
+
+        self.conversionCount += 1
+
+        return outBuf, result
+
+    # Run all requested conversions over inBuf, returns the converted buffer
+    def process(self, inBuf, result):
+        args = self.args
+        outBuf = inBuf
+
+        # Diagnostics of markup handlers are given their line in the buffer (see
+        # BlockLineLogFilter) before anything else looks at them
+        rootLogger = logging.getLogger()
+        blockLines = BlockLineLogFilter()
+        rootLogger.addFilter(blockLines)
+
+        # Lines are traced back to the input for --sourcemap, diagnostics logged
+        # meanwhile are given their input line
+        sourceMap = None
+        if args['--sourcemap']:
+            sourceMap = SourceMapBuilder(inBuf)
+            logFilter = SourceMapLogFilter(sourceMap)
+            rootLogger.addFilter(logFilter)
+
+        try:
+            outBuf = self.runStages(inBuf, result, sourceMap, blockLines)
+        finally:
+            rootLogger.removeFilter(blockLines)
+            if sourceMap:
+                rootLogger.removeFilter(logFilter)
+                logFilter.finish()
+
+        if sourceMap:
+            result['sourceMap'] = sourceMap.toDict()
+
+        return outBuf
+
+    # The conversions of process(). With a source map each stage records its edits
+    # in edits() (see LineEdits), track is called with the buffer after it has run.
+    # blockLines is the BlockLineLogFilter process() has added to the root logger.
+    def runStages(self, inBuf, result, sourceMap=None, blockLines=None):
+        args = self.args
+        outBuf = inBuf
+        edits = lambda: sourceMap.edits if sourceMap else None
+        track = sourceMap.update if sourceMap else lambda buf: None
+
+        result['counts']['markupErrors'] = 0
+        if not args['--report']:
+            errorCount = validateDpMarkup(inBuf, validationJobs(args))
+            result['counts']['markupErrors'] = errorCount
+            if errorCount > 0 and not args['--force']:
+                fatal("Correct markup issues then re-run operation, or use --force to ignore markup errors")
+
+
+        outBuf = doStandardConversions(outBuf, args['--keeporiginal'])
+        track(outBuf)
+
+        if args['--pages']:
+            outBuf = processBlankPages(outBuf, args['--keeporiginal'], edits=edits())
+            track(outBuf)
+            outBuf = processPageNumbers(outBuf, args['--keeporiginal'], edits=edits())
+            track(outBuf)
+        if args['--fixup']:
+            result['fixups'] = {}
+            outBuf = fixup(outBuf, args['--keeporiginal'], args.get('fixupRules'), result['fixups'], edits=edits())
+            track(outBuf)
+        if args['--utf8']:
+            outBuf = convertUTF8(outBuf, edits=edits())
+            track(outBuf)
+        if args['--scannos']:
+            outBuf = processScannos(outBuf, args['--scannos'], args['--wordlist'], args['--keeporiginal'], edits=edits())
+            track(outBuf)
+        if args['--chapters'] or args['--sections']:
+            outBuf = processHeadings(outBuf, args['--chapters'], args['--sections'], args['--keeporiginal'], args['--chaptermaxlines'], args['--sectionmaxlines'], edits=edits())
+            track(outBuf)
+        if args['--sidenotes']:
+            outBuf = processSidenotes(outBuf, args['--keeporiginal'], args['--snkeepbreaks'], edits=edits())
+            track(outBuf)
+        if args['--illustrations']:
+            illustrations = buildImageDictionary(self.imageDir)
+            outBuf = processIllustrations(outBuf, self.imageDir, illustrations, edits=edits())
+            track(outBuf)
+            for key in sorted(illustrations):
+                il = illustrations[key]
+                if il['usageCount'] > 0:
+                    result['illustrations'].append({'id':key, 'fileName':il['fileName'], 'dimensions':il['dimensions'], 'caption':il['caption'], 'usageCount':il['usageCount']})
+        if args['--footnotes']:
+            # Set defaults
+            fndest = ""
+            lzdestt = ""
+            lzdesth = ""
+            if args['--fndest']:
+                fndest = args['--fndest']
+            else:
+                fndest = "paragraphend"
+                lzdestt = "chapterend"
+                lzdesth = "bookend"
+
+            if args['--lzdestt']:
+                lzdestt = args['--lzdestt']
+            if args['--lzdesth']:
+                lzdesth = args['--lzdesth']
+            fnautonum = False
+            if args['--fnautonum']:
+                fnautonum = True
+
+            outBuf, footnotes = processFootnotes(outBuf, fndest, args['--keeporiginal'], lzdestt, lzdesth, fnautonum, edits=edits())
+            track(outBuf)
+            for fn in footnotes:
+                result['footnotes'].append({'id':fn['fnID'], 'scanPageNum':fn['scanPageNum'], 'startLine':fn['startLine']+1, 'text':fn['fnText']})
+        if args['--joinspanned']:
+            outBuf = joinSpannedFormatting(outBuf, args['--keeporiginal'], edits=edits())
+            track(outBuf)
+            outBuf = joinSpannedHyphenations(outBuf, args['--keeporiginal'], edits=edits())
+            track(outBuf)
+        if args['--autofixhyphens']:
+            autoFixHyphens(outBuf)
+            track(outBuf)
+        if args['--detectmarkup']:
+            outBuf = detectMarkup(outBuf)
+            track(outBuf)
+        if args['--markup']:
+            outBuf = processOOLFMarkup(outBuf, args['--keeporiginal'], edits=edits(), blockLines=blockLines)
+            track(outBuf)
+
+        if args['--boilerplate']:
+            outBuf = addBoilerplate(outBuf, edits=edits())
+            track(outBuf)
+
+        if args['--tnote']:
+            outBuf = generateTransNote(outBuf, edits=edits())
+            track(outBuf)
+
+        if args['--report']:
+            generateReport(outBuf,args['--report'])
+
+        return outBuf
+
+    # Returns a generator converting lines a few pages at a time (--stream), only the
+    # page-local conversions are run, in the same order as process() runs them.
+    # Raises ConversionError once all lines have been read if markup errors were
+    # found and --force was not given. The .cv statements of --utf8 are not part of
+    # the lines, they are returned by streamHeader at the end.
+    def stream(self, lines):
+        args = self.args
+        keepOriginal = args['--keeporiginal']
+
+        skipped = [o for o in streamSkippedOptions if args[o]]
+        if skipped:
+            logging.warning("Skipping {} in streaming mode, these need the whole book at once".format(", ".join(skipped)))
+
+        # (stage, window) see streamStage, stages joining text across a page break need a window of 2
+        stages = [(lambda buf: doStandardConversions(buf, keepOriginal), 1)]
+        if args['--pages']:
+            stages.append((lambda buf: processPageNumbers(processBlankPages(buf, keepOriginal), keepOriginal), 1))
+        if args['--fixup']:
+            stages.append((lambda buf: fixup(buf, keepOriginal, args.get('fixupRules')), 2))
+        # .cv statements are collected over all pages, see streamHeader
+        self.cvs = {}
+        if args['--utf8']:
+            stages.append((lambda buf: convertUTF8(buf, self.cvs), 1))
+        if args['--sidenotes']:
+            stages.append((lambda buf: processSidenotes(buf, keepOriginal, args['--snkeepbreaks']), 1))
+        if args['--illustrations']:
+            illustrations = buildImageDictionary(self.imageDir)
+            stages.append((lambda buf: processIllustrations(buf, self.imageDir, illustrations), 1))
+        if args['--joinspanned']:
+            stages.append((lambda buf: joinSpannedFormatting(buf, keepOriginal), 2))
+            stages.append((lambda buf: joinSpannedHyphenations(buf, keepOriginal), 2))
+
+        return self.streamPages(lines, stages)
+
+    # Lines that go before those of the last stream(), known once all of them have
+    # been read: the .cv statements of --utf8
+    def streamHeader(self):
+        return cvStatements(self.cvs)
+
+    # Generator half of stream(), kept apart so options are checked when stream() is called
+    def streamPages(self, lines, stages):
+        validator = DpMarkupValidator()
+        logging.info("Checking input file for markup errors")
+
+        def validated(pages):
+            for page in pages:
+                validator.checkLines(page)
+                yield page
+
+        pages = validated(iterPages(line.rstrip() for line in lines))
+        for stage, window in stages:
+            pages = streamStage(pages, stage, window)
+
+        # Diagnostics are written a page at a time, --stream keeps no source map to
+        # give them an output line
+        pageCount = 0
+        for page in pages:
+            pageCount += 1
+            flushDiagnostics()
+            for line in page:
+                yield line
+
+        logging.info("Streamed {} pages".format(pageCount))
+        errorCount = validator.finish()
+        flushDiagnostics()
+        if errorCount > 0 and not self.args['--force']:
+            fatal("Correct markup issues then re-run operation, or use --force to ignore markup errors")
+
+
+def convertFile(infile, outfile, args, imageDir="images"):
+    if infile.lower().endswith(".zip"):
+        convertZipFile(infile, outfile, args)
+        return
+
+    if args['--stream']:
+        streamFile(infile, outfile, args, imageDir)
+        return
+
+    # Open source file and represent as an array of lines
+    if args['--mmap']:
+        inBuf, encoding = mapFile(infile)
+    else:
+        inBuf, encoding = loadFile(infile, args['--compact'])
+
     # Process source document
     logging.info("Processing '{}'".format(infile))
-    outBuf = inBuf
+    try:
+        outBuf, result = Converter.fromArgs(args, imageDir).convert(inBuf)
+    finally:
+        if isinstance(inBuf, MappedFile):
+            inBuf.close()
+
+    saveOutput(outBuf, outfile, encoding, args)
+    saveSourceMap(result, outfile, args)
+
+    return
 
-    if not args['--report']:
-        errorCount = validateDpMarkup(inBuf)
-        if errorCount > 0 and not args['--force']:
-            fatal("Correct markup issues then re-run operation, or use --force to ignore markup errors")
 
+# Like convertFile but reads, converts and writes a few pages at a time (--stream)
+def streamFile(infile, outfile, args, imageDir="images"):
+    if args['--mmap']:
+        inLines, encoding = mapFile(infile)
+    else:
+        encoding = detectFileEncoding(infile)
+        inLines = iterFileLines(infile, encoding)
+
+    logging.info("Processing '{}'".format(infile))
+    converter = Converter.fromArgs(args, imageDir)
+    outLines = converter.stream(inLines)
 
-    outBuf = doStandardConversions(outBuf, args['--keeporiginal'])
-
-    if args['--pages']:
-        outBuf = processBlankPages(outBuf, args['--keeporiginal'])
-        outBuf = processPageNumbers(outBuf, args['--keeporiginal'])
-    if args['--fixup']:
-        outBuf = fixup(outBuf, args['--keeporiginal'])
-    if args['--utf8']:
-        outBuf = convertUTF8(outBuf)
-    if args['--chapters'] or args['--sections']:
-        outBuf = processHeadings(outBuf, args['--chapters'], args['--sections'], args['--keeporiginal'], args['--chaptermaxlines'], args['--sectionmaxlines'])
-    if args['--sidenotes']:
-        outBuf = processSidenotes(outBuf, args['--keeporiginal'], args['--snkeepbreaks'])
-    if args['--illustrations']:
-        outBuf = processIllustrations(outBuf)
-    if args['--footnotes']:
-        # Set defaults
-        fndest = ""
-        lzdestt = ""
-        lzdesth = ""
-        if args['--fndest']:
-            fndest = args['--fndest']
+    try:
+        saveOutput(outLines, outfile, encoding, args, converter.streamHeader)
+    finally:
+        if isinstance(inLines, MappedFile):
+            inLines.close()
+
+
+# Finds the book in a DP project zip, the .txt file nearest the top of the archive
+# (the largest if there are several). Returns (zipFile, textName, imageDir) with
+# imageDir the ZipImageDir of the images/ folder beside the text.
+def openZipProject(fn):
+    import zipfile
+
+    if not os.path.isfile(fn):
+        fatal("File not found: {}".format(fn))
+
+    try:
+        zf = zipfile.ZipFile(fn)
+    except zipfile.BadZipFile as e:
+        fatal("Cannot read zip archive '{}': {}".format(fn, e))
+
+    texts = [i for i in zf.infolist() if not i.is_dir() and i.filename.lower().endswith(".txt")]
+    if not texts:
+        zf.close()
+        fatal("No text file found in '{}'".format(fn))
+
+    texts.sort(key=lambda i: (i.filename.count("/"), -i.file_size))
+    textName = texts[0].filename
+    if len(texts) > 1:
+        logging.info("Using '{}' of {} text files in '{}'".format(textName, len(texts), fn))
+
+    folder = textName.rpartition("/")[0]
+    imageDir = ZipImageDir(zf, "{}/images/".format(folder) if folder else "images/")
+
+    return zf, textName, imageDir
+
+
+# Like convertFile for a DP project zip, the text is read from the archive once and
+# image dimensions are read from its images/ entries, nothing is extracted
+def convertZipFile(infile, outfile, args):
+    zf, textName, imageDir = openZipProject(infile)
+    with zf:
+        inBuf, encoding = decodeText(zf.read(textName), args['--compact'])
+
+        logging.info("Processing '{}' in '{}'".format(textName, infile))
+        converter = Converter.fromArgs(args, imageDir)
+        header = None
+        if args['--stream']:
+            outLines = converter.stream(inBuf)
+            header = converter.streamHeader
         else:
-            fndest = "paragraphend"
-            lzdestt = "chapterend"
-            lzdesth = "bookend"
-
-        if args['--lzdestt']:
-            lzdestt = args['--lzdestt']
-        if args['--lzdesth']:
-            lzdesth = args['--lzdesth']
-        fnautonum = False
-        if args['--fnautonum']:
-            fnautonum = True
-
-        outBuf = processFootnotes(outBuf, fndest, args['--keeporiginal'], lzdestt, lzdesth, fnautonum)
-    if args['--joinspanned']:
-        outBuf = joinSpannedFormatting(outBuf, args['--keeporiginal'])
-        outBuf = joinSpannedHyphenations(outBuf, args['--keeporiginal'])
-    if args['--autofixhyphens']:
-        autoFixHyphens(outBuf)
-    if args['--detectmarkup']:
-        outBuf = detectMarkup(outBuf)
-    if args['--markup']:
-        outBuf = processOOLFMarkup(outBuf, args['--keeporiginal'])
-
-    if args['--boilerplate']:
-        outBuf = addBoilerplate(outBuf)
-
-    if args['--tnote']:
-        outBuf = generateTransNote(outBuf)
-
-    if args['--report']:
-        generateReport(outBuf,args['--report'])
-
-    if not args['--dryrun']:
+            outLines, result = converter.convert(inBuf)
+
+        saveOutput(outLines, outfile, encoding, args, header)
+        if not args['--stream']:
+            saveSourceMap(result, outfile, args)
+
+
+# Writes the converted lines to outfile unless --dryrun, the lines are still read
+# through with --dryrun as --stream converts as they are read. header, if given,
+# returns lines to put before them once they have all been read (see streamHeader).
+def saveOutput(outLines, outfile, encoding, args, header=None):
+    if args['--dryrun']:
+        for line in outLines:
+            pass
+    else:
         logging.info("Saving output to '{}'".format(outfile))
-        # Save file
-        f = open(outfile, 'w')
-        f.write('\n'.join(outBuf))
-        f.close()
+        # The output is discarded if the conversion fails part way through
+        with AtomicLineWriter(outfile, encoding) as w:
+            w.writeLines(outLines)
+            if header:
+                w.writeHeader(header())
+
+
+# Writes the source map of a conversion beside its output as <outfile>.map (--sourcemap)
+def saveSourceMap(result, outfile, args):
+    if args['--sourcemap'] and not args['--dryrun']:
+        writeSourceMap(result['sourceMap'], outfile + ".map")
+
+
+# Adds the name of the book being converted to log records in batch mode. A
+# default filter only names records that are not already named
+class BookLogFilter(logging.Filter):
+    def __init__(self, book, default=False):
+        super().__init__()
+        self.book = book
+        self.default = default
+
+    def filter(self, record):
+        if not self.default or not hasattr(record, 'book'):
+            record.book = self.book
+        return True
+
+
+# Convert one book of a batch, failures are reported in the result instead of ending the batch
+def convertBook(infile, outfile, args):
+    result = {'infile':infile, 'outfile':outfile, 'ok':False, 'error':"", 'seconds':0.0}
+
+    logFilter = BookLogFilter(infile)
+    handlers = logging.getLogger().handlers
+    for h in handlers:
+        h.addFilter(logFilter)
+
+    startTime = time.perf_counter()
+    try:
+        imageDir = os.path.join(os.path.dirname(infile), "images")
+        convertFile(infile, outfile, args, imageDir)
+        result['ok'] = True
+    except ConversionError as e:
+        result['error'] = str(e)
+    except Exception as e:
+        logging.exception("Unexpected error converting '{}'".format(infile))
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        result['seconds'] = time.perf_counter() - startTime
+        flushDiagnostics()
+        for h in handlers:
+            h.removeFilter(logFilter)
+
+    return result
+
+
+def configureBatchLogging(logLevel, diagnostics=None):
+    logging.basicConfig(format='%(levelname)s: [%(book)s] %(message)s', level=logLevel, force=True)
+    # Records logged outside a book, by the batch itself or by other libraries
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(BookLogFilter(__appname__, default=True))
+    if diagnostics:
+        logging.getLogger().addHandler(DiagnosticsHandler(diagnostics, 'a'))
+
+
+def loadManifest(fn):
+    import shlex
+
+    books = []
+    inBuf, encoding = loadFile(fn)
+    for line in inBuf:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        tokens = shlex.split(line)
+        infile = tokens[0]
+        outfile = createOutputFileName(infile)
+        if len(tokens) > 1:
+            outfile = tokens[1]
+        books.append((infile, outfile))
+
+    return books
+
+
+def batchConvert(books, args, jobs):
+    import concurrent.futures
+
+    logLevel = logging.getLogger().getEffectiveLevel()
+    diagnostics = args['--diagnostics']
+    if diagnostics:
+        open(diagnostics, 'w').close()
+    configureBatchLogging(logLevel, diagnostics)
+
+    logging.info("Converting {} books using {} worker(s)".format(len(books), jobs))
+
+    startTime = time.perf_counter()
+    results = []
+    if jobs == 1:
+        for infile, outfile in books:
+            results.append(convertBook(infile, outfile, args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=configureBatchLogging, initargs=(logLevel, diagnostics)) as executor:
+            futures = [executor.submit(convertBook, infile, outfile, args) for infile, outfile in books]
+            for future in futures:
+                results.append(future.result())
+    elapsed = time.perf_counter() - startTime
+
+    # Summary, the failures in it are not diagnostics of their own
+    w = max([len(r['infile']) for r in results] + [len('Book')])
+    logging.info('{:<{}}  {:<6}  {:>8}  {}'.format('Book', w, 'Status', 'Seconds', 'Output'))
+    logging.info('{:-<{}}'.format('', w+30))
+    for r in results:
+        if r['ok']:
+            logging.info('{:<{}}  {:<6}  {:>8.2f}  {}'.format(r['infile'], w, "ok", r['seconds'], r['outfile']))
+        else:
+            logging.error('{:<{}}  {:<6}  {:>8.2f}  {}'.format(r['infile'], w, "FAILED", r['seconds'], r['error']), extra=diagnosticDetail)
+    logging.info('{:-<{}}'.format('', w+30))
+
+    failCount = sum([1 for r in results if not r['ok']])
+    logging.log(logging.WARNING if failCount else logging.INFO, '{} converted, {} failed, {:.2f} seconds total ({:.2f} seconds of conversion work)'.format(len(results)-failCount, failCount, elapsed, sum([r['seconds'] for r in results])), extra=diagnosticDetail)
+
+    return failCount
+
+
+# Convert a server mode request in the form
+#   {"text": "...", "options": ["--pages", "--utf8"], "imageDir": "images"}
+# returns an HTTP status code and the response
+def convertRequest(request):
+    import shlex
+
+    response = {'ok':False, 'output':"", 'diagnostics':[], 'seconds':0.0}
+
+    text = request.get('text')
+    options = request.get('options', [])
+    if isinstance(options, str):
+        options = shlex.split(options)
+    if not isinstance(text, str) or not isinstance(options, list):
+        response['diagnostics'].append({'level':'ERROR', 'message':"Request needs 'text' (string) and optionally 'options' (list)"})
+        return 400, response
+
+    try:
+        converter = Converter(options, request.get('imageDir', "images"))
+    except ValueError as e:
+        response['diagnostics'].append({'level':'ERROR', 'message':str(e)})
+        return 400, response
+
+    inBuf = text.lstrip("\ufeff").split("\n")
+
+    status = 200
+    try:
+        outBuf, result = converter.convert(inBuf)
+        response['output'] = '\n'.join(outBuf)
+        response['ok'] = True
+        response['counts'] = result['counts']
+        if 'fixups' in result:
+            response['fixups'] = result['fixups']
+        if 'sourceMap' in result:
+            response['sourceMap'] = result['sourceMap']
+        response['seconds'] = result['seconds']
+        response['diagnostics'] = result['warnings']
+    except ConversionError as e:
+        status = 422
+        response['seconds'] = e.result['seconds']
+        response['diagnostics'] = e.result['warnings']
+    except Exception as e:
+        logging.exception("Unexpected error during conversion")
+        status = 500
+        response['diagnostics'].append({'level':'CRITICAL', 'message':"{}: {}".format(type(e).__name__, e)})
+
+    return status, response
+
+
+def isLoopbackHost(host):
+    import ipaddress
+
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.IPv4Address(host).is_loopback
+    except ValueError:
+        return False
+
+
+# Long running conversion server, address is a port, host:port or the path of a
+# Unix socket. TCP servers listen on the loopback interface only.
+def serve(address):
+    import http.server
+    import importlib
+    import json
+    import socketserver
+    import stat
+
+    # The conversion stages import these when they first need them, load them up
+    # front so the first request is not slower than the rest
+    for module in ("shlex", "subprocess", "tempfile", "glob", "PIL.Image"):
+        importlib.import_module(module)
+
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/version":
+                self.sendJson(200, {'version':__version__})
+            else:
+                self.sendJson(404, {'error':"Unknown path {}".format(self.path)})
+
+        def do_POST(self):
+            if self.path != "/convert":
+                self.sendJson(404, {'error':"Unknown path {}".format(self.path)})
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as e:
+                self.sendJson(400, {'error':"Invalid JSON request: {}".format(e)})
+                return
+            if not isinstance(request, dict):
+                self.sendJson(400, {'error':"Request must be a JSON object"})
+                return
+
+            logging.info("Converting {} characters".format(len(request.get('text') or "")))
+            status, response = convertRequest(request)
+            self.sendJson(status, response)
+
+        def sendJson(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("{} {}".format(self.address_string(), format % args))
+
+    class UnixHTTPServer(socketserver.UnixStreamServer):
+        def get_request(self):
+            request, clientAddress = super().get_request()
+            return request, ("local", 0)
+
+    socketPath = None
+    if "/" in address or address.endswith(".sock"):
+        socketPath = address
+        if os.path.exists(socketPath):
+            if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                fatal("Not a socket, refusing to replace: {}".format(socketPath))
+            os.remove(socketPath) # stale socket left by a previous server
+        server = UnixHTTPServer(socketPath, RequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        host = host or "localhost"
+        # Requests name files to read and write, only this machine may send them
+        if not isLoopbackHost(host):
+            fatal("Server host must be localhost or a 127.x.x.x address, not {}".format(host))
+        try:
+            server = http.server.HTTPServer((host, int(port)), RequestHandler)
+        except ValueError:
+            fatal("Invalid server address: {}".format(address))
+
+    logging.info("dp2ppgen v{} listening on {}".format(__version__, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+    finally:
+        server.server_close()
+        if socketPath and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+    return
+
+
+def main():
+    args = docopt(__doc__, version="dp2ppgen v{}".format(__version__))
+
+    if args['--jobs'] is not None:
+        try:
+            parseJobs(args['--jobs'])
+        except ValueError as e:
+            raise DocoptExit(str(e))
+
+    # Configure logging
+    configureLogging(args)
+    logging.debug(args)
+
+    if args['--serve']:
+        try:
+            serve(args['--serve'])
+        except ConversionError:
+            exit(1)
+        return
+
+    # Process processing options
+    args = resolveOptions(args)
+
+    if args['--batch']:
+        books = []
+        if args['--manifest']:
+            try:
+                books.extend(loadManifest(args['--manifest']))
+            except ConversionError:
+                exit(1)
+        # None rather than [] once defaults.json has been merged in (see mergeDict)
+        for infile in args['<infiles>'] or []:
+            books.append((infile, createOutputFileName(infile)))
+
+        if not books:
+            logging.critical("No books given to convert")
+            exit(1)
+
+        jobs = os.cpu_count() or 1
+        if args['--jobs']:
+            jobs = parseJobs(args['--jobs'])
+        jobs = min(jobs, len(books))
+
+        if batchConvert(books, args, jobs) > 0:
+            exit(1)
+        return
+
+    # Process required command line arguments
+    infile = args['<infile>']
+    outfile = createOutputFileName(infile)
+    if args['<outfile>']:
+        outfile = args['<outfile>']
+
+    if args['--diagnostics']:
+        logging.getLogger().addHandler(DiagnosticsHandler(args['--diagnostics']))
+
+    try:
+        convertFile(infile, outfile, args)
+    except ConversionError:
+        exit(1)
 
     return
 
 
 def loadJson(fn):
+    import json
+
     with open(fn) as f:
         data = json.load(f)
 
@@ -0,0 +1,47 @@
+import logging
+import sys
+
+import pytest
+
+from dp2ppgen.dp2ppgen import configureBatchLogging, main, parseJobs
+
+
+def test_batch_logging_names_records_without_a_book(capsys):
+    configureBatchLogging(logging.INFO)
+    try:
+        logging.getLogger("other").warning("from a library")
+        logging.warning("from a book", extra={'book': "a.txt"})
+    finally:
+        logging.basicConfig(force=True)
+
+    err = capsys.readouterr().err
+    assert "WARNING: [dp2ppgen] from a library" in err
+    assert "WARNING: [a.txt] from a book" in err
+
+
+@pytest.mark.parametrize("value", ["x", "0", "-2", "1.5"])
+def test_bad_jobs_rejected(value):
+    with pytest.raises(ValueError, match="--jobs"):
+        parseJobs(value)
+
+
+def test_batch_summary_after_failed_book(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "good.txt").write_text("-----File: 001.png---\\x\\-----\nSome text.\n")
+    (tmp_path / "bad.txt").write_text("-----File: 001.png---\\x\\-----\nSome <i>text.\n")
+    (tmp_path / "books.txt").write_text("bad.txt bad-out.txt\ngood.txt good-out.txt\n")
+
+    monkeypatch.setattr(sys, "argv", ["dp2ppgen", "--batch", "--manifest=books.txt", "--jobs=1"])
+    try:
+        with pytest.raises(SystemExit) as e:
+            main()
+    finally:
+        logging.basicConfig(force=True)
+
+    assert e.value.code == 1
+    assert not (tmp_path / "bad-out.txt").exists()
+    assert "Some text." in (tmp_path / "good-out.txt").read_text().split("\n")
+
+    captured = capsys.readouterr()
+    assert "1 converted, 1 failed" in captured.err
+    assert "converted" not in captured.out
@@ -0,0 +1,56 @@
+import logging
+
+from dp2ppgen import Converter
+from dp2ppgen.dp2ppgen import BlockLineLogFilter, processOOLFMarkup
+
+
+book = [
+    "-----File: 001.png---\\x\\-----",
+    "Text",
+    "",
+    "/*index",
+    "Apples, 1, 3",
+    "Pears, 12345",
+    "*/",
+    "",
+    "/*table",
+    "Title line",
+    "+---+---+",
+    "| a | b |",
+    "+---+---+",
+    "*/",
+    "-----File: 002.png---\\x\\-----",
+    "[Illustration: pic]",
+    "",
+]
+
+
+def diagnostics(options):
+    outBuf, result = Converter(["--force", "--markup", "--illustrations"] + options).convert(book)
+    return outBuf, {w['code']: w for w in reversed(result['warnings']) if 'code' in w}
+
+
+def test_handler_diagnostics_give_book_lines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf, found = diagnostics([])
+
+    assert found['index.digit-link']['line'] == 6
+    assert found['table.line-outside']['line'] == 10
+    assert found['illustration.no-image']['scanPage'] == "002.png"
+
+
+def test_diagnostics_give_output_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf, found = diagnostics(["--sourcemap"])
+
+    d = found['index.digit-link']
+    assert d['inputLine'] == 6
+    assert outBuf[d['outputLine']-1] == "Pears, 12345"
+
+
+def test_markup_stage_maps_handler_lines_on_its_own(caplog):
+    processOOLFMarkup(book, False)
+
+    codes = {r.diagnostic['code']: r.diagnostic for r in caplog.records if getattr(r, 'diagnostic', None)}
+    assert codes['index.digit-link']['line'] == 6
+    assert not any(isinstance(f, BlockLineLogFilter) for f in logging.getLogger().filters)
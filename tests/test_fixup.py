@@ -0,0 +1,72 @@
+import json
+import os
+
+from dp2ppgen import dp2ppgen
+from dp2ppgen.dp2ppgen import fixup, fixupRules
+
+
+before = [
+    "-----File: 001.png---\\x\\-----",
+    "Some text,\twith a tab.  ",
+    "<tb>",
+    "<tb>  ",
+    "Spaced  out , words .",
+    "",
+    "",
+    "-----File: 002.png---\\x\\-----",
+    "/*",
+    "Poem  line ,  spaced",
+    "\tindented \t",
+    "",
+    "*/",
+    "/#",
+    "Quote  , here",
+    "#/",
+    "",
+    "-----File: 003.png---\\x\\-----",
+    "End.",
+]
+
+# What fixup gave before it was made a list of rules: tabs to spaces, trailing
+# spaces removed, <tb> to .tb and blank lines at the end of pages removed
+after = [
+    "-----File: 001.png---\\x\\-----",
+    "Some text,    with a tab.",
+    ".tb",
+    ".tb",
+    "Spaced  out , words .",
+    "-----File: 002.png---\\x\\-----",
+    "/*",
+    "Poem  line ,  spaced",
+    "    indented",
+    "",
+    "*/",
+    "/#",
+    "Quote  , here",
+    "#/",
+    "-----File: 003.png---\\x\\-----",
+    "End.",
+]
+
+
+def test_default_rules_match_old_fixup():
+    hits = {}
+    assert fixup(list(before), False, None, hits) == after
+    assert hits['blankLinesAtPageEnds'] == 3
+
+
+def test_guiguts_rules_skip_out_of_line_blocks():
+    outBuf = fixup(list(before), False, {'multipleSpaces': True, 'spacesBeforePunctuation': True})
+
+    assert outBuf[4] == "Spaced out, words."
+    # multipleSpaces skips /* */ only, spacesBeforePunctuation both kinds of block
+    assert outBuf[7] == "Poem  line ,  spaced"
+    assert outBuf[12] == "Quote , here"
+
+
+def test_defaults_list_every_rule():
+    fn = os.path.join(os.path.dirname(dp2ppgen.__file__), "defaults.json")
+    with open(fn) as f:
+        defaults = json.load(f)
+
+    assert defaults['fixupRules'] == {rule[0]: rule[1] for rule in fixupRules}
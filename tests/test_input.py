@@ -0,0 +1,85 @@
+import io
+import sys
+import zipfile
+
+from dp2ppgen.dp2ppgen import Converter, MappedFile, loadFile, main, mapFile
+
+
+text = "-----File: 001.png---\\x\\-----\nSome text.  \n<tb>\n-----File: 002.png---\\x\\-----\nMore [oe]uvre\n"
+
+
+def test_mapped_file_converts_like_loaded_lines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fn = tmp_path / "book.txt"
+    fn.write_text(text, encoding="latin_1")
+
+    inBuf, encoding = mapFile(str(fn))
+    assert isinstance(inBuf, MappedFile)
+    try:
+        mapped = Converter(["--force", "--pages", "--utf8"]).convert(inBuf)[0]
+    finally:
+        inBuf.close()
+
+    loaded = Converter(["--force", "--pages", "--utf8"]).convert(loadFile(str(fn))[0])[0]
+    assert mapped == loaded
+
+
+def test_mmap_output_matches_plain_input(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "book.txt").write_bytes(("\n".join(["-----File: 001.png---\\x\\-----", "Caf\xe9 [oe]uvre", "", "<tb>"] * 300) + "\n").encode("latin_1"))
+
+    for options, outfile in (([], "plain.txt"), (["--mmap"], "mapped.txt")):
+        monkeypatch.setattr(sys, "argv", ["dp2ppgen", "--force", *options, "book.txt", outfile])
+        main()
+
+    assert (tmp_path / "mapped.txt").read_bytes() == (tmp_path / "plain.txt").read_bytes()
+
+
+def test_mapped_file_keeps_last_blocks(tmp_path):
+    fn = tmp_path / "book.txt"
+    fn.write_text("\n".join("line {}".format(n) for n in range(10)))
+
+    inBuf, encoding = mapFile(str(fn))
+    try:
+        inBuf.blockLines = 2
+        inBuf.cachedBlocks = 2
+        assert inBuf[0] == "line 0"
+        assert inBuf[3] == "line 3"
+        assert inBuf[1] == "line 1"
+        assert list(inBuf.blocks) == [1, 0]
+
+        # Block 1 was used longest ago and is dropped
+        assert inBuf[9] == "line 9"
+        assert list(inBuf.blocks) == [0, 4]
+        assert inBuf[2] == "line 2"
+        assert list(inBuf.blocks) == [4, 1]
+    finally:
+        inBuf.close()
+
+
+def test_zip_project_converts(tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.chdir(tmp_path)
+    image = io.BytesIO()
+    Image.new("RGB", (40, 30)).save(image, "PNG")
+    with zipfile.ZipFile(tmp_path / "project.zip", "w") as zf:
+        zf.writestr("project/book.txt", "-----File: 001.png---\\x\\-----\nSome text.\n[Illustration: A picture]\n\nMore text.\n")
+        zf.writestr("project/images/i_001.png", image.getvalue())
+
+    # The text is read from the archive once
+    opened = []
+    zipOpen = zipfile.ZipFile.open
+    def countingOpen(self, name, *args, **kwargs):
+        opened.append(getattr(name, 'filename', name))
+        return zipOpen(self, name, *args, **kwargs)
+    monkeypatch.setattr(zipfile.ZipFile, "open", countingOpen)
+
+    monkeypatch.setattr(sys, "argv", ["dp2ppgen", "--force", "--illustrations", "project.zip", "out.txt"])
+    main()
+
+    assert opened.count("project/book.txt") == 1
+    outBuf = (tmp_path / "out.txt").read_text(encoding="latin_1").split("\n")
+    assert ".il id=i_001 fn=i_001.png w=40px alt=''" in outBuf
+    assert ".ca A picture" in outBuf
+    assert "More text." in outBuf
@@ -0,0 +1,215 @@
+import importlib.metadata
+import logging
+import re
+
+import pytest
+
+from dp2ppgen import dp2ppgen
+from dp2ppgen.dp2ppgen import Converter, OOLFBlocks, detectMarkup, detectMarkupType, processOOLFMarkup, processPoetry, processToc, tocStyles
+
+
+book = [
+    "-----File: 001.png---\\x\\-----",
+    "/*toc",
+    "Chapter One        1",
+    "Chapter Two        3",
+    "*/",
+    "",
+    "/#",
+    "/*index",
+    "Apples, 1, 3",
+    "*/",
+    "#/",
+    "-----File: 002.png---\\x\\-----",
+    "Text one",
+    "-----File: 003.png---\\x\\-----",
+    "Text two",
+]
+
+
+def danglingLinks(lines):
+    outBuf, result = Converter(["--force", "--pages", "--markup"]).convert(lines)
+    return [w['message'] for w in result['warnings'] if w.get('code') == "links.dangling"]
+
+
+def test_page_links_not_checked_without_page_numbers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert danglingLinks(book) == []
+
+
+def test_page_links_checked_once_per_block(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lines = list(book)
+    lines.insert(lines.index("Text one"), ".pn 2")
+
+    messages = danglingLinks(lines)
+    assert len(messages) == 2
+    assert messages[0].endswith("in toc block point to pages that do not exist: 1")
+    assert messages[1].endswith("in index block point to pages that do not exist: 1")
+
+
+def test_letter_is_not_a_signature():
+    letter = [
+        "Dear Sir,",
+        "I write to tell you that the parcel you sent me last week has arrived.",
+        "Yours sincerely,",
+        "John",
+    ]
+    assert detectMarkupType(letter, "*") != "signature"
+    assert detectMarkupType(["Dear Sir,", "I write to thank you.", "Yours sincerely,", "John"], "*") != "signature"
+
+
+def test_signature_detected():
+    assert detectMarkupType(["I remain,", "    Yours very faithfully,", "        HENRY JAMES."], "*") == "signature"
+    assert detectMarkupType(["          Your obedient servant,", "               J. SMITH."], "*") == "signature"
+
+
+def test_poetry_detected():
+    poem = ["The sun is set, the swallows sleep,", "  The bats are flitting fast;", "",
+            "Across the hills the shadows creep,", "  The day is gone at last."]
+    assert detectMarkupType(poem, "*") == "poetry"
+
+
+def test_toc_detected():
+    toc = ["CONTENTS", "", "I. The Beginning        1", "II. The Middle        12", "III. The End        30"]
+    assert detectMarkupType(toc, "*") == "toc"
+
+
+def test_quoted_paragraphs_detected_as_bq():
+    quote = ["It was a truth universally acknowledged, that a single man in possession of a good",
+             "fortune, must be in want of a wife. However little known the feelings or views of such"]
+    assert detectMarkupType(quote, "#") == "bq"
+
+
+def test_unsure_blocks_left_alone():
+    book = ["/*", "Chapter One", "The beginning", "*/", "", "/#", "A short quoted line", "Another one", "#/"]
+    assert detectMarkupType(book[1:3], "*") == ""
+    assert detectMarkupType(book[6:8], "#") == ""
+    assert detectMarkup(book) == book
+
+
+def test_toc_mixed_styles():
+    toc = ["1. The Start      1", "XI. Columbus and the Savages      48", "SIR CHRISTOPHER WREN      24", "Other"]
+    assert processToc(toc, False, {}) == [
+        ".ta rlr",
+        "1.|#The Start:Page_1#|#1#",
+        "XI.|#Columbus and the Savages:Page_48#|#48#",
+        "|#SIR CHRISTOPHER WREN:Page_24#|#24#",
+        "Other",
+        ".ta-",
+    ]
+
+
+def test_toc_custom_style_matches_re_sub():
+    toc = ["The Start ... 1", "The End ... 20"]
+    s, r = r"^(.+?) \.\.\. (\d+)", r"\g<2>\t\1 \g<0>"
+    assert processToc(toc, False, {'s': s, 'r': r})[1:-1] == [re.sub(s, r, line) for line in toc]
+    assert processToc(toc, False, {'s': s}) == [".ta lr", "#The Start:Page_1#|#1#", "#The End:Page_20#|#20#", ".ta-"]
+    assert [style['r'] for style in tocStyles] == [r"\1|#\2:Page_\3#|#\3#", r"\1|#\2:Page_\3#|#\3#", r"#\1:Page_\2#|#\2#"]
+
+    with pytest.raises(re.error):
+        processToc(toc, False, {'s': s, 'r': r"\q"})
+
+
+poem = [
+    "    Tell me not, in mournful numbers,",
+    "      Life is but an empty dream!     10",
+    "",
+    "",
+    "    For the soul is dead that slumbers,",
+    "       And things are not what they seem.    20",
+]
+
+
+def test_poetry_kept_as_is():
+    assert processPoetry(list(poem), False, {}) == [".nf b"] + poem + [".nf-"]
+
+
+def test_poetry_normalized():
+    # The stray space of the last line joins the indent of the second
+    assert processPoetry(list(poem), False, {'normalize': 'normalize'}) == [
+        ".nf b",
+        "Tell me not, in mournful numbers,",
+        "  Life is but an empty dream!  10",
+        "",
+        "For the soul is dead that slumbers,",
+        "  And things are not what they seem.  20",
+        ".nf-",
+    ]
+
+
+def test_poetry_normalize_from_block_command(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf, result = Converter(["--force", "--markup"]).convert(["/*poetry normalize"] + poem + ["*/"])
+    assert "Tell me not, in mournful numbers," in outBuf
+
+
+class EntryPoint:
+    def __init__(self, name, value, load):
+        self.name = name
+        self.value = value
+        self.load = load
+
+
+def processGlossary(inBlock, keepOriginal, args):
+    return [".gl " + line for line in inBlock]
+
+processGlossary.aliases = ("gloss",)
+
+
+def brokenPlugin():
+    raise ImportError("no module named glossary")
+
+
+def test_markup_plugin_loaded_from_entry_points(monkeypatch, caplog):
+    groups = []
+    def entryPoints(**kwargs):
+        groups.append(kwargs.get('group'))
+        return [EntryPoint("glossary", "plugin:processGlossary", lambda: processGlossary),
+                EntryPoint("broken", "broken:handler", brokenPlugin)]
+
+    monkeypatch.setattr(importlib.metadata, "entry_points", entryPoints)
+    monkeypatch.setattr(dp2ppgen, "markupPluginsLoaded", False)
+    monkeypatch.setattr(dp2ppgen, "markupHandlers", dict(dp2ppgen.markupHandlers))
+    monkeypatch.setattr(dp2ppgen, "markupAliases", dict(dp2ppgen.markupAliases))
+
+    with caplog.at_level(logging.WARNING):
+        outBuf = processOOLFMarkup(["/*glossary", "one", "*/", "/*gloss", "two", "*/"], False)
+
+    assert groups == ["dp2ppgen.markup"]
+    assert outBuf == [".gl one", ".gl two"]
+    assert "Couldn't load markup handler broken" in caplog.text
+    # Loaded once
+    processOOLFMarkup(["/*gloss", "three", "*/"], False)
+    assert groups == ["dp2ppgen.markup"]
+
+
+nested = [
+    "Before",
+    "/#",
+    "Quote",
+    "/*",
+    "First verse",
+    "Last verse",
+    "*/",
+    "After verse",
+    "#/",
+    "/*",
+    "Only line",
+    "*/",
+    "End",
+]
+
+
+# Every line other than a block marker, including the first and last lines inside
+# a block and a block's only line
+@pytest.mark.parametrize("lineNum", [i for i, line in enumerate(nested) if not line.startswith(("/*", "/#", "*/", "#/"))])
+def test_delete_line_keeps_depths_in_step(lineNum):
+    oolf = OOLFBlocks(nested)
+    oolf.deleteLine(lineNum)
+
+    lines = nested[:lineNum] + nested[lineNum+1:]
+    fresh = OOLFBlocks(lines)
+    assert oolf.nowrapDepths == fresh.nowrapDepths
+    assert oolf.quoteDepths == fresh.quoteDepths
+    assert [oolf.depth(i) for i in range(len(lines))] == [fresh.depth(i) for i in range(len(lines))]
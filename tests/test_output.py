@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from dp2ppgen.dp2ppgen import AtomicLineWriter
+
+
+def test_interrupted_write_keeps_old_output(tmp_path):
+    fn = tmp_path / "out.txt"
+    fn.write_text("old output")
+
+    with pytest.raises(RuntimeError):
+        with AtomicLineWriter(str(fn), "latin_1") as w:
+            w.writeLines(["new", "output", "œuvre"])
+            raise RuntimeError("interrupted")
+
+    assert fn.read_text() == "old output"
+    assert os.listdir(tmp_path) == ["out.txt"]
+
+
+def test_switches_to_utf8(tmp_path):
+    fn = tmp_path / "out.txt"
+    with AtomicLineWriter(str(fn), "latin_1") as w:
+        w.writeLines(["Caf\xe9", "œuvre", "end"])
+
+    assert w.encoding == "utf_8"
+    assert fn.read_bytes() == "Caf\xe9\nœuvre\nend".encode("utf_8")
+    assert os.listdir(tmp_path) == ["out.txt"]
+
+
+def test_header_goes_first(tmp_path):
+    fn = tmp_path / "out.txt"
+    with AtomicLineWriter(str(fn), "latin_1") as w:
+        w.writeLines(["Caf\xe9", "end"])
+        w.writeHeader([".cv x"])
+
+    assert fn.read_bytes() == ".cv x\nCaf\xe9\nend".encode("latin_1")
+
+
+def test_header_switches_to_utf8(tmp_path):
+    fn = tmp_path / "out.txt"
+    with AtomicLineWriter(str(fn), "latin_1") as w:
+        w.writeLines(["Caf\xe9"])
+        w.writeHeader([".cv [oe] œ"])
+
+    assert fn.read_bytes() == ".cv [oe] œ\nCaf\xe9".encode("utf_8")
+    assert os.listdir(tmp_path) == ["out.txt"]
@@ -0,0 +1,56 @@
+from dp2ppgen.dp2ppgen import PageIndex
+
+
+def pageBreak(n):
+    return "-----File: {:03}.png---\\x\\-----".format(n)
+
+
+book = [
+    "Title",
+    pageBreak(1),
+    ".pn iii",
+    "Preface",
+    pageBreak(2),
+    ".pn +1",
+    "More preface",
+    pageBreak(3),
+    ".pn 1",
+    "Chapter",
+    pageBreak(4),
+    "A page without .pn",
+    pageBreak(5),
+    ".pn +2",
+    "Text",
+]
+
+
+def test_labels_across_pn_changes():
+    pageIndex = PageIndex(book)
+
+    assert [pageIndex.labelAt(lineNum) for lineNum in (0, 1, 3, 6, 9, 11, 14)] == [None, "iii", "iii", "iv", "1", "1", "3"]
+    assert pageIndex.numberedFrom == 1
+    assert pageIndex.labels() == {"iii", "iv", "1", "3"}
+
+
+def test_roman_to_arabic_numbering():
+    pageIndex = PageIndex(book)
+
+    assert pageIndex.pageNumAt(6) == (4, True)
+    assert pageIndex.pageNumAt(9) == (1, False)
+    # .pn +2 keeps counting in arabic numbers
+    assert pageIndex.pageNumAt(14) == (3, False)
+
+
+def test_page_breaks():
+    pageIndex = PageIndex(book)
+
+    assert pageIndex.pageBreaks() == [(1, "001.png"), (4, "002.png"), (7, "003.png"), (10, "004.png"), (12, "005.png")]
+    assert [pageIndex.scanPageAt(lineNum) for lineNum in (0, 3, 12, 14)] == [0, "001.png", "005.png", "005.png"]
+
+
+def test_counted_pages_are_not_labels():
+    pageIndex = PageIndex([pageBreak(1), ".pn +1", "Text", pageBreak(2), ".pn +1", "Text"])
+
+    assert pageIndex.labelAt(5) == "ii"
+    assert pageIndex.numberedFrom is None
+    assert pageIndex.labels() == set()
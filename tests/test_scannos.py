@@ -0,0 +1,36 @@
+import collections
+
+from dp2ppgen.dp2ppgen import WordTrie, findScannos, processScannos, swapScanno
+
+
+def trieOf(wordCounts):
+    trie = WordTrie()
+    for word, count in wordCounts.items():
+        trie.add(word, count)
+    return trie
+
+
+def test_known_scanno_found():
+    wordCounts = collections.Counter({'modern': 20, 'rnodern': 1, 'the': 30})
+    scannos = findScannos(trieOf(wordCounts), wordCounts)
+
+    assert scannos == {'rnodern': ((0, 'rn', 'm'),)}
+    assert swapScanno("rnodern", scannos['rnodern']) == "modern"
+    assert swapScanno("Rnodern", scannos['rnodern']) == "Modern"
+
+
+def test_swapped_toward_the_common_word():
+    # m to rn is tried as well as rn to m, only the rarer spelling is a scanno
+    wordCounts = collections.Counter({'modern': 1, 'rnodern': 20})
+    assert findScannos(trieOf(wordCounts), wordCounts) == {'modern': ((0, 'm', 'rn'),)}
+
+    wordCounts = collections.Counter({'modern': 5, 'rnodern': 1})
+    assert findScannos(trieOf(wordCounts), wordCounts) == {}
+
+
+def test_scannos_fixed_in_text():
+    inBuf = ["A modern house."] * 20 + ["-----File: 002.png---\\x\\-----", "The rnodern age and Rnodern times."]
+    outBuf = processScannos(inBuf, "fix")
+
+    assert outBuf[:21] == inBuf[:21]
+    assert outBuf[21] == "The modern age and Modern times."
@@ -0,0 +1,30 @@
+import pytest
+
+from dp2ppgen.dp2ppgen import ConversionError, LRUCache, isLoopbackHost, serve
+
+
+def test_loopback_hosts():
+    assert isLoopbackHost("localhost")
+    assert isLoopbackHost("127.0.0.1")
+    assert isLoopbackHost("127.1.2.3")
+    assert not isLoopbackHost("0.0.0.0")
+    assert not isLoopbackHost("192.168.1.10")
+    assert not isLoopbackHost("example.com")
+
+
+def test_serve_refuses_public_host():
+    with pytest.raises(ConversionError):
+        serve("0.0.0.0:8040")
+
+
+def test_cache_drops_least_recently_used():
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
@@ -0,0 +1,75 @@
+from dp2ppgen.dp2ppgen import Converter, SourceMap
+
+
+book = [
+    "-----File: 001.png---\\x\\-----",
+    "Some text.",
+    "",
+    "/#bq",
+    "A quotation in block form.",
+    "#/",
+    "",
+    "/*poetry normalize",
+    "  The first line of verse,",
+    "    indented line here,",
+    "*/",
+]
+
+
+def test_inserted_lines_are_not_exact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf, result = Converter(["--force", "--markup", "--detectmarkup", "--sourcemap"]).convert(book)
+    sourceMap = SourceMap(result['sourceMap'])
+
+    # The .in closing the block quote is not a line of the verse
+    outputLine = outBuf.index(".in", outBuf.index("A quotation in block form.")) + 1
+    inputLine, scanPage, exact = sourceMap.resolve(outputLine)
+    assert not exact
+
+    # Reindented verse still maps exactly
+    outputLine = outBuf.index("The first line of verse,") + 1
+    assert sourceMap.resolve(outputLine) == (9, "001.png", True)
+
+
+footnoteBook = [
+    "-----File: 001.png---\\x\\-----",
+    "",
+    "",
+    "",
+    "",
+    "CHAPTER I.",
+    "",
+    "",
+    "Text with an anchor[1] in it.",
+    "",
+    "[Footnote 1: The footnote,",
+    "over two lines.]",
+    "",
+    "-----File: 002.png---\\x\\-----",
+    "",
+    "",
+    "",
+    "",
+    "CHAPTER II.",
+    "",
+    "",
+    "More text.",
+]
+
+
+def test_moved_footnote_maps_to_its_block(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    options = ["--force", "--sourcemap", "--pages", "--chapters", "--footnotes", "--keeporiginal", "--boilerplate", "--tnote",
+               "--fndest=chapterend", "--lzdestt=bookend", "--lzdesth=chapterend"]
+    outBuf, result = Converter(options).convert(footnoteBook)
+    sourceMap = SourceMap(result['sourceMap'])
+
+    # Every stage recorded its edits
+    assert "Source map has" not in caplog.text
+
+    outputLine = outBuf.index("over two lines.") + 1
+    assert sourceMap.resolve(outputLine) == (12, "001.png", True)
+    outputLine = outBuf.index("More text.") + 1
+    assert sourceMap.resolve(outputLine) == (22, "002.png", True)
+    outputLine = outBuf.index(".fn-") + 1
+    assert not sourceMap.resolve(outputLine)[2]
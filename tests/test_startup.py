@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import time
+
+
+# Seconds `dp2ppgen --version` may take. Batch schedulers and editor hooks start
+# it thousands of times a day; set DP2PPGEN_STARTUP_BUDGET for slower machines.
+startupBudget = float(os.environ.get("DP2PPGEN_STARTUP_BUDGET", "0.5"))
+
+# Imported only by the stages that use them
+lazyModules = {"PIL", "json", "subprocess", "tempfile", "shlex", "glob", "docutils", "zipfile", "mmap", "http"}
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+versionScript = "import sys; sys.argv = ['dp2ppgen', '--version']; from dp2ppgen.dp2ppgen import main; main()"
+
+
+def runVersion(*pythonOptions):
+    return subprocess.run([sys.executable, *pythonOptions, "-c", versionScript], cwd=rootDir, capture_output=True, text=True, check=True)
+
+
+def test_version_imports_no_stage_modules():
+    proc = runVersion("-X", "importtime")
+
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:"):
+            imported.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+
+    assert "dp2ppgen" in imported
+    assert not imported & lazyModules
+
+
+def test_version_within_startup_budget():
+    seconds = []
+    for i in range(3):
+        startTime = time.perf_counter()
+        runVersion()
+        seconds.append(time.perf_counter() - startTime)
+
+    assert min(seconds) < startupBudget, "dp2ppgen --version took {:.3f}s, the budget is {}s".format(min(seconds), startupBudget)
@@ -0,0 +1,74 @@
+import logging
+
+from dp2ppgen import Converter
+from dp2ppgen.dp2ppgen import diagnostic, isLinePageBreak, streamStage
+
+
+# Markup closing at the end of a page followed by an empty page, so the two page
+# window of joinspanned ends on the page break lines
+book = [
+    "Text",
+    "/*",
+    "poem",
+    "*/",
+    "-----File: 002.png---\\x\\-----",
+    "-----File: 003.png---\\x\\-----",
+    "more",
+]
+
+
+def test_stream_default_options_finishes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf = list(Converter(["--force"]).stream(book))
+
+    assert outBuf[-1] == "more"
+    assert outBuf.count(".pn +1") == 2
+
+
+def test_stream_joinspanned_at_window_end(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outBuf = list(Converter(["--force", "--fixup", "--joinspanned"]).stream(book))
+
+    assert outBuf == book
+
+
+def test_stream_cv_statements_in_header(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lines = [
+        "-----File: 001.png---\\x\\-----",
+        "Caf[=e] here",
+        "-----File: 002.png---\\x\\-----",
+        "A [=o] and [=e]",
+    ]
+    converter = Converter(["--force", "--utf8"])
+    outBuf = list(converter.stream(lines))
+
+    assert not [line for line in outBuf if line.startswith(".cv")]
+    assert converter.streamHeader() == [".cv ē [=e]", ".cv ō [=o]"]
+
+
+# Adds a line after each page break and warns about "bad" lines, with the line in
+# the buffer it was given
+def addLineStage(buf):
+    outBuf = []
+    for i, line in enumerate(buf):
+        if line == "bad":
+            logging.warning("Line {}: bad before {}".format(i+1, buf[i+1]), extra=diagnostic("test.bad", i))
+        outBuf.append(line)
+        if isLinePageBreak(line) and (i+1 == len(buf) or buf[i+1] != ".pn +1"):
+            outBuf.append(".pn +1")
+    return outBuf
+
+
+def test_stream_lines_are_stage_input_lines(caplog):
+    pages = [
+        ["-----File: 001.png---\\x\\-----", "a", "b"],
+        ["-----File: 002.png---\\x\\-----", "bad", "c"],
+        ["-----File: 003.png---\\x\\-----", "d", "bad", "e"],
+    ]
+    outPages = list(streamStage(iter(pages), addLineStage, 2))
+
+    assert [len(page) for page in outPages] == [4, 4, 5]
+    lines = [r.diagnostic['line'] for r in caplog.records if getattr(r, 'diagnostic', None)]
+    assert lines == [5, 9]
+    assert [r.getMessage().split(":")[0] for r in caplog.records] == ["Line 5", "Line 9"]
@@ -0,0 +1,66 @@
+import logging
+
+from dp2ppgen.dp2ppgen import Converter, LineEdits, SourceMap, generateTransNote, indexProofersNotes
+
+
+def pageBreak(n):
+    return "-----File: {:03}.png---\\x\\-----".format(n)
+
+
+book = [
+    pageBreak(1),
+    ".pn 1",
+    "Some text[1] with a [**teh|the] typo in it.",
+    "A note [**unclear word] here.",
+    "",
+    "[Footnote 1: In the footnote a [**misprnt|misprint] is fixed.]",
+    pageBreak(2),
+    ".pn +1",
+    "Two [**a|b] notes [**c|d] on one line.",
+]
+
+
+def test_notes_indexed_by_position():
+    notes = indexProofersNotes(book)
+
+    assert [(n['lineNum'], n['start'], n['end'], n['id'], n['label']) for n in notes] == [
+        (2, 20, 31, "tnote_2", "1"),
+        (3, 7, 23, "tnote_3", "1"),
+        (5, 31, 51, "tnote_5", "1"),
+        (8, 4, 11, "tnote_8", "2"),
+        (8, 18, 25, "tnote_8_1", "2"),
+    ]
+    assert all(book[n['lineNum']][n['start']:n['end']] == n['text'] for n in notes)
+
+
+def test_transnote_changes_buffer_in_place():
+    inBuf = list(book)
+    edits = LineEdits()
+    outBuf = generateTransNote(inBuf, edits)
+
+    assert outBuf is inBuf
+    assert outBuf[2] == "Some text[1] with a <span id='tnote_2'>the</span> typo in it."
+    assert outBuf[3] == "A note [**unclear word] here."
+    assert outBuf[5] == "[Footnote 1: In the footnote a <span id='tnote_5'>misprint</span> is fixed.]"
+    assert outBuf[8] == "Two <span id='tnote_8'>b</span> notes <span id='tnote_8_1'>d</span> on one line."
+
+    tnote = outBuf[outBuf.index(".nf l")+1:outBuf.index(".nf-")]
+    assert tnote == [
+        "#Page 1:tnote_2#: text[1] with a <B>teh</B> typo in → text[1] with a <B>the</B> typo in",
+        "• #[**unclear word]:Page_1#",
+        "#Page 1:tnote_5#: In the footnote a <B>misprnt</B> is → In the footnote a <B>misprint</B> is",
+        "#Page 2:tnote_8#: Two <B>a</B> notes [**c|d] on → Two <B>b</B> notes [**c|d] on",
+        "#Page 2:tnote_8_1#: Two [**a|b] notes <B>c</B> on one → Two [**a|b] notes <B>d</B> on one",
+    ]
+    assert edits.steps == [[(len(book), 0, [None] * (len(outBuf)-len(book)), len(book)-1)]]
+
+
+def test_transnote_after_footnotes_maps_to_input(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    with caplog.at_level(logging.WARNING):
+        outBuf, result = Converter(["--force", "--footnotes", "--tnote", "--sourcemap"]).convert(book + [""])
+    sourceMap = SourceMap(result['sourceMap'])
+
+    assert "Source map has" not in caplog.text
+    outputLine = next(i for i, line in enumerate(outBuf) if "misprint</span>" in line) + 1
+    assert sourceMap.resolve(outputLine)[0] == book.index("[Footnote 1: In the footnote a [**misprnt|misprint] is fixed.]") + 1
@@ -0,0 +1,25 @@
+from dp2ppgen.dp2ppgen import convertUTF8, getUTF8Table
+
+
+def test_composed_diacritics():
+    outBuf = convertUTF8(["M[=a]ori", "Hom[)e]r and [:a] [c,]", "[vi] stays"])
+
+    # ā and ĕ are outside Latin-1 so get a .cv for the text output, ä and ç don't
+    assert outBuf == [".cv ĕ [)e]", ".cv ā [=a]", "Māori", "Homĕr and ä ç", "[vi] stays"]
+
+
+def test_ligatures():
+    outBuf = convertUTF8(["[oe]uvre, [OE]dipus, [ae]on, [AE]neid", "[oe]--"])
+
+    assert outBuf == ["œuvre, Œdipus, æon, Æneid", "œ—"]
+
+
+def test_cv_statements_follow_header():
+    inBuf = ["// A comment", ".dt The Title", ".de p { margin: 0 }", "", "[=o]"]
+
+    assert convertUTF8(inBuf) == ["// A comment", ".dt The Title", ".de p { margin: 0 }", ".cv ō [=o]", "", "ō"]
+
+
+def test_table_built_once():
+    assert getUTF8Table() is getUTF8Table()
+    assert getUTF8Table()["[=a]"] == "ā"
@@ -0,0 +1,64 @@
+import logging
+
+from dp2ppgen import dp2ppgen
+from dp2ppgen.dp2ppgen import validateDpMarkup
+
+
+def page(n, *lines):
+    return ["-----File: {:03}.png---\\x\\-----".format(n)] + list(lines)
+
+
+# Markup opened on one page and closed on the next, so it is open across the
+# boundary of every chunk, and one mismatched tag
+book = (
+    page(1, "Text with <i>italics", "and a block", "/*") +
+    page(2, "still in the block", "*/", "end of</i> italics", "[Footnote 1: A footnote") +
+    page(3, "over two pages.]", "Some <b>bold</i> text.") +
+    page(4, "A [bracket", "left open")
+)
+
+
+def errors(caplog, inBuf, jobs):
+    caplog.clear()
+    with caplog.at_level(logging.ERROR):
+        errorCount = validateDpMarkup(inBuf, jobs)
+    return errorCount, [r.getMessage() for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_parallel_validation_matches_sequential(caplog, monkeypatch):
+    sequential = errors(caplog, book, 1)
+    assert sequential[0] == 2
+
+    monkeypatch.setattr(dp2ppgen, "parallelValidationMinLines", 0)
+    for jobs in (2, 3, 4):
+        assert errors(caplog, book, jobs) == sequential
+
+
+def test_validation_runs_in_process_by_default():
+    args = {'--batch': False, '--jobs': None}
+    assert dp2ppgen.validationJobs(args) == 1
+    assert dp2ppgen.validationJobs(dict(args, **{'--jobs': "3"})) == 3
+
+
+def diagnostics(caplog, inBuf):
+    caplog.clear()
+    with caplog.at_level(logging.ERROR):
+        errorCount = validateDpMarkup(inBuf)
+    return errorCount, [(r.getMessage(), r.diagnostic and r.diagnostic['code']) for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_mismatched_tag_reported(caplog):
+    assert diagnostics(caplog, page(1, "Some <i>italic", "and</b> text.</i>", "A stray ]")) == (2, [
+        ("Line 3: Unexpected </b>, previous (2:<i>)", "markup.unexpected"),
+        ("Line 4: Unexpected ]", "markup.unexpected"),
+    ])
+
+
+def test_unclosed_blocks_reported(caplog):
+    inBuf = page(1, "/*", "A verse", "*/", "/#", "A quote", "", "/*", "More verse")
+
+    assert diagnostics(caplog, inBuf) == (1, [
+        ("Reached end of file with unresolved formatting markup, (probably due to previous markup error(s))", "markup.unresolved"),
+        ("Unresolved markup:", None),
+        ("Line 5: '/#', Line 8: '/*'", None),
+    ])